@@ -35,20 +35,21 @@
 ## PyVisa 1.8 is used
 ## Windows 7 Enterprise, 64-bit (has implications for time.clock if ported to unix type machine; use time.time instead)
 
-## HiSlip and Socket connections not supported
+## Connects over VISA (any interface), HiSLIP (through VISA), or a raw SCPI socket (built in; no VISA needed); see SCOPE_TRANSPORT
 
 ## DESCRIPTION OF FUNCTIONALITY
 ## This script is intended to be run after the user has acquired multiple waveforms in segmented memory mode from Infiniium's front panel, with an automatic measurement 
 ## enabled.  The script determines how many segments were acquired, logs the time tag and measurement result for each segment, and saves those values to a CSV file.  
 ## This script should work for all current Infiniium oscilloscopes running Infiniium version 6.00.00628 or higher.  
 
-## PyVisa does not yet support HiSlip connections.  Sockets are untested in this script.
+## HiSLIP needs a VISA library that supports it (e.g. Keysight IO Libraries); PyVISA-py does not.
 
 ## ALWAYS DO SOME TEST RUNS before making important measurements to ensure you are getting the data you need!  
 
 ## INSTRUCTIONS:
 ## Edit the VISA address of the oscilloscope (get this from Keysight Connection Expert)
 ## Edit the file save locations ## IMPORTANT NOTE:  This script WILL overwrite previously saved files!
+## (Or give these on the command line or in a configuration file instead; run the script with --help)
 ## Manually (or write more code) acquire segmented data on the oscilloscope.  Ensure that the data acquisition is finished.
 ## Run script.
 '''
@@ -56,14 +57,26 @@
 ## Import Python modules
 ##############################################################################################################################################################################
 
-## Import Python modules - Not all of these are used in this script; provided for reference
-import sys
-import visa
+## Import Python modules
+## Modules that take a while to load and are needed only for some options (PyVISA, matplotlib, argparse, ...) are imported where they are used, as
+## the logger is often launched many times in a row.  See --connect-only and benchmark_startup.
 import time
-import struct
+SCRIPT_START = time.time() # For the startup time, from here until the scope answers its first query
+import os
+import re
+import sys
+import gzip
+import json
+import atexit
+import Queue
+import pickle
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import warnings
 import numpy as np
-import scipy as sp
-import matplotlib.pyplot as plt
 
 ##############################################################################################################################################################################
 ## Define constants
@@ -72,9 +85,31 @@ import matplotlib.pyplot as plt
 ## Initialization constants
 SCOPE_VISA_ADDRESS = "msos804a" # Get this from Keysight Connection Expert
     ## Video: Connecting to Instruments Over LAN, USB, and GPIB in Keysight Connection Expert: https://youtu.be/sZz8bNHX5u4
+    ## Use a list of addresses, e.g. ["msos804a", "msos254a"], to run several scopes concurrently.  Each scope is set up, acquires, and is read out
+    ## in its own thread and saved to its own BASE_FILE_NAME + "_Scope<n>" files; the results of all scopes are merged into one timeline, sorted
+    ## by time tag, in BASE_FILE_NAME + "_Timeline.csv".  Continuous mode and the statistics report are single scope only.
+SCOPE_TRANSPORT = "VISA" # "VISA", "HISLIP", or "SOCKET"
+    ## VISA:   SCOPE_VISA_ADDRESS is opened with PyVISA as given (alias or resource string), except that raw socket resource strings
+    ##         (TCPIP0::<host>::<port>::SOCKET) are opened by the socket backend of this script
+    ## HISLIP: SCOPE_VISA_ADDRESS is the scope's host name or IP address, opened with PyVISA as TCPIP0::<host>::hislip0::INSTR
+    ## SOCKET: SCOPE_VISA_ADDRESS is the scope's host name or IP address (or host:port), connected to directly on SOCKET_PORT; no VISA is needed, so
+    ##         this works on any OS.  Lowest latency, but a socket has no device clear or service request:  clear() reconnects instead, and
+    ##         ACQUISITION_WAIT_METHOD must be "POLL".
+VISA_LIBRARY = "" # VISA library for PyVISA; "" finds the installed one, or e.g. "C:\\Windows\\System32\\visa32.dll", or "@py" for PyVISA-py
+SOCKET_PORT = 5025 # Infiniium SCPI socket port
+SOCKET_BUFFER_SIZE = 4194304 # Socket send and receive buffer size in bytes; large buffers keep big binary transfers streaming
+SYNCHRONIZED_ARMING = "YES" # "YES" or "NO"
+    ## With several scopes, YES waits until every scope is set up and then arms them all together, so that their time tags line up in the timeline
 GLOBAL_TIMEOUT = 10000 # General I/O timeout in milliseconds
 ACQUISITION_TIMEOUT = 30000 # Maximum time in milliseconds to wait to acquire all waveforms in segmented mode
 ACQUISITION_TIMEOUT_BEHAVIOR = "SAVE_AND_ABORT" # "SAVE_AND_ABORT" or "TRY_AGAIN"
+    ## SAVE_AND_ABORT: stop the acquisition and keep the segments acquired so far
+    ## TRY_AGAIN:      stop and restart the acquisition, up to ACQUISITION_RETRIES times, then keep the segments of the last try
+ACQUISITION_RETRIES = 2 # Restarts allowed with ACQUISITION_TIMEOUT_BEHAVIOR = "TRY_AGAIN"
+ACQUISITION_WAIT_METHOD = "POLL" # "POLL" or "SRQ"
+    ## POLL: arm with :SINGle and poll the acquisition done register (:ADER?), reporting segments acquired so far and the trigger rate
+    ## SRQ:  arm with :DIGitize;*OPC and wait for the service request; no progress is reported, as the scope is busy until done (GPIB, USB, and VXI-11/HiSLIP only)
+ACQUISITION_POLL_INTERVAL = 0.5 # Longest time in seconds between progress polls; polls come sooner when the acquisition is about to finish
 
 ## Save locations
 BASE_FILE_NAME = "my_data"
@@ -95,10 +130,20 @@ NUMBER_SEGMENTS = 100 # Number of waveforms to acquire in segmented mode
 
 NUMBER_CHANNELS = bool(CHANNEL_1_SCALE) + bool(CHANNEL_2_SCALE) + bool(CHANNEL_3_SCALE) + bool(CHANNEL_4_SCALE)
 print NUMBER_CHANNELS
+ENABLED_CHANNELS = [n for n, scale in [(1, CHANNEL_1_SCALE), (2, CHANNEL_2_SCALE), (3, CHANNEL_3_SCALE), (4, CHANNEL_4_SCALE)] if scale != 0]
 
 SETUP_METHOD = "SCRIPT" # "SCRIPT" or "MANUAL"
     ## MANUAL:  Manually set up the oscilloscope from the front panel 
     ## SCRIPT:  Scope configuration is completely controlled by the script 
+COALESCE_COMMANDS = "YES" # "YES" or "NO"
+    ## YES: settings are held back and sent together, ; joined, with the next command or query, and settings already sent with the same value are skipped.
+    ## This saves most of the round trips of the setup.  Errors are then checked at the end of the setup rather than after each command.
+SCPI_MAX_MESSAGE_LENGTH = 1024 # Longest combined program message, in characters
+SETUP_CACHE = "YES" # "YES" or "NO"
+    ## YES: with SETUP_METHOD = "SCRIPT", the scope's setup is saved (:SYSTem:SETup?) after the first scripted setup, and later runs restore it in one
+    ## transfer instead of resetting and setting up command by command.  The saved setup is found by a hash of the scope's *IDN? and the setup
+    ## constants and code, so changing any of them runs the scripted setup again.  Delete the Setup_*.set files to force it.
+SETUP_CACHE_DIRECTORY = BASE_DIRECTORY # Where the saved setups go, and the list of scopes without XLIST support (see TTAG_READ_METHOD)
 
 USE_AS_TRIGGER_TIME_RECORDER_ONLY = "NO" # "YES" or "NO"
     ## If YES, only log time tags for each trigger event.  No measurement results are logged.  
@@ -126,6 +171,39 @@ LOCK_SCOPE = "NO" ## "YES" or "NO"
     ## NOT UNLOCKED if a keyboard interrupt is issued.  Can be unlocked by changing the setting to NO and running the script or sending :SYSTem:LOCK 0 via IO Libraries/Connection Expert... 
 
 REPORT_THROUGHPUT_STATISTICS = "YES" ## "YES or "NO" ## This is only done at the end, after all acquisitions complete.
+REPORT_PLOTS = "FILES" # "FILES", "SCREEN", or "NO"
+    ## FILES:  the report plots are saved as PNG files, with an HTML page showing them all (BASE_FILE_NAME + "_Report.html"), by a background
+    ##         process with no display, so the script does not wait for them
+    ## SCREEN: the plots are shown on screen one after another; the script waits for each window to be closed
+    ## Either way, scatter plots are reduced to the lowest and highest point in each of REPORT_PLOT_WIDTH pixel columns, and histograms are counted
+    ## by NumPy into REPORT_HISTOGRAM_BINS bins, so drawing takes as long for millions of segments as for a few.
+REPORT_PLOT_WIDTH = 1200 # Plot width in pixels
+REPORT_HISTOGRAM_BINS = 100
+STATISTICS_PERCENTILES = [1, 50, 99] # Percentiles reported along with the average, standard deviation, minimum, and maximum
+SKETCH_RELATIVE_ACCURACY = 1e-4 # Relative accuracy of the percentiles in continuous mode, where statistics are updated run by run instead of from all results
+    ## Percentiles of 10 us trigger intervals come back within 1 ns; the standard deviation is exact, and the time tag analysis resolves jitter finer
+SKETCH_MAX_BUCKETS = 65536 # Most buckets kept for each sign of each column (16 bytes each); past this, the buckets nearest zero are merged
+    ## At the accuracy above, this covers five decades of magnitudes below the largest; percentiles of smaller magnitudes come back as the smallest kept
+SKETCH_MIN_MAGNITUDE = 1e-15 # Values of smaller magnitude are counted as zero
+ANALYZE_TIME_TAGS = "YES" # "YES" or "NO"
+    ## YES: as time tags are saved, they are analyzed chunk by chunk:  trigger rate (mean, instantaneous, and over windows), the trigger period fitted by
+    ## least squares and the jitter against it, dead time (shortest interval), and gaps that are likely missed triggers.  The results are saved to
+    ## BASE_FILE_NAME + "_TimeTagSummary.csv", and the gaps found to BASE_FILE_NAME + "_TimeTagGaps.csv".
+TIME_TAG_RATE_WINDOW = 1000 # Window for the windowed trigger rate, in trigger periods
+TIME_TAG_GAP_THRESHOLD = 1.5 # Intervals longer than this many trigger periods are gaps; intervals shorter than one period divided by this are flagged as short
+
+CONTINUOUS_RUNS = 1 # Number of segmented acquisitions (runs) to make back to back; 0 runs until stopped with Ctrl-C
+    ## With more than one run, the scope is re-armed as soon as each run is read out, and a background thread saves each run to its own
+    ## BASE_FILE_NAME + "_Run<n>" files while the next run is acquired.  Timing and duty cycle (fraction of time acquiring) of each run
+    ## are saved to BASE_FILE_NAME + "_Runs.csv".  Statistics are updated as each run is saved, and reported over all runs at the end.
+PROCESSING_QUEUE_SIZE = 2 # Runs waiting to be saved; if saving falls this far behind, readout waits for it instead of using more memory
+
+TRACE_COMMANDS = "NO" # "YES" or "NO"
+    ## YES: every write, query, and read to the scope is timed, along with the bytes sent and received and the phase of the script it belongs to
+    ## (setup, acquisition wait, time tag readout, measurement readout, waveform download, save, report).  At exit, a summary of where the time went
+    ## (scope I/O versus everything else in each phase, per-command latency percentiles and histograms) is printed, and the trace is saved to
+    ## BASE_FILE_NAME + "_Trace.csv" or "_Trace.json".  NO leaves the connection as it is, so there is no overhead.  Not available with several scopes.
+TRACE_FORMAT = "CSV" # "CSV" (one row per command) or "JSON" (summary, histograms, and every command)
 
 ## Save locations and format
 BASE_FILE_NAME = "my_data"
@@ -134,22 +212,177 @@ BASE_DIRECTORY = "C:\\Users\\Public\\"
 SAVE_FORMAT = "CSV" # "CSV" or "NUMPY"
     ## CSV is easy to work with and can be opened in Microsoft Excel, but it is slow
     ## NUMPY is a native Python binary format and is much faster than CSV
+SAVE_FLUSH_SEGMENTS = 10000 # Saved data is flushed to disk every this many segments, so a crash mid-run loses at most this many
+RESUME_READOUT = "YES" # "YES" or "NO"
+    ## YES: the readout records its progress after every batch in BASE_FILE_NAME + "_Readout.journal":  segments saved, the time tag of the last one,
+    ## and the length of each output file.  If the readout fails (timeout, Ctrl-C, lost connection), run the script again with the same settings:
+    ## it finds the journal, checks that the scope still holds the same acquisition, and reads on from the next segment into the same output files,
+    ## without setting up or arming the scope again.  The journal is removed once the readout is complete.  Single scope, single run, and
+    ## uncompressed output only.
+ARCHIVE_RUNS = "NO" # "YES" or "NO"
+    ## YES: every run (each run of continuous mode) is also added to the run archive in ARCHIVE_DIRECTORY, where runs are kept side by side instead of
+    ## being overwritten.  Each run is stored column by column in chunks of ARCHIVE_CHUNK_ROWS segments, and an index (Archive_Index.json) keeps
+    ## each run's metadata (start time, scope, columns) and each chunk's minimum and maximum per column.  Queries (ResultArchive.query, or
+    ## --query on the command line) use the index to read only the chunks that can hold matching rows, e.g. a time tag window or a measurement
+    ## over a threshold, memory mapped.
+ARCHIVE_DIRECTORY = BASE_DIRECTORY + "Archive"
+ARCHIVE_CHUNK_ROWS = 65536 # Segments per chunk; smaller chunks let queries skip more, but make the index bigger
+ARCHIVE_COMPRESSION = "NO" # "YES" or "NO"
+    ## YES: chunks are deflate compressed, in one .npz file per run.  Smaller, but chunks are decompressed when queried instead of memory mapped.
+CSV_PRECISION = 16 # Digits after the decimal point in CSV files (scientific notation); 16 reads back exactly, smaller values are faster and make smaller files
+CSV_CHUNK_ROWS = 100000 # Rows formatted and written at a time
+CSV_COMPRESSION = "NO" # "YES" or "NO"
+    ## If YES, CSV files are gzip compressed (fastest level) and named .csv.gz; np.loadtxt reads them directly
+
+## Time tag readout
+TTAG_READ_METHOD = "AUTO" # "AUTO", "XLIST", or "BATCH"
+    ## XLIST: Reads every time tag in a single transfer with :WAVeform:SEGMented:XLISt? TTAG (requires newer Infiniium firmware)
+    ## BATCH: Packs TTAG_BATCH_SIZE index/time tag query pairs into each SCPI message
+    ## AUTO:  Tries XLIST first and falls back to BATCH if the scope does not support it (older firmware will wait out one GLOBAL_TIMEOUT);
+    ##        scopes that do not answer are remembered, by *IDN? (which includes the firmware version), in Xlist_Unsupported.txt in
+    ##        SETUP_CACHE_DIRECTORY, so later runs and later launches on older firmware go straight to BATCH.  Delete the file after a firmware update.
+TTAG_BATCH_SIZE = 250 # Segments read per SCPI message in BATCH mode; larger is faster, but must fit in the scope's input buffer
+
+## Measurement readout
+MEAS_BATCH_SIZE = 50 # Segments measured per SCPI message; each segment adds its index, time tag, and measurement queries to the message
+
+## Waveform download
+DOWNLOAD_WAVEFORMS = "NO" # "YES" or "NO"
+    ## If YES, every segment of every enabled channel (scale not 0) is downloaded in one transfer per channel and saved to BASE_FILE_NAME + "_Waveforms.npy"
+    ## Large segmented memories can take longer than GLOBAL_TIMEOUT to transfer; increase GLOBAL_TIMEOUT as needed
+WAVEFORM_FORMAT = "WORD" # "WORD", "BYTE", or "ASCII"
+    ## WORD:  16 bit binary; full resolution
+    ## BYTE:  8 bit binary; half the transfer size of WORD, but only 8 bits of resolution
+    ## ASCII: comma separated voltages; many times larger and slower than binary, and provided for comparison only
+
+## Host-side measurements
+HOST_MEASUREMENTS = "NO" # "YES" or "NO"
+    ## If YES, the MEASURE_LIST measurements are computed by this script from the downloaded waveforms (requires DOWNLOAD_WAVEFORMS = "YES"),
+    ## instead of having the scope measure each segment.  Supports :MEASure:VPP, :MEASure:RISetime (10-90%), and :MEASure:TVOLt.
+    ## Top and base levels are the most common voltage in the upper and lower half of each segment's histogram (host_top_base), as on the scope;
+    ## results can still differ slightly from the scope's, which uses its own bin count and the full acquisition record.
+HOST_CHUNK_SEGMENTS = 10000 # Segments processed at a time; bounds memory use for waveform arrays larger than RAM (e.g. np.load(..., mmap_mode='r'))
+
+## Benchmarks
+RUN_BENCHMARKS = "NO" # "YES" or "NO"
+    ## If YES, runs the readout benchmarks against a simulated oscilloscope and exits.  No oscilloscope is needed.
+    ## Setting SCOPE_VISA_ADDRESS = "SIMULATED" instead runs the whole script against the simulated oscilloscope.
+BENCHMARK_SEGMENTS = 2000 # Number of segments in the simulated segmented memory
+BENCHMARK_LATENCY = 0.001 # Simulated VISA round trip time in seconds; 1 ms is typical for LAN
+BENCHMARK_COMMAND_LATENCY = {"*RST": 0.5} # Extra simulated processing time in seconds for individual commands, keyed by short form header (e.g. "ACQ:SEGM:IND")
+BENCHMARK_TRIGGER_PERIOD = 1e-5 # Time between simulated triggers in seconds; :DIGitize takes the number of segments times this long
+
+##############################################################################################################################################################################################################
+## Command line and configuration file
+##############################################################################################################################################################################################################
+
+## The constants above are the defaults.  Run with --help for the command line options, which override them:  the scope address, segments, channels,
+## measurements, and output location have flags of their own, any constant can be set with --set NAME=VALUE, and --config FILE reads a configuration
+## file of constant assignments in the same form as above (e.g. NUMBER_SEGMENTS = 1000), so a test sequence can keep one file per setup.
+## Flags take precedence over the configuration file.
+
+## Define a function to read a configuration file into a dictionary of constant names and values
+def read_configuration(filename):
+    settings = {}
+    execfile(filename, {}, settings)
+    return dict([(name, value) for name, value in settings.items() if not name.startswith("_")])
+
+## Define a function to parse the command line
+## Returns the parsed arguments; .settings holds the constants to override, by name
+def parse_command_line(argv, constants):
+    import argparse
+    import ast
+    parser = argparse.ArgumentParser(description = "Log the time tag and measurement results of each segment of an Infiniium segmented memory acquisition.",
+                                     epilog = "Any constant at the top of this script can be set with --set or in the configuration file.")
+    parser.add_argument("--config", metavar = "FILE", help = "configuration file of constant assignments, e.g. NUMBER_SEGMENTS = 1000")
+    parser.add_argument("--address", action = "append", metavar = "ADDRESS", help = "VISA address of the scope, or SIMULATED; repeat for several scopes")
+    parser.add_argument("--segments", type = int, metavar = "N", help = "number of segments to acquire")
+    parser.add_argument("--channel", action = "append", nargs = 3, type = float, metavar = ("N", "SCALE", "OFFSET"),
+                        help = "enable channel N with this scale and offset (V); repeat for each channel, the others are turned off")
+    parser.add_argument("--measure", action = "append", nargs = 2, metavar = ("NAME", "COMMAND"),
+                        help = "measurement to log, e.g. --measure \"V p-p(1) (V)\" \":MEASure:VPP CHANnel1\"; repeat for each, in place of MEASURE_LIST")
+    parser.add_argument("--output", metavar = "PATH", help = "directory and base file name of the saved files, e.g. C:\\Users\\Public\\my_data")
+    parser.add_argument("--set", action = "append", default = [], metavar = "NAME=VALUE", help = "set a constant; VALUE is a Python literal, else a string")
+    parser.add_argument("--benchmark", action = "store_true", help = "run the benchmarks against a simulated scope and exit")
+    parser.add_argument("--connect-only", action = "store_true", help = "connect to the scope, report the startup time, and exit")
+    parser.add_argument("--query", nargs = 3, metavar = ("COLUMN", "LOW", "HIGH"),
+                        help = "find the rows of the archived runs with COLUMN from LOW to HIGH, e.g. --query \"Time Tag (s)\" 0.5 0.6, or a measurement "
+                               "and 0.9 inf; save them to BASE_FILE_NAME + \"_Query_Run<n>.csv\" and exit")
+    parser.add_argument("--render-report", metavar = "FILE", help = argparse.SUPPRESS) # See start_report_process
+    args = parser.parse_args(argv)
+    if args.query is not None:
+        try:
+            args.query = [args.query[0], float(args.query[1]), float(args.query[2])]
+        except ValueError:
+            parser.error("--query needs a column name and two numbers")
+
+    settings = read_configuration(args.config) if args.config is not None else {}
+    if args.address:
+        settings["SCOPE_VISA_ADDRESS"] = args.address[0] if len(args.address) == 1 else args.address
+    if args.segments is not None:
+        settings["NUMBER_SEGMENTS"] = args.segments
+    if args.channel:
+        for n in range(1, 5):
+            settings["CHANNEL_%d_SCALE" % n] = settings["CHANNEL_%d_OFFSET" % n] = 0
+        for n, scale, offset in args.channel:
+            if n not in [1, 2, 3, 4]:
+                parser.error("there is no channel %g" % n)
+            settings["CHANNEL_%d_SCALE" % n] = scale
+            settings["CHANNEL_%d_OFFSET" % n] = offset
+    if args.measure:
+        settings["MEAS_METHOD"] = "SCRIPT"
+        settings["MEASURE_LIST"] = [command for name, command in args.measure]
+        settings["MEASUREMENT_HEADER"] = ",".join([name for name, command in args.measure])
+    if args.output is not None:
+        directory, settings["BASE_FILE_NAME"] = os.path.split(args.output)
+        settings["BASE_DIRECTORY"] = os.path.join(directory, "") if directory else ""
+    for setting in args.set:
+        name, equals, value = setting.partition("=")
+        if not equals:
+            parser.error("--set needs NAME=VALUE, not " + setting)
+        try:
+            settings[name.strip()] = ast.literal_eval(value.strip())
+        except (ValueError, SyntaxError):
+            settings[name.strip()] = value.strip()
+    if args.benchmark:
+        settings["RUN_BENCHMARKS"] = "YES"
+
+    unknown = sorted([name for name in settings if name not in constants])
+    if unknown:
+        parser.error("unknown constant(s): " + ", ".join(unknown))
+    args.settings = settings
+    return args
+
+## Override the constants, and the constants that follow from them
+if len(sys.argv) > 1:
+    Command_Line = parse_command_line(sys.argv[1:], globals())
+    globals().update(Command_Line.settings)
+    if "SETUP_CACHE_DIRECTORY" not in Command_Line.settings:
+        SETUP_CACHE_DIRECTORY = BASE_DIRECTORY
+    if "ARCHIVE_DIRECTORY" not in Command_Line.settings:
+        ARCHIVE_DIRECTORY = BASE_DIRECTORY + "Archive"
+    NUMBER_CHANNELS = bool(CHANNEL_1_SCALE) + bool(CHANNEL_2_SCALE) + bool(CHANNEL_3_SCALE) + bool(CHANNEL_4_SCALE)
+    ENABLED_CHANNELS = [n for n, scale in [(1, CHANNEL_1_SCALE), (2, CHANNEL_2_SCALE), (3, CHANNEL_3_SCALE), (4, CHANNEL_4_SCALE)] if scale != 0]
+else:
+    Command_Line = None
 
 ##############################################################################################################################################################################
 ## Define a few helper functions
 ##############################################################################################################################################################################
 
 ## Define Error Check function
-def ErrCheck():
+def ErrCheck(scope = None):
+    if scope is None:
+        scope = KsInfiniium
     myError = []
-    ErrorList = KsInfiniium.query(":SYSTem:ERRor? STRing").split(',')
+    ErrorList = scope.query(":SYSTem:ERRor? STRing").split(',')
     Error = ErrorList[0]
     while int(Error)!=0:
         print "Error #: " + ErrorList[0]
         print "Error Description: " + ErrorList[1]
         myError.append(ErrorList[0])
         myError.append(ErrorList[1])
-        ErrorList = KsInfiniium.query(":SYSTem:ERRor? STRing").split(',')
+        ErrorList = scope.query(":SYSTem:ERRor? STRing").split(',')
         Error = ErrorList[0]
         myError = list(myError)
     return myError
@@ -163,63 +396,2886 @@ def InfiniiumSafeExitCustomMessage(message):
     KsInfiniium.close()
     sys.exit(message)
 
+## Define a function to reduce a header node such as SEGMented or CHANnel1, or a keyword argument such as POSitive, to its short form (SEGM, CHAN1, POS)
+def scpi_short_form(node):
+    query = "?" if node.endswith("?") else ""
+    match = re.match(r"^(\*?[A-Z]+)[a-z]*(\d*)$", node.rstrip("?"))
+    if match is None:
+        return node.rstrip("?").upper() + query
+    return match.group(1) + match.group(2) + query
+
+## Define a function to split a SCPI program message at each ; that is not inside an IEEE 488.2 definite length block (#<n><length><data>)
+## Block data is binary and may hold any byte, ; and newline included.  Messages without a block, by far the most, take a fast path.
+def split_scpi_message(message):
+    if "#" not in message:
+        return [unit.strip() for unit in message.split(";")]
+    units = []
+    start = 0
+    i = 0
+    block_end = None # End of the block in the current unit; block data must not be stripped
+    while i < len(message):
+        if message[i] == "#" and message[i + 1:i + 2].isdigit() and message[i + 1] != "0":
+            ndigits = int(message[i + 1])
+            i = block_end = i + 2 + ndigits + int(message[i + 2:i + 2 + ndigits])
+            continue
+        if message[i] == ";":
+            units.append(message[start:block_end].lstrip() + message[block_end:i].strip() if block_end else message[start:i].strip())
+            start = i + 1
+            block_end = None
+        i += 1
+    units.append(message[start:block_end].lstrip() + message[block_end:].strip() if block_end else message[start:].strip())
+    return units
+
+## Define a function to find the end of the first complete program message in a stream of received text:  the index of its terminating newline, not
+## counting newlines inside definite length blocks, or -1 if the message is not all there yet
+def scpi_message_end(received):
+    i = 0
+    while True:
+        newline = received.find("\n", i)
+        block = received.find("#", i, newline if newline >= 0 else len(received))
+        if block < 0:
+            return newline
+        if not received[block + 1:block + 2].isdigit() or received[block + 1] == "0":
+            i = block + 1
+            continue
+        ndigits = int(received[block + 1])
+        if len(received) < block + 2 + ndigits:
+            return -1
+        i = block + 2 + ndigits + int(received[block + 2:block + 2 + ndigits])
+        if i > len(received):
+            return -1
+
+## Define a function to split a SCPI program message into its commands, following the SCPI rules for relative headers
+## Returns (key, header, args) for each command:  the short form path (CHAN1:SCAL), the absolute header (:CHANnel1:SCALe), and the arguments
+def parse_scpi_message(message):
+    commands = []
+    path = []
+    for unit in split_scpi_message(message):
+        if not unit:
+            continue
+        header, _, args = unit.partition(" ")
+        nodes = header.strip(":").split(":")
+        if header.startswith("*"): # Common commands do not change the current path
+            full = nodes
+        elif header.startswith(":") or not path:
+            full = nodes
+            path = nodes[:-1]
+        else:
+            full = path + nodes
+            path = full[:-1]
+        key = ":".join([scpi_short_form(node) for node in full])
+        args = args.lstrip()
+        if not args.startswith("#"):
+            args = args.rstrip()
+        commands.append((key, full[0] if header.startswith("*") else ":" + ":".join(full), args))
+    return commands
+
+## Define a raw SCPI socket connection to the scope, for SCOPE_TRANSPORT = "SOCKET", with the same interface as a PyVISA resource
+## (write, write_raw, query, read, read_raw, clear, close, timeout in milliseconds)
+## Nagle's algorithm is off, so each message goes out at once, and the socket buffers are large.  read_raw reads a definite length block
+## (#<n><length><data>) straight into a buffer of its exact size, and returns that buffer (a bytearray) for block_view, with no copies in Python.
+class SocketInstrument(object):
+
+    def __init__(self, host, port = SOCKET_PORT, timeout = GLOBAL_TIMEOUT, buffer_size = SOCKET_BUFFER_SIZE, no_delay = True):
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size
+        self.no_delay = no_delay
+        self._timeout = timeout
+        self._connect()
+
+    def _connect(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.no_delay:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.buffer_size:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.buffer_size) # Before connecting, so the receive window can be large
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.buffer_size)
+        self.socket.settimeout(self._timeout / 1000.0)
+        self.socket.connect((self.host, self.port))
+        self.pending = "" # Received past the end of the last reply
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+        self.socket.settimeout(timeout / 1000.0)
+
+    def _receive(self, count):
+        while len(self.pending) < count:
+            data = self.socket.recv(65536)
+            if not data:
+                raise IOError("Connection closed by the scope.")
+            self.pending += data
+        data = self.pending[:count]
+        self.pending = self.pending[count:]
+        return data
+
+    def write(self, message):
+        self.socket.sendall(message if message.endswith("\n") else message + "\n")
+
+    def write_raw(self, message):
+        self.socket.sendall(message)
+
+    def read(self):
+        chunks = [self.pending]
+        while "\n" not in chunks[-1]:
+            data = self.socket.recv(65536)
+            if not data:
+                raise IOError("Connection closed by the scope.")
+            chunks.append(data)
+        end = len(chunks[-1]) - chunks[-1].index("\n")
+        reply = "".join(chunks)
+        self.pending = reply[len(reply) - end + 1:]
+        return reply[:len(reply) - end + 1]
+
+    def read_raw(self):
+        start = self._receive(1)
+        if start == "#":
+            start += self._receive(1)
+        if len(start) < 2 or start[1] not in "123456789": # Not a definite length block
+            self.pending = start + self.pending
+            return self.read()
+        header = start + self._receive(int(start[1]))
+        raw = bytearray(len(header) + int(header[2:]) + 1) # The block and its terminating newline
+        raw[:len(header)] = header
+        filled = len(header) + len(self.pending[:len(raw) - len(header)])
+        raw[len(header):filled] = self.pending[:len(raw) - len(header)]
+        self.pending = self.pending[filled - len(header):]
+        view = memoryview(raw)
+        while filled < len(raw):
+            count = self.socket.recv_into(view[filled:], len(raw) - filled)
+            if count == 0:
+                raise IOError("Connection closed by the scope.")
+            filled += count
+        return raw
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    ## A socket has no device clear; reconnecting drops any reply not yet read
+    def clear(self):
+        self.socket.close()
+        self._connect()
+
+    def wait_for_srq(self, timeout):
+        raise IOError("A socket has no service request; use ACQUISITION_WAIT_METHOD = \"POLL\".")
+
+    def close(self):
+        self.socket.close()
+
+## Define a resource manager that opens each address with SCOPE_TRANSPORT, with the same interface as a PyVISA resource manager
+## PyVISA is only loaded if an address needs it.
+class ScopeResourceManager(object):
+
+    def __init__(self, transport = SCOPE_TRANSPORT, visa_library = VISA_LIBRARY):
+        self.transport = transport
+        self.visa_library = visa_library
+        self.visa = None
+        self.lock = threading.Lock() # Several scopes open their connections from their own threads
+
+    def _visa_resource(self, address):
+        with self.lock:
+            if self.visa is None:
+                import visa
+                self.visa = visa.ResourceManager(self.visa_library) if self.visa_library else visa.ResourceManager()
+        return self.visa.open_resource(address)
+
+    def open_resource(self, address):
+        fields = address.split("::")
+        if self.transport == "SOCKET":
+            host, _, port = address.partition(":")
+            return SocketInstrument(host, int(port) if port else SOCKET_PORT)
+        elif self.transport == "HISLIP":
+            return self._visa_resource("TCPIP0::%s::hislip0::INSTR" % address)
+        elif self.transport == "VISA" and len(fields) == 4 and fields[3].upper() == "SOCKET":
+            return SocketInstrument(fields[1], int(fields[2]))
+        elif self.transport == "VISA":
+            return self._visa_resource(address)
+        raise ValueError("SCOPE_TRANSPORT must be VISA, HISLIP, or SOCKET, not %s." % self.transport)
+
+    def close(self):
+        if self.visa is not None:
+            self.visa.close()
+
+## Define a session layer around the scope connection, for COALESCE_COMMANDS = "YES"
+## Settings written (commands with arguments in CACHED_SUBSYSTEMS) are held back and sent with the next other command or query, ; joined into program
+## messages of up to max_message characters, which saves a round trip each.  A setting already sent with the same value is skipped; this assumes
+## nothing else changes the settings during the session, except the commands in CACHE_RESETS, which clear the cache.
+## Queries go out as they are, after the held back settings.  Only the settings a query message carries (e.g. :ACQuire:SEGMented:INDex in the batched
+## readout) are looked at, as parsing whole batched readout queries would slow the readout down:  those settings are dropped from the cache, and the
+## commands in CACHE_RESETS clear it.  A plain query, such as *OPC? or :ADER?, leaves the cache alone.
+## A device clear drops the held back settings, and close sends them first.  Everything else (read_raw, timeout, ...) goes straight to the connection.
+class ScpiSession(object):
+
+    CACHED_SUBSYSTEMS = ["ACQ", "TIM", "CHAN1", "CHAN2", "CHAN3", "CHAN4", "TRIG", "WAV"]
+    CACHE_RESETS = ["*RST", "*RCL", "SYST:SET", "SYST:PRES", "AUT", "DIG", "SING", "RUN"] # An acquisition may move the segment index
+
+    def __init__(self, resource, max_message = SCPI_MAX_MESSAGE_LENGTH):
+        self.resource = resource
+        self.max_message = max_message
+        self.pending = []
+        self.cache = {}
+        self.keys = {} # Short form path of each absolute header seen in a query message
+        self.skipped = 0 # Settings not sent because they were already set
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    @property
+    def timeout(self):
+        return self.resource.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.resource.timeout = value
+
+    ## Normalize setting arguments, so that 0.2 matches 2.000000E-01 and CENTer matches CENT
+    @staticmethod
+    def _value(args):
+        values = []
+        for arg in args.split(","):
+            try:
+                values.append(repr(float(arg)))
+            except ValueError:
+                values.append(scpi_short_form(arg.strip()))
+        return ",".join(values)
+
+    ## Check the commands of a message against the cache; returns the commands to send, and whether any of them has to go out now
+    def _filter(self, message):
+        commands = []
+        send_now = False
+        for key, header, args in parse_scpi_message(message):
+            if key in self.CACHE_RESETS:
+                self.cache.clear()
+            if args and not key.endswith("?") and key.split(":")[0] in self.CACHED_SUBSYSTEMS:
+                value = self._value(args)
+                if self.cache.get(key) == value:
+                    self.skipped += 1
+                    continue
+                self.cache[key] = value
+            else:
+                send_now = True
+            commands.append(header + " " + args if args else header)
+        return commands, send_now
+
+    ## Join the held back settings, followed by the given message, into as few program messages as possible
+    ## The given message is not split, so that the caller's own batching is kept.
+    def _messages(self, message):
+        messages = []
+        for command in self.pending:
+            if messages and len(messages[-1]) + 1 + len(command) <= self.max_message:
+                messages[-1] += ";" + command
+            else:
+                messages.append(command)
+        del self.pending[:]
+        if messages and len(messages[-1]) + 1 + len(message) <= self.max_message:
+            messages[-1] += ";" + message
+        else:
+            messages.append(message)
+        return messages
+
+    def write(self, message):
+        commands, send_now = self._filter(message)
+        if not send_now:
+            self.pending.extend(commands)
+            return
+        for message in self._messages(";".join(commands)):
+            self.resource.write(message)
+
+    ## Keep the cache in step with the settings carried by a query message
+    def _track(self, message):
+        settings = [unit for unit in split_scpi_message(message) if unit and not unit.partition(" ")[0].endswith("?")]
+        if not settings:
+            return
+        if all([unit.startswith((":", "*")) for unit in settings]):
+            keys = []
+            for unit in settings:
+                header = unit.partition(" ")[0]
+                if header not in self.keys:
+                    self.keys[header] = parse_scpi_message(header)[0][0]
+                keys.append(self.keys[header])
+        else: # A relative header needs the path set by the commands before it
+            keys = [key for key, header, args in parse_scpi_message(message) if not key.endswith("?")]
+        for key in keys:
+            if key in self.CACHE_RESETS:
+                self.cache.clear()
+            else:
+                self.cache.pop(key, None)
+
+    def query(self, message):
+        self._track(message)
+        messages = self._messages(message)
+        for pending in messages[:-1]:
+            self.resource.write(pending)
+        return self.resource.query(messages[-1])
+
+    ## Binary messages (e.g. a setup to restore) are not parsed either, and clear the cache
+    def write_raw(self, message):
+        self.cache.clear()
+        if self.pending:
+            for pending in self._messages(self.pending.pop()):
+                self.resource.write(pending)
+        self.resource.write_raw(message)
+
+    ## The held back settings were never sent, so the cache, which already counts them as set, is cleared with them
+    def clear(self):
+        del self.pending[:]
+        self.cache.clear()
+        self.resource.clear()
+
+    def close(self):
+        if self.pending:
+            for pending in self._messages(self.pending.pop()):
+                self.resource.write(pending)
+        self.resource.close()
+
+## Define a tracer of the I/O with the scope, for TRACE_COMMANDS = "YES"
+## It wraps the connection, under any ScpiSession so that it sees the messages actually sent, and records for each write, query, and read:  when it
+## started and how long it took, the phase of the script, the first command of the message, and the bytes sent and received.  Phases are marked with
+## set_phase; the time in a phase not spent in scope I/O goes to parsing, computing, and writing to disk.
+class CommandTracer(object):
+
+    LATENCY_BINS = np.logspace(-6, 2, 33) # Histogram bin edges, 1 us to 100 s, 4 bins per decade
+
+    def __init__(self, resource):
+        self.resource = resource
+        self.events = [] # (start, phase, operation, command, duration, bytes sent, bytes received)
+        self.phases = [] # [phase, start, end]
+        self.phase = None
+        self.set_phase("connect")
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    @property
+    def timeout(self):
+        return self.resource.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.resource.timeout = value
+
+    def set_phase(self, phase):
+        now = timer()
+        if self.phases:
+            self.phases[-1][2] = now
+        self.phases.append([phase, now, None])
+        self.phase = phase
+
+    ## Label a message by its first command, and how many more it holds; batched messages would otherwise all be different
+    @staticmethod
+    def _label(message):
+        more = message.count(";")
+        first = message.split(";", 1)[0].strip().split(" ", 1)[0]
+        return first + " +%d" % more if more else first
+
+    def write(self, message):
+        start = timer()
+        self.resource.write(message)
+        self.events.append((start, self.phase, "write", self._label(message), timer() - start, len(message), 0))
+
+    def write_raw(self, message):
+        start = timer()
+        self.resource.write_raw(message)
+        self.events.append((start, self.phase, "write", self._label(message[:64]), timer() - start, len(message), 0))
+
+    def query(self, message):
+        start = timer()
+        reply = self.resource.query(message)
+        self.events.append((start, self.phase, "query", self._label(message), timer() - start, len(message), len(reply)))
+        return reply
+
+    def read(self):
+        start = timer()
+        reply = self.resource.read()
+        self.events.append((start, self.phase, "read", "", timer() - start, 0, len(reply)))
+        return reply
+
+    def read_raw(self):
+        start = timer()
+        reply = self.resource.read_raw()
+        self.events.append((start, self.phase, "read", "", timer() - start, 0, len(reply)))
+        return reply
+
+    ## Summarize the trace:  time, I/O time, and bytes per phase; latency percentiles per command; and a latency histogram per phase
+    def summary(self):
+        if self.phases[-1][2] is None:
+            self.phases[-1][2] = timer()
+        durations = np.array([event[4] for event in self.events])
+        phases = []
+        for phase, start, end in self.phases:
+            if phase not in [entry["phase"] for entry in phases]:
+                phases.append({"phase": phase, "wall_s": 0.0, "io_s": 0.0, "commands": 0, "bytes_sent": 0, "bytes_received": 0,
+                               "histogram": np.zeros(len(self.LATENCY_BINS) - 1, dtype = int)})
+            [entry for entry in phases if entry["phase"] == phase][0]["wall_s"] += end - start
+        by_phase = dict([(entry["phase"], entry) for entry in phases])
+        groups = {}
+        for i, (start, phase, operation, command, duration, sent, received) in enumerate(self.events):
+            entry = by_phase[phase]
+            entry["io_s"] += duration
+            entry["commands"] += 1
+            entry["bytes_sent"] += sent
+            entry["bytes_received"] += received
+            groups.setdefault((phase, operation, command.split(" +")[0]), []).append(i)
+        for entry in phases:
+            entry["histogram"] = np.histogram(durations[[i for i, event in enumerate(self.events) if event[1] == entry["phase"]]], self.LATENCY_BINS)[0].tolist()
+        commands = []
+        for (phase, operation, command), indices in groups.items():
+            d = durations[indices]
+            p50, p90, p99 = np.percentile(d, [50, 90, 99])
+            commands.append({"phase": phase, "operation": operation, "command": command, "count": len(d), "total_s": d.sum(), "mean_s": d.mean(),
+                             "p50_s": p50, "p90_s": p90, "p99_s": p99, "max_s": d.max()})
+        commands.sort(key = lambda entry: -entry["total_s"])
+        return {"phases": phases, "commands": commands, "histogram_bin_edges_s": self.LATENCY_BINS.tolist()}
+
+    ## Print where the time went
+    def report(self, summary = None, top = 10):
+        if summary is None:
+            summary = self.summary()
+        print "I/O TRACE:\n"
+        print "\t%-20s %10s %10s %10s %9s %12s %14s" % ("Phase", "Time (s)", "I/O (s)", "Other (s)", "Commands", "Sent (B)", "Received (B)")
+        for entry in summary["phases"]:
+            print "\t%-20s %10.3f %10.3f %10.3f %9d %12d %14d" % (entry["phase"], entry["wall_s"], entry["io_s"], entry["wall_s"] - entry["io_s"],
+                                                                 entry["commands"], entry["bytes_sent"], entry["bytes_received"])
+        print "\n\tCommands taking the most time (ms):"
+        print "\t%-20s %-6s %-32s %7s %10s %8s %8s %8s %8s %8s" % ("Phase", "I/O", "Command", "Count", "Total (s)", "Mean", "p50", "p90", "p99", "Max")
+        for entry in summary["commands"][:top]:
+            print "\t%-20s %-6s %-32s %7d %10.3f %8.3f %8.3f %8.3f %8.3f %8.3f" % (entry["phase"], entry["operation"], entry["command"][:32], entry["count"], entry["total_s"],
+                                                                              1e3 * entry["mean_s"], 1e3 * entry["p50_s"], 1e3 * entry["p90_s"], 1e3 * entry["p99_s"], 1e3 * entry["max_s"])
+        print "\n\tLatency histograms:"
+        edges = summary["histogram_bin_edges_s"]
+        for entry in summary["phases"]:
+            counts = entry["histogram"]
+            if not any(counts):
+                continue
+            print "\t%s:" % entry["phase"]
+            for low, high, count in zip(edges[:-1], edges[1:], counts):
+                if count:
+                    print "\t\t%9.1f - %9.1f us %8d %s" % (low * 1e6, high * 1e6, count, "#" * int(np.ceil(40.0 * count / max(counts))))
+        print ""
+
+    ## Save the trace, as CSV (one row per command) or JSON (the summary and every command)
+    def save(self, base_path, trace_format = TRACE_FORMAT):
+        if trace_format == "JSON":
+            keys = ["start_s", "phase", "operation", "command", "duration_s", "bytes_sent", "bytes_received"]
+            with open(base_path + "_Trace.json", 'w') as f:
+                json.dump({"summary": self.summary(), "events": [dict(zip(keys, event)) for event in self.events]}, f)
+        else:
+            with open(base_path + "_Trace.csv", 'w') as f:
+                f.write("Start (s),Phase,Operation,Command,Duration (s),Bytes sent,Bytes received\n")
+                start = self.phases[0][1]
+                f.writelines(["%.6f,%s,%s,%s,%.6e,%d,%d\n" % ((event[0] - start,) + event[1:]) for event in self.events])
+
+    ## Report and save the trace; registered to run at exit
+    def finish(self, base_path, trace_format = TRACE_FORMAT):
+        summary = self.summary()
+        self.report(summary)
+        self.save(base_path, trace_format)
+        print "I/O trace saved to " + base_path + ("_Trace.json" if trace_format == "JSON" else "_Trace.csv")
+
+## The tracer in use, if TRACE_COMMANDS = "YES"; set in the main code
+COMMAND_TRACER = None
+
+## Define a function to mark the start of a phase of the script in the I/O trace
+def trace_phase(phase):
+    if COMMAND_TRACER is not None:
+        COMMAND_TRACER.set_phase(phase)
+
+## Define a function to wait for an acquisition by polling, reporting progress
+## Returns True when the acquisition is done, or False if it is not done within timeout milliseconds.
+def wait_for_acquisition_poll(scope, NSegs, timeout = ACQUISITION_TIMEOUT):
+    scope.query(":ADER?") # Reading the acquisition done event register clears it
+    scope.write(":SINGle")
+    start = timer()
+    first = None # (time, segments) of the first poll; the trigger rate is measured from there, as the first poll is mostly latency
+    idle_wait = 0.01 # Until the trigger rate is known, back off from a short first poll
+    while True:
+        done, acquired = scope.query(":ADER?;:WAVeform:SEGMented:COUNt?").strip().split(";")
+        elapsed = timer() - start
+        acquired = int(acquired)
+        if int(done) == 1:
+            sys.stdout.write("\r\t%d of %d segments acquired in %.3f s.                    \n" % (NSegs, NSegs, elapsed))
+            return True
+        if first is None:
+            first = (elapsed, acquired)
+        rate = (acquired - first[1]) / (elapsed - first[0]) if elapsed > first[0] else 0.0
+        sys.stdout.write("\r\t%d of %d segments acquired, %.1f segments/s" % (acquired, NSegs, rate))
+        sys.stdout.flush()
+        if elapsed * 1000.0 >= timeout:
+            sys.stdout.write("\n")
+            return False
+        if rate > 0:
+            remaining = (NSegs - acquired) / rate # Estimated time to finish
+        else:
+            remaining = idle_wait
+            idle_wait = min(2 * idle_wait, ACQUISITION_POLL_INTERVAL)
+        time.sleep(max(0.001, min(ACQUISITION_POLL_INTERVAL, remaining, timeout / 1000.0 - elapsed)))
+
+## Define a function to wait for an acquisition on a service request
+## Returns True when the acquisition is done, or False if it is not done within timeout milliseconds.
+def wait_for_acquisition_srq(scope, timeout = ACQUISITION_TIMEOUT):
+    scope.write("*CLS;*ESE 1;*SRE 32") # Operation complete sets the event status bit, which requests service
+    scope.write(":DIGitize;*OPC")
+    try:
+        scope.wait_for_srq(timeout)
+    except Exception: # Timeout
+        return False
+    scope.query("*ESR?") # Clear the event
+    return True
+
 ## Define a function to acquire all waveforms and wait for the acquisition to complete
-def acquire_waveforms():
-
-    KsInfiniium.timeout = ACQUISITION_TIMEOUT # Use a separate timeout value to give the segmented acquisition enough time to complete
-    sys.stdout.write("Acquiring waveforms...\n")
-    try: # Set up a try/except block to catch a possible timeout and exit
-        KsInfiniium.query(":DIGitize;*OPC?") # Acquire the signal(s) with :DIGitize (blocking) and wait until *OPC? comes back with a one.
-        sys.stdout.write("All %d segments were acquired.\n" % NUMBER_SEGMENTS)
-    except Exception: # Catch a possible timeout and exit.
-        print "The acquisition timed out, most likely due to no trigger or an insufficient ACQUISITION_TIMEOUT. Properly closing scope connection and exiting script.\n"
-        KsInfiniium.clear() # Clear the remote interface and abort the :DIGitize operation
-        KsInfiniium.close() # Close interface to scope
-        sys.exit("Exiting script.")
-    KsInfiniium.timeout =  GLOBAL_TIMEOUT # Restore the general I/O timeout value
-
-## Define a function for saving data
-def Save_Data(R, MH):    
-
-    ## Save measurement data
-    if SAVE_FORMAT == "CSV" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
-    
-        ## Finish creating header info
-        MH = MH.strip('\n')
-        MH = "Index,Time Tag (s)," + MH + "\n"
-        
-        ## Save data in CSV format - viewable in Microsoft Excel, etc.
-        filename = BASE_DIRECTORY + BASE_FILE_NAME + "_Measurements.csv"
-        with open(filename, 'w') as filehandle:
-            filehandle.write(str(MH))
-            np.savetxt(filehandle, R, delimiter=',')
-        
-        ### Read CSV data back into Python with:
-        #with open(filename, 'r') as filehandle: # r means open for reading
-        #    recalled_CSV_data = np.loadtxt(filename,delimiter=',',skiprows=1)    
-        
-        del filehandle, filename     
+## If the acquisition is not done within ACQUISITION_TIMEOUT (most likely a missing trigger), it is stopped, and the segments acquired so far are kept
+## (SAVE_AND_ABORT) or it is restarted (TRY_AGAIN).  Returns True if all segments were acquired; the caller finds how many were with :WAVeform:SEGMented:COUNt?
+def acquire_waveforms(scope = None, NSegs = NUMBER_SEGMENTS, wait_method = ACQUISITION_WAIT_METHOD, timeout_behavior = ACQUISITION_TIMEOUT_BEHAVIOR, timeout = ACQUISITION_TIMEOUT):
+
+    if scope is None:
+        scope = KsInfiniium
+    tries = 1 + (ACQUISITION_RETRIES if timeout_behavior == "TRY_AGAIN" else 0)
+    for attempt in xrange(tries):
+        sys.stdout.write("Acquiring waveforms...\n")
+        try: # Set up a try/except block to catch a lost connection and exit
+            if wait_method == "SRQ":
+                done = wait_for_acquisition_srq(scope, timeout)
+            else:
+                done = wait_for_acquisition_poll(scope, NSegs, timeout)
+        except Exception:
+            print "Communication with the scope failed during the acquisition. Properly closing scope connection and exiting script.\n"
+            scope.clear() # Clear the remote interface and abort the acquisition
+            scope.close() # Close interface to scope
+            sys.exit("Exiting script.")
+        if done:
+            sys.stdout.write("All %d segments were acquired.\n" % NSegs)
+            return True
+
+        scope.clear() # Clear the remote interface and abort :DIGitize, if it was used
+        scope.query(":STOP;*OPC?") # Stop; the segments acquired so far are kept
+        acquired = int(scope.query(":WAVeform:SEGMented:COUNt?"))
+        print "The acquisition timed out after %d of %d segments, most likely due to a missing trigger or an insufficient ACQUISITION_TIMEOUT." % (acquired, NSegs)
+        if attempt + 1 < tries:
+            print "Trying again (retry %d of %d)." % (attempt + 1, tries - 1)
+    print "Keeping the %d segments acquired." % acquired
+    return False
+
+## Define a function to set up the scope for SETUP_METHOD = "SCRIPT"
+def setup_scope(scope, NSegs = NUMBER_SEGMENTS):
+
+    ## Start with a default setup
+    scope.query("*RST;*OPC?") # Reset scope
+    scope.write(":STOP") # Stop scope before making changes
+
+    ## Set acquisition type        
+    scope.write(":ACQuire:MODE SEGMented")
     
-    elif SAVE_FORMAT == "NUMPY" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
-        filename = BASE_DIRECTORY + BASE_FILE_NAME + ".npy"
-        with open(filename, 'wb') as filehandle: # wb means open for writing in binary; can overwrite
-            np.save(filehandle, R)
-        
-    #    ## Read the NUMPY BINARY data back into Python with:
-    #    with open(filename, 'rb') as filehandle: # rb means open for reading binary
-    #        recalled_NPY_data = np.load(filehandle)
-    #        ## NOTE, if one were to not use with open, and just do np.save like this:
-    #                ## np.save(filename, Results)
-    #                ## this method automatically appends a .npy to the file name...
-           
-    ## Save trigger time tags
-    if USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
-        with open(filename, 'w') as filehandle:
-            filehandle.write("Apparent trigger times (s)\n")
-            np.savetxt(filehandle, R[:,1], delimiter=',')
-    del filename, filehandle
-
-    return R, MH
+    ## Setup timebase - Set them in this order
+    scope.write(":TIMebase:VIEW MAIN")
+    scope.write(":TIMebase:REFerence CENTer")
+    scope.write(":TIMebase:SCALe 5e-9") # Set horizontal scale (seconds/division)
+    scope.write(":TIMebase:POSition 0")
+
+    ## Turn the channels of ENABLED_CHANNELS on, with their vertical scale (volts/division) and offset, and the others off
+    channel_settings = [(CHANNEL_1_SCALE, CHANNEL_1_OFFSET), (CHANNEL_2_SCALE, CHANNEL_2_OFFSET), (CHANNEL_3_SCALE, CHANNEL_3_OFFSET), (CHANNEL_4_SCALE, CHANNEL_4_OFFSET)]
+    for n, (scale, offset) in enumerate(channel_settings, 1):
+        if n in ENABLED_CHANNELS:
+            scope.write(":CHANnel%d:DISPlay 1; SCALe %g; OFFSet %g" % (n, scale, offset))
+        else:
+            scope.write(":CHANnel%d:DISPlay 0" % n)
+
+    ## Set up trigger
+    ## Trigger sweep is always TRIGgered (not AUTO) in Segmented memory mode
+    scope.write(":TRIGger:MODE EDGE")
+    scope.write(":TRIGger:EDGE:SOURce CHANnel1") # Set source for edge trigger    
+    scope.write(":TRIGger:EDGE:COUPling DC")
+    scope.write(":TRIGger:EDGE:SLOPe POSitive")
+    scope.write(":TRIGger:LEVel CHANnel1,0") # Set level last
+
+    ## Set up segmented acquisiton
+    scope.write(":ACQuire:SEGMented:COUNt %d" % NSegs)
+    scope.query("*OPC?") # Wait for the setup to complete; the caller then checks for errors
+
+## Define a function to find the file of the saved setup for SETUP_CACHE = "YES"
+## The file name holds a hash of everything the scripted setup depends on:  the scope (model, serial number, firmware), the value of every constant
+## setup_scope reads (e.g. ENABLED_CHANNELS and each CHANNEL_<n>_SCALE and _OFFSET), and the code of setup_scope itself, so that editing the setup
+## or its configuration is picked up too.
+def setup_cache_file(scope, NSegs = NUMBER_SEGMENTS, directory = SETUP_CACHE_DIRECTORY):
+    code = setup_scope.__code__
+    constants = [(name, globals()[name]) for name in sorted(code.co_names) if name.isupper() and name in globals()]
+    key = repr((scope.query("*IDN?").strip(), NSegs, constants, code.co_code, code.co_consts, code.co_names))
+    return os.path.join(directory, "Setup_%s.set" % hashlib.sha1(key).hexdigest()[:16])
+
+## Define a function to restore a saved setup in a single transfer
+## Returns False if there is no saved setup yet
+def restore_setup(scope, filename):
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        setup = f.read()
+    scope.write_raw(":SYSTem:SETup #8%08d%s\n" % (len(setup), setup)) # Definite length block, for setups of up to 99,999,999 bytes
+    scope.query("*OPC?")
+    return True
+
+## Define a function to save the scope's setup, as a binary block, for restore_setup
+def save_setup(scope, filename):
+    scope.write(":SYSTem:SETup?")
+    setup = block_view(scope.read_raw(), np.uint8).tostring()
+    with open(filename, 'wb') as f:
+        f.write(setup)
+
+## Define a fast replacement for np.savetxt
+## np.savetxt formats one row at a time in Python.  This formats chunk_rows rows with a single % operation and writes them in one call.
+## The output (values in %.<precision>e format, comma delimited, one row per line) reads back with np.loadtxt(filename, delimiter = ',').
+def fast_savetxt(filehandle, X, precision = CSV_PRECISION, chunk_rows = CSV_CHUNK_ROWS):
+    X = np.asarray(X, dtype = np.float64)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    row_format = ",".join(["%%.%de" % precision] * X.shape[1]) + "\n"
+    for start in xrange(0, len(X), chunk_rows):
+        chunk = X[start:start + chunk_rows]
+        filehandle.write((row_format * len(chunk)) % tuple(chunk.ravel()))
+
+## Define a function to open a CSV file for writing, gzip compressed if CSV_COMPRESSION = "YES"
+def open_csv(filename, compression = CSV_COMPRESSION):
+    if compression == "YES":
+        return gzip.open(filename + ".gz", 'wb', 1)
+    return open(filename, 'wb')
+
+## Define a function to read the readout journal at base_path (see StreamingResultWriter)
+## Returns a dictionary of the run it belongs to (scope, segments, measurements, header, save format) and the progress of its readout
+## (segments saved, last time tag, measurement offset, time tag offset), or None if there is no journal.
+def read_readout_journal(base_path):
+    try:
+        with open(base_path + "_Readout.journal", 'rb') as f:
+            identity, progress = f.read().split("\n")[:2]
+        journal = json.loads(identity)
+        saved, last_time_tag, measurement_offset, time_tag_offset = progress.split(",")
+    except (IOError, ValueError):
+        return None
+    journal.update({"segments saved": int(saved), "last time tag": float(last_time_tag),
+                    "measurement offset": int(measurement_offset), "time tag offset": int(time_tag_offset)})
+    return journal
+
+## Define a function to describe a readout for its journal:  a journal is only resumed by a readout with the same identity
+def readout_identity(scope_id, NSegs, NMeas, header = MEASUREMENT_HEADER, save_format = SAVE_FORMAT):
+    return {"scope": scope_id, "segments": NSegs, "measurements": NMeas, "header": "Index,Time Tag (s)," + header.strip('\n'), "save format": save_format,
+            "csv compression": CSV_COMPRESSION}
+
+## Define a function to find a readout to resume:  the journal left at base_path by a readout that did not finish, if it was made with the same settings
+## (number of measurements, header, save format, and compression) and the scope still holds the same acquisition (the same scope, number of segments,
+## and time tag of the last segment saved).  Returns the journal, or None.
+def find_resumable_readout(scope, base_path, NMeas, header = MEASUREMENT_HEADER, save_format = SAVE_FORMAT):
+    journal = read_readout_journal(base_path)
+    if journal is None:
+        return None
+    identity = readout_identity(scope.query("*IDN?").strip(), journal["segments"], NMeas, header, save_format)
+    if any([journal.get(key) != value for key, value in identity.items()]):
+        return None
+    if int(scope.query(":WAVeform:SEGMented:COUNt?")) != journal["segments"]:
+        return None
+    if journal["segments saved"] > 0:
+        if float(scope.query(":ACQuire:SEGMented:INDex %d;:WAVeform:SEGMented:TTAG?" % journal["segments saved"])) != journal["last time tag"]:
+            return None
+    return journal
+
+## Define a streaming writer for saving data
+## Each batch of segments is saved as soon as it is read, instead of all at the end, so a crash loses at most flush_segments segments
+## and the memory used does not grow with the number of segments.
+##     SAVE_FORMAT = "NUMPY": results go to a memory mapped .npy file, pre-allocated for NSegs segments; rows not yet written have index 0
+##     SAVE_FORMAT = "CSV":   results are appended to the _Measurements.csv file
+## Time tags are always appended to their own _TimeTags.csv file, which never overwrites the measurement output, and analyzed on the way if
+## ANALYZE_TIME_TAGS = "YES" (see TimeTagAnalyzer); the analysis is saved on close.
+## With no measurements (NMeas = 0, e.g. USE_AS_TRIGGER_TIME_RECORDER_ONLY = "YES") only time tags are saved.
+## With resume = "YES", the progress is written to the readout journal after every batch (see RESUME_READOUT), once the batch is out of this
+## process, so the journal never claims more than the files hold.  Given the journal of a readout that did not finish, the writer reopens its files,
+## cuts off anything written after the last batch recorded, and carries on from there; the readout functions then start at the next segment.
+## If the journal does not fit (different settings, or files shorter than recorded), the files are started over.
+class StreamingResultWriter(object):
+
+    def __init__(self, base_path, NSegs, NMeas, header = MEASUREMENT_HEADER, save_format = SAVE_FORMAT, flush_segments = SAVE_FLUSH_SEGMENTS, analyze = ANALYZE_TIME_TAGS,
+                 resume = RESUME_READOUT, scope_id = "", journal = None):
+        self.header = "Index,Time Tag (s)," + header.strip('\n')
+        self.base_path = base_path
+        self.flush_segments = flush_segments
+        self.analyzer = TimeTagAnalyzer() if analyze == "YES" else None
+        self.results = None
+        self.csv_file = None
+        self.count = 0 # Rows of results written
+        self.time_tag_count = 0 # Time tags written
+        self.last_time_tag = 0.0
+        self.unflushed = 0 # Time tags written since the last flush
+        self.identity = readout_identity(scope_id, NSegs, NMeas, header, save_format)
+        self.journal_file = None
+        if resume == "YES" and CSV_COMPRESSION != "YES": # A gzip stream cannot be cut off and carried on
+            self.journal_file = open(base_path + "_Readout.journal.new", 'wb')
+            self.journal_file.write(json.dumps(self.identity) + "\n")
+            self.progress_offset = self.journal_file.tell()
+
+        if NMeas > 0 and save_format not in ["CSV", "NUMPY"]:
+            raise ValueError("SAVE_FORMAT must be CSV or NUMPY, not %s." % save_format)
+        resumed = journal is not None and self._resume(journal)
+        if resumed:
+            print "Resuming the readout after segment %d of %d." % (self.time_tag_count, NSegs)
+        elif NMeas > 0 and save_format == "NUMPY":
+            self.results = np.lib.format.open_memmap(base_path + ".npy", mode = 'w+', dtype = np.float64, shape = (NSegs, 2 + NMeas))
+            ## Read the NUMPY BINARY data back into Python with:
+                ## recalled_NPY_data = np.load(base_path + ".npy", mmap_mode = 'r') # mmap_mode = 'r' reads only the parts used
+        elif NMeas > 0 and save_format == "CSV":
+            self.csv_file = open_csv(base_path + "_Measurements.csv")
+            self.csv_file.write(self.header + "\n")
+            ## Read CSV data back into Python with:
+                ## recalled_CSV_data = np.loadtxt(base_path + "_Measurements.csv", delimiter = ',', skiprows = 1)
+        if not resumed:
+            self.time_tag_file = open_csv(base_path + "_TimeTags.csv")
+        if self.journal_file is not None:
+            self._checkpoint()
+            if os.path.exists(base_path + "_Readout.journal"):
+                os.remove(base_path + "_Readout.journal") # os.rename does not replace files on Windows
+            self.journal_file.close()
+            os.rename(base_path + "_Readout.journal.new", base_path + "_Readout.journal")
+            self.journal_file = open(base_path + "_Readout.journal", 'r+b')
+
+    ## Reopen the output files where the journal left them; returns False, with nothing opened, if they do not match it
+    def _resume(self, journal):
+        if any([journal[key] != value for key, value in self.identity.items() if key != "scope"]):
+            return False
+        saved = journal["segments saved"]
+        time_tag_path = self.base_path + "_TimeTags.csv"
+        if not os.path.exists(time_tag_path) or os.path.getsize(time_tag_path) < journal["time tag offset"]:
+            return False
+        if self.identity["measurements"] > 0 and self.identity["save format"] == "NUMPY":
+            if not os.path.exists(self.base_path + ".npy"):
+                return False
+            self.results = np.lib.format.open_memmap(self.base_path + ".npy", mode = 'r+')
+            if self.results.shape != (self.identity["segments"], 2 + self.identity["measurements"]):
+                self.results = None
+                return False
+            self.count = saved
+        elif self.identity["measurements"] > 0:
+            measurement_path = self.base_path + "_Measurements.csv"
+            if not os.path.exists(measurement_path) or os.path.getsize(measurement_path) < journal["measurement offset"]:
+                return False
+            self.csv_file = open(measurement_path, 'r+b')
+            self.csv_file.truncate(journal["measurement offset"])
+            self.csv_file.seek(0, 2)
+            self.count = saved
+        self.time_tag_file = open(time_tag_path, 'r+b')
+        self.time_tag_file.truncate(journal["time tag offset"])
+        self.time_tag_file.seek(0, 2)
+        self.time_tag_count = saved
+        self.last_time_tag = journal["last time tag"]
+        if self.analyzer is not None:
+            self.analyzer.update(self.saved_time_tags())
+        return True
+
+    ## Read back the time tags saved before a resumed readout
+    def saved_time_tags(self):
+        self.time_tag_file.seek(0)
+        TTags = np.fromstring(self.time_tag_file.read(), dtype = np.float64, sep = " ")
+        self.time_tag_file.seek(0, 2)
+        return TTags
+
+    ## Read back the rows of results saved before a resumed readout
+    def saved_results(self):
+        if self.results is not None:
+            return self.results[:self.count]
+        self.csv_file.seek(0)
+        rows = self.csv_file.read().partition("\n")[2].strip().replace("\n", ",")
+        self.csv_file.seek(0, 2)
+        return np.fromstring(rows, dtype = np.float64, sep = ",").reshape(-1, 2 + self.identity["measurements"])
+
+    ## Record the progress in the journal, in place; fixed width, so each record overwrites the last one completely
+    def _checkpoint(self):
+        self.journal_file.seek(self.progress_offset)
+        self.journal_file.write("%015d,%-25r,%020d,%020d\n" % (self.time_tag_count, self.last_time_tag,
+                                                               self.csv_file.tell() if self.csv_file is not None else 0, self.time_tag_file.tell()))
+        self.journal_file.flush()
+
+    ## Append rows of results (index, time tag, measurements); their time tags are appended to the time tag file
+    def append(self, R):
+        if self.results is not None and not np.may_share_memory(R, self.results): # Nothing to copy if R was read straight into the memory map
+            self.results[self.count:self.count + len(R)] = R
+        elif self.csv_file is not None:
+            fast_savetxt(self.csv_file, R)
+        self.count += len(R)
+        self.append_time_tags(R[:,1])
+
+    def append_time_tags(self, TTags):
+        fast_savetxt(self.time_tag_file, TTags)
+        if self.analyzer is not None:
+            self.analyzer.update(TTags)
+        self.time_tag_count += len(TTags)
+        if len(TTags) > 0:
+            self.last_time_tag = float(TTags[-1])
+        self.unflushed += len(TTags)
+        if self.unflushed >= self.flush_segments:
+            self.flush()
+        elif self.journal_file is not None: # Hand the batch to the OS, so it survives this process, then record it
+            for filehandle in [self.csv_file, self.time_tag_file]:
+                if filehandle is not None:
+                    filehandle.flush()
+            self._checkpoint()
+
+    ## Push everything written so far to disk
+    def flush(self):
+        if self.results is not None:
+            self.results.flush()
+        for filehandle in [self.csv_file, self.time_tag_file]:
+            if filehandle is not None:
+                filehandle.flush()
+                os.fsync(filehandle.fileno())
+        if self.journal_file is not None:
+            self._checkpoint()
+            os.fsync(self.journal_file.fileno())
+        self.unflushed = 0
+
+    def close(self):
+        self.flush()
+        if self.csv_file is not None:
+            self.csv_file.close()
+        self.time_tag_file.close()
+        if self.journal_file is not None: # The readout is complete; nothing to resume
+            self.journal_file.close()
+            os.remove(self.base_path + "_Readout.journal")
+        if self.analyzer is not None:
+            self.analyzer.save(self.base_path)
+
+## Define an archive of runs, for ARCHIVE_RUNS = "YES"
+## Each run is a table of columns (index, time tag, then measurements), stored column by column:  uncompressed, one .npy file per column in the
+## run's own directory, memory mapped when read; compressed, one .npz file per run with one member per column and chunk.  The index,
+## Archive_Index.json, lists the runs with their metadata, and the rows, minimum, and maximum of each column of each chunk (null where all are NaN).
+## query() reads only the chunks whose range overlaps the range asked for, then keeps the rows inside it.
+class ResultArchive(object):
+
+    def __init__(self, directory = ARCHIVE_DIRECTORY, chunk_rows = ARCHIVE_CHUNK_ROWS, compression = ARCHIVE_COMPRESSION):
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.index_file = os.path.join(directory, "Archive_Index.json")
+        self.chunks_read = 0 # By the last query
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'rb') as f:
+                self.runs = json.load(f)["runs"]
+        else:
+            self.runs = []
+
+    def _save_index(self):
+        with open(self.index_file + ".new", 'wb') as f:
+            json.dump({"runs": self.runs}, f, indent = 1)
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file) # os.rename does not replace files on Windows
+        os.rename(self.index_file + ".new", self.index_file)
+
+    ## Add a run:  R is a (segments x columns) array, names the name of each column; metadata is kept in the index with the run
+    ## Files of the new run number left over from an add that failed before the index was saved are replaced.
+    ## Returns the run number.
+    def add_run(self, R, names, started = None, **metadata):
+        R = np.asarray(R, dtype = np.float64)
+        if len(names) != R.shape[1]:
+            raise ValueError("Expected %d column names, got %d." % (R.shape[1], len(names)))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        number = max([run["run"] for run in self.runs] + [0]) + 1
+        name = "Run%06d" % number
+        starts = np.arange(0, len(R), self.chunk_rows)
+        if self.compression == "YES":
+            np.savez_compressed(os.path.join(self.directory, name + ".npz"),
+                                **dict([("c%d_%d" % (c, n), R[start:start + self.chunk_rows,c]) for c in range(R.shape[1]) for n, start in enumerate(starts)]))
+        else:
+            if os.path.isdir(os.path.join(self.directory, name)): # Not in the index, so left over
+                shutil.rmtree(os.path.join(self.directory, name))
+            os.mkdir(os.path.join(self.directory, name))
+            for c in range(R.shape[1]):
+                np.save(os.path.join(self.directory, name, "c%d.npy" % c), np.ascontiguousarray(R[:,c]))
+        with np.errstate(invalid = 'ignore'):
+            minima = np.fmin.reduceat(R, starts, axis = 0) if len(R) > 0 else np.empty((0, R.shape[1])) # fmin and fmax skip NaN
+            maxima = np.fmax.reduceat(R, starts, axis = 0) if len(R) > 0 else np.empty((0, R.shape[1]))
+        bound = lambda values: [None if np.isnan(value) else float(value) for value in values]
+        run = {"run": number, "path": name + (".npz" if self.compression == "YES" else ""), "started": started if started is not None else time.time(),
+               "segments": len(R), "columns": list(names),
+               "chunks": [{"rows": [int(start), int(min(start + self.chunk_rows, len(R)))], "min": bound(minima[n]), "max": bound(maxima[n])}
+                          for n, start in enumerate(starts)]}
+        run.update(metadata)
+        self.runs.append(run)
+        self._save_index()
+        return number
+
+    ## Read columns of chunk n of a run, as a (rows x columns) array
+    def _read_chunk(self, run, n, columns):
+        start, stop = run["chunks"][n]["rows"]
+        path = os.path.join(self.directory, run["path"])
+        if run["path"].endswith(".npz"):
+            with np.load(path) as archive: # Decompresses only the members read
+                return np.column_stack([archive["c%d_%d" % (c, n)] for c in columns])
+        return np.column_stack([np.load(os.path.join(path, "c%d.npy" % c), mmap_mode = 'r')[start:stop] for c in columns])
+
+    ## Find the runs started (host clock, time.time()) from since up to until
+    def find_runs(self, since = None, until = None):
+        return [run for run in self.runs if (since is None or run["started"] >= since) and (until is None or run["started"] <= until)]
+
+    ## Find the rows of each run whose column lies from low to high, e.g. a time tag window, or a measurement over a threshold (high = np.inf)
+    ## Returns a list of (run metadata, rows) with the rows as a (rows x columns) array, for the runs with any matching rows; columns is a list of
+    ## column names to return (all, if None).  Runs without the column are skipped.
+    def query(self, column = "Time Tag (s)", low = -np.inf, high = np.inf, columns = None, runs = None):
+        self.chunks_read = 0
+        matches = []
+        for run in (self.runs if runs is None else runs):
+            if column not in run["columns"] or (columns is not None and not set(columns) <= set(run["columns"])):
+                continue
+            c = run["columns"].index(column)
+            wanted = range(len(run["columns"])) if columns is None else [run["columns"].index(name) for name in columns]
+            read = wanted if c in wanted else wanted + [c] # The queried column is last if it was not asked for
+            rows = []
+            for n, chunk in enumerate(run["chunks"]):
+                if chunk["min"][c] is None or chunk["max"][c] < low or chunk["min"][c] > high:
+                    continue
+                block = self._read_chunk(run, n, read)
+                self.chunks_read += 1
+                values = block[:,read.index(c)]
+                rows.append(block[(values >= low) & (values <= high)][:,:len(wanted)])
+            if rows and sum([len(r) for r in rows]) > 0:
+                matches.append((run, np.concatenate(rows)))
+        return matches
+
+## Define a timer for benchmarks and throughput reporting
+## time.clock is the high resolution timer on Windows; time.time is the high resolution timer on unix type machines
+if sys.platform == "win32":
+    timer = time.clock
+else:
+    timer = time.time
+
+## Define a function to empty the scope's error queue without reporting the errors
+def clear_error_queue(scope):
+    while int(scope.query(":SYSTem:ERRor? STRing").split(',')[0]) != 0:
+        pass
+
+## Whether each open scope answers :WAVeform:SEGMented:XLISt?; AUTO readouts on those that do not skip straight to BATCH
+Xlist_Support = {}
+
+## Define a function to find whether a scope answers :WAVeform:SEGMented:XLISt?, as far as is known:  from this session, or else from the scopes
+## listed (by *IDN?) in Xlist_Unsupported.txt in directory by earlier launches.  Only the first call for a scope queries it.
+def xlist_supported(scope, directory = SETUP_CACHE_DIRECTORY):
+    if scope not in Xlist_Support:
+        filename = os.path.join(directory, "Xlist_Unsupported.txt")
+        unsupported = []
+        if os.path.exists(filename):
+            with open(filename, 'r') as f:
+                unsupported = f.read().splitlines()
+        Xlist_Support[scope] = scope.query("*IDN?").strip() not in unsupported
+    return Xlist_Support[scope]
+
+## Define a function to remember that a scope does not answer :WAVeform:SEGMented:XLISt?, for this session and for later launches
+def set_xlist_unsupported(scope, directory = SETUP_CACHE_DIRECTORY):
+    Xlist_Support[scope] = False
+    try:
+        with open(os.path.join(directory, "Xlist_Unsupported.txt"), 'a') as f:
+            f.write(scope.query("*IDN?").strip() + "\n")
+    except IOError as e: # Only later launches lose out
+        print "Could not save the scope's lack of XLIST support: %s" % e
+
+## Define a function to read the time tags of all acquired segments in bulk
+## If a StreamingResultWriter is given, each batch of time tags is saved as soon as it is read; if it resumed a readout, the time tags it already
+## saved are read back from its file, and the scope is read from the next segment on.  xlist_directory holds the list of scopes without XLIST support.
+def read_time_tags(scope, NSegs, method = TTAG_READ_METHOD, batch_size = TTAG_BATCH_SIZE, writer = None, xlist_directory = SETUP_CACHE_DIRECTORY):
+
+    TTags = np.empty(NSegs, dtype = np.float64) # Pre-allocate; replies are parsed straight into this array
+    first = 0
+    if writer is not None and writer.time_tag_count > 0:
+        first = writer.time_tag_count
+        TTags[:first] = writer.saved_time_tags()
+
+    ## Try the all-segments transfer first:  one round trip for all time tags
+    if method == "XLIST" or (method == "AUTO" and xlist_supported(scope, xlist_directory)):
+        try:
+            reply = scope.query(":WAVeform:SEGMented:XLISt? TTAG")
+            values = np.fromstring(reply.strip(), dtype = np.float64, sep = ',')
+        except Exception: # Most likely a timeout; older firmware does not answer :WAVeform:SEGMented:XLISt?
+            scope.clear()
+            values = np.empty(0)
+            set_xlist_unsupported(scope, xlist_directory)
+        if len(values) == NSegs:
+            TTags[first:] = values[first:]
+            if writer is not None:
+                writer.append_time_tags(TTags[first:])
+            return TTags
+        if method == "XLIST":
+            raise ValueError("Expected %d time tags from :WAVeform:SEGMented:XLISt?, got %d." % (NSegs, len(values)))
+        clear_error_queue(scope) # Discard the "Undefined header" error before falling back to BATCH
+
+    elif method not in ("AUTO", "BATCH"):
+        raise ValueError("TTAG_READ_METHOD must be AUTO, XLIST, or BATCH, not %s." % method)
+
+    ## Pack batch_size index/time tag query pairs into each message; the replies come back as one ; separated list
+    for start in xrange(first, NSegs, batch_size):
+        stop = min(start + batch_size, NSegs)
+        message = ";".join([":ACQuire:SEGMented:INDex %d;:WAVeform:SEGMented:TTAG?" % (n + 1) for n in xrange(start, stop)])
+            ## Note the index of the first segment is 1, not 0
+        values = np.fromstring(scope.query(message).strip(), dtype = np.float64, sep = ';')
+        if len(values) != stop - start:
+            raise ValueError("Expected %d time tags for segments %d to %d, got %d." % (stop - start, start + 1, stop, len(values)))
+        TTags[start:stop] = values
+        if writer is not None:
+            writer.append_time_tags(values)
+
+    return TTags
+
+## Define a function to turn a measurement command such as ":MEASure:VPP CHANnel1" into its query form, ":MEASure:VPP? CHANnel1"
+def measurement_query(command):
+    header, _, args = command.strip().partition(" ")
+    return (header + "? " + args).strip()
+
+## Define a function to switch :MEASure:RESults? to its values-only form and count the measurements enabled on the scope
+## With statistics on, the scope answers a label (e.g. "V p-p(1)") and six values per measurement; with :MEASure:STATistics CURRent it answers
+## just the current value of each, which parses straight into the results array
+def scope_measurement_results(scope):
+    scope.write(":MEASure:SENDvalid OFF;STATistics CURRent")
+    return len([field for field in scope.query(":MEASure:RESults?").strip().split(',') if field.strip()])
+
+## Define a function to capture the time tag and measurement results of every segment
+## Each segment becomes one group of queries (index, time tag, measurements), and batch_size groups are concatenated into each SCPI message,
+## so the number of round trips is NSegs/batch_size rather than NSegs*NMeas.
+## MEAS_METHOD = "SCRIPT" uses MEASURE_LIST; MEAS_METHOD = "SCOPE" uses one :MEASure:RESults? per segment, in its values-only form (see scope_measurement_results).
+## If a StreamingResultWriter is given, each batch is saved as soon as it is read; with SAVE_FORMAT = "NUMPY" the replies are parsed straight into its memory map.
+## If it resumed a readout, the rows it already saved are read back, and the scope is read from the next segment on.
+def capture_measurements(scope, NSegs, NMeas, method = MEAS_METHOD, measure_list = MEASURE_LIST, batch_size = MEAS_BATCH_SIZE, writer = None):
+
+    if method == "SCRIPT":
+        segment_queries = ";".join([measurement_query(m) for m in measure_list])
+    elif method == "SCOPE":
+        scope.write(":MEASure:SENDvalid OFF;STATistics CURRent")
+        segment_queries = ":MEASure:RESults?"
+    else:
+        raise ValueError("MEAS_METHOD must be SCRIPT or SCOPE, not %s." % method)
+    values_per_segment = 1 + NMeas # Time tag, then one value per measurement
+
+    if writer is not None and writer.results is not None:
+        R = writer.results
+    else:
+        R = np.empty((NSegs, 2 + NMeas), dtype = np.float64) # Pre-allocate; replies are parsed straight into this array
+    first = writer.count if writer is not None else 0
+    if first > 0 and R is not writer.results: # Rows in the memory map are already in place
+        R[:first] = writer.saved_results()
+
+    for start in xrange(first, NSegs, batch_size):
+        stop = min(start + batch_size, NSegs)
+        message = ";".join([":ACQuire:SEGMented:INDex %d;:WAVeform:SEGMented:TTAG?;%s" % (n + 1, segment_queries) for n in xrange(start, stop)])
+        reply = scope.query(message).strip().replace(";", ",") # Query replies are ; separated; :MEASure:RESults? fields are , separated
+        values = np.fromstring(reply, dtype = np.float64, sep = ',')
+        if len(values) != (stop - start) * values_per_segment:
+            raise ValueError("Expected %d values for segments %d to %d, got %d." % ((stop - start) * values_per_segment, start + 1, stop, len(values)))
+        values = values.reshape(stop - start, values_per_segment)
+        R[start:stop,0] = np.arange(start + 1, stop + 1)
+        R[start:stop,1:] = values
+        if writer is not None:
+            writer.append(R[start:stop])
+
+    return R
+
+## Define a function to view the payload of an IEEE 488.2 definite length block (#<n><length><data>) as a NumPy array without copying it
+def block_view(raw, dtype):
+    if raw[0:1] != b"#":
+        raise ValueError("Reply is not an IEEE 488.2 binary block.")
+    ndigits = int(raw[1:2])
+    if ndigits == 0: # Indefinite length block; the data runs to the terminating newline
+        offset, length = 2, len(raw) - 3
+    else:
+        offset, length = 2 + ndigits, int(raw[2:2 + ndigits])
+    dtype = np.dtype(dtype)
+    return np.frombuffer(raw, dtype = dtype, count = length // dtype.itemsize, offset = offset)
+
+## Define a function to download every segment of each channel in one transfer per channel
+## Returns a (channels x segments x points) array of raw codes, and a (channels x 5) array of scaling:  channel, Y increment, Y origin, X increment, X origin
+## Voltage = code * Y increment + Y origin; the time of point i is i * X increment + X origin
+## In ASCII format the scope sends voltages, so the array is float64 volts and the Y increment and Y origin are 1 and 0
+def download_waveforms(scope, NSegs, channels = ENABLED_CHANNELS, waveform_format = WAVEFORM_FORMAT):
+
+    if waveform_format == "WORD":
+        scope.write(":WAVeform:FORMat WORD;BYTeorder LSBFirst")
+        dtype = np.dtype("<i2")
+    elif waveform_format == "BYTE":
+        scope.write(":WAVeform:FORMat BYTE")
+        dtype = np.dtype("i1")
+    elif waveform_format == "ASCII":
+        scope.write(":WAVeform:FORMat ASCii")
+        dtype = np.dtype(np.float64)
+    else:
+        raise ValueError("WAVEFORM_FORMAT must be WORD, BYTE, or ASCII, not %s." % waveform_format)
+    scope.write(":WAVeform:SEGMented:ALL ON;:WAVeform:STReaming OFF") # All segments in one :WAVeform:DATA? reply, with a definite length block header
+
+    W = None
+    scaling = np.empty((len(channels), 5), dtype = np.float64)
+    for i, channel in enumerate(channels):
+        scope.write(":WAVeform:SOURce CHANnel%d" % channel)
+        preamble = scope.query(":WAVeform:PREamble?").split(",")
+        if waveform_format == "ASCII":
+            values = np.fromstring(scope.query(":WAVeform:DATA?").strip(), dtype = dtype, sep = ",")
+            scaling[i] = [channel, 1.0, 0.0, float(preamble[4]), float(preamble[5])]
+        else:
+            scope.write(":WAVeform:DATA?")
+            values = block_view(scope.read_raw(), dtype) # A view of the received buffer; no copy yet
+            scaling[i] = [channel, float(preamble[7]), float(preamble[8]), float(preamble[4]), float(preamble[5])]
+        if W is None: # Pre-allocate once the number of points per segment is known
+            W = np.empty((len(channels), NSegs, len(values) // NSegs), dtype = dtype)
+        if len(values) != W.shape[1] * W.shape[2]:
+            raise ValueError("Expected %d points from channel %d, got %d." % (W.shape[1] * W.shape[2], channel, len(values)))
+        W[i] = values.reshape(NSegs, -1) # The only copy:  from the receive buffer into the output array
+
+    scope.write(":WAVeform:SEGMented:ALL OFF")
+    return W, scaling
+
+## Define host-side measurement functions
+## Each works on a 2-D (segments x points) array of volts and returns one result per segment, without a Python loop over segments.
+## Segments without a valid result return NaN.
+
+## Peak-peak voltage
+def host_vpp(V):
+    return V.max(axis = 1) - V.min(axis = 1)
+
+## Time (in samples, interpolated) at which each segment crosses level between sample i and i + 1
+def interpolate_crossing(V, i, level):
+    rows = np.arange(V.shape[0])
+    i = np.clip(i, 0, V.shape[1] - 2)
+    v0 = V[rows,i]
+    v1 = V[rows,i + 1]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return i + (level - v0) / (v1 - v0)
+
+## Top and base levels of each segment, found as the scope finds them:  the most common voltage in the upper and in the lower half of the
+## segment's range, from a histogram of its samples.  Each level is the mean of the samples in its histogram bin and the bins on either side,
+## so noise peaks do not pull it the way they pull the maximum and minimum.  A half with no samples falls back to the maximum or minimum.
+def host_top_base(V, bins = 64):
+    NSegs = V.shape[0]
+    minimum = V.min(axis = 1)
+    maximum = V.max(axis = 1)
+    span = np.where(maximum > minimum, maximum - minimum, 1.0)
+    index = np.clip(((V - minimum[:,np.newaxis]) * (bins / span)[:,np.newaxis]).astype(np.int64), 0, bins - 1)
+    keys = (index + (np.arange(NSegs) * bins)[:,np.newaxis]).ravel()
+    counts = np.bincount(keys, minlength = NSegs * bins).reshape(NSegs, bins)
+    sums = np.bincount(keys, weights = V.ravel(), minlength = NSegs * bins).reshape(NSegs, bins)
+    def window(histogram): # Each bin plus the bins on either side
+        summed = histogram.copy()
+        summed[:,1:] += histogram[:,:-1]
+        summed[:,:-1] += histogram[:,1:]
+        return summed
+    counts = window(counts)
+    sums = window(sums)
+    rows = np.arange(NSegs)
+    upper = bins // 2 + np.argmax(counts[:,bins // 2:], axis = 1)
+    lower = np.argmax(counts[:,:bins // 2], axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        top = np.where(counts[rows,upper] > 0, sums[rows,upper] / counts[rows,upper], maximum)
+        base = np.where(counts[rows,lower] > 0, sums[rows,lower] / counts[rows,lower], minimum)
+    return top, base
+
+## 10-90% rise time of the first rising edge:  from the last 10% crossing before the first 90% crossing, between the top and base levels
+def host_rise_time(V, x_increment):
+    top, base = host_top_base(V)
+    low = (base + 0.1 * (top - base))[:,np.newaxis]
+    high = (base + 0.9 * (top - base))[:,np.newaxis]
+    above_high = V >= high
+    i90 = np.argmax(above_high, axis = 1) # First sample at or above 90%
+    below_low = (V < low) & (np.arange(V.shape[1])[np.newaxis,:] < i90[:,np.newaxis])
+    i10 = V.shape[1] - 1 - np.argmax(below_low[:,::-1], axis = 1) # Last sample below 10% before that
+    valid = above_high.any(axis = 1) & below_low.any(axis = 1)
+    t10 = interpolate_crossing(V, i10, low[:,0])
+    t90 = interpolate_crossing(V, i90 - 1, high[:,0])
+    return np.where(valid, (t90 - t10) * x_increment, np.nan)
+
+## Time of the nth crossing of level with the given slope (+1 rising, -1 falling), as in :MEASure:TVOLt <level>,<slope><occurrence>,<source>
+def host_threshold_crossing(V, level, slope, occurrence, x_increment, x_origin):
+    if slope > 0:
+        crossings = (V[:,:-1] < level) & (V[:,1:] >= level)
+    else:
+        crossings = (V[:,:-1] > level) & (V[:,1:] <= level)
+    count = np.cumsum(crossings, axis = 1)
+    i = np.argmax(count >= occurrence, axis = 1)
+    valid = count[:,-1] >= occurrence
+    return np.where(valid, interpolate_crossing(V, i, level) * x_increment + x_origin, np.nan)
+
+## Define a function to compute the MEASURE_LIST measurements of every segment on the host
+## W and scaling are as returned by download_waveforms (W may be a memory mapped array); segments are converted to volts and measured chunk_segments at a time
+def compute_host_measurements(W, scaling, measure_list = MEASURE_LIST, chunk_segments = HOST_CHUNK_SEGMENTS):
+
+    ## Parse each measurement into (function name, channel row in W, arguments)
+    rows = dict((int(channel), row) for row, channel in enumerate(scaling[:,0]))
+    parsed = []
+    for command in measure_list:
+        header, _, args = command.strip().partition(" ")
+        name = scpi_short_form(header.strip(":").split(":")[-1])
+        args = [a.strip() for a in args.split(",")]
+        channel = int(args[-1][-1])
+        if channel not in rows:
+            raise ValueError("%s needs channel %d, which was not downloaded." % (command, channel))
+        if name not in ("VPP", "RIS", "TVOL"):
+            raise ValueError("%s is not supported by the host-side measurements." % command)
+        parsed.append((name, rows[channel], args))
+
+    NSegs = W.shape[1]
+    M = np.empty((NSegs, len(parsed)), dtype = np.float64)
+    for start in xrange(0, NSegs, chunk_segments):
+        stop = min(start + chunk_segments, NSegs)
+        volts = {} # Convert each channel once per chunk
+        for n, (name, row, args) in enumerate(parsed):
+            if row not in volts:
+                volts[row] = W[row, start:stop].astype(np.float64) * scaling[row,1] + scaling[row,2]
+            V = volts[row]
+            if name == "VPP":
+                M[start:stop,n] = host_vpp(V)
+            elif name == "RIS":
+                M[start:stop,n] = host_rise_time(V, scaling[row,3])
+            else:
+                slope = -1 if args[1].startswith("-") else 1
+                M[start:stop,n] = host_threshold_crossing(V, float(args[0]), slope, abs(int(args[1])), scaling[row,3], scaling[row,4])
+    return M
+
+## Define a function to compute the statistics of each column of X in one vectorized pass
+## Returns a dict with an array of one value per column for count, mean, std, min, max, and range, and percentiles, a dict of such arrays by percentile.
+## NaNs (invalid results) are left out column by column:  count is the number of valid results, and a column without any has NaN statistics.
+def compute_statistics(X, percentiles = STATISTICS_PERCENTILES):
+    X = np.asarray(X, dtype = np.float64)
+    if X.ndim == 1:
+        X = X.reshape(-1, 1)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # Raised for columns without valid results
+        minimum = np.nanmin(X, axis = 0)
+        maximum = np.nanmax(X, axis = 0)
+        return {"count": np.count_nonzero(~np.isnan(X), axis = 0), "mean": np.nanmean(X, axis = 0), "std": np.nanstd(X, axis = 0), "min": minimum, "max": maximum,
+                "range": maximum - minimum, "percentiles": dict(zip(percentiles, np.nanpercentile(X, percentiles, axis = 0)))}
+
+## Define a mergeable quantile sketch, after DDSketch
+## Values are counted in logarithmic buckets (kept apart for negative values and zero), so that any quantile comes back within relative_accuracy of a true
+## value.  Sketches of different batches or runs merge exactly by adding their counts.  Memory is bounded:  values of magnitude below min_magnitude
+## count as zero, and once a sign has more than max_buckets buckets, its lowest (nearest zero) are merged into the lowest one kept, so only quantiles
+## of the largest magnitudes keep the full accuracy.  NaNs (invalid results) are left out; a sketch of none but NaNs has NaN quantiles.
+class QuantileSketch(object):
+
+    def __init__(self, relative_accuracy = SKETCH_RELATIVE_ACCURACY, max_buckets = SKETCH_MAX_BUCKETS, min_magnitude = SKETCH_MIN_MAGNITUDE):
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.max_buckets = max_buckets
+        self.min_magnitude = min_magnitude
+        empty = (np.empty(0, dtype = np.int64), np.empty(0, dtype = np.int64))
+        self.positive = empty # Sorted bucket keys, and their counts; bucket k counts values in (gamma**(k-1), gamma**k]
+        self.negative = empty # Same, for the magnitude of negative values
+        self.zero = 0
+        self.count = 0
+
+    ## Bucket keys of some magnitudes, and how many fall in each; infinities go to the bucket of the largest float
+    def _keys(self, magnitudes):
+        return np.unique(np.ceil(np.log(np.minimum(magnitudes, np.finfo(np.float64).max)) / self.log_gamma).astype(np.int64), return_counts = True)
+
+    ## Add counts to the buckets of one sign, then merge its lowest buckets if there are too many
+    def _insert(self, buckets, keys, counts):
+        if len(keys) == 0:
+            return buckets
+        keys, index = np.unique(np.concatenate((buckets[0], keys)), return_inverse = True)
+        counts = np.bincount(index, weights = np.concatenate((buckets[1], counts))).astype(np.int64)
+        excess = len(keys) - self.max_buckets
+        if excess > 0:
+            counts[excess] += counts[:excess].sum()
+            keys, counts = keys[excess:], counts[excess:]
+        return keys, counts
+
+    def add(self, values):
+        values = np.asarray(values, dtype = np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        small = np.abs(values) < self.min_magnitude
+        self.zero += np.count_nonzero(small)
+        self.positive = self._insert(self.positive, *self._keys(values[(values > 0) & ~small]))
+        self.negative = self._insert(self.negative, *self._keys(-values[(values < 0) & ~small]))
+
+    def merge(self, other):
+        self.positive = self._insert(self.positive, *other.positive)
+        self.negative = self._insert(self.negative, *other.negative)
+        self.zero += other.zero
+        self.count += other.count
+
+    def quantile(self, q):
+        if self.count == 0:
+            return np.nan
+        rank = q * (self.count - 1)
+        keys, counts = self.negative[0][::-1], self.negative[1][::-1] # Most negative first
+        seen = np.cumsum(counts)
+        if len(seen) > 0 and seen[-1] > rank:
+            return -self._value(keys[np.searchsorted(seen, rank, side = 'right')])
+        passed = (seen[-1] if len(seen) > 0 else 0) + self.zero
+        if passed > rank or len(self.positive[0]) == 0:
+            return 0.0
+        keys, counts = self.positive
+        return self._value(keys[min(np.searchsorted(passed + np.cumsum(counts), rank, side = 'right'), len(keys) - 1)])
+
+    ## Magnitude that bucket key stands for (infinity for the bucket of the largest float)
+    def _value(self, key):
+        with np.errstate(over = 'ignore'):
+            return float(2.0 * np.power(self.gamma, float(key)) / (self.gamma + 1.0))
+
+## Define streaming statistics of each column, updated batch by batch or run by run without keeping the results
+## Mean and variance are combined with the parallel form of Welford's algorithm, which stays accurate where sums of squares would lose precision;
+## percentiles come from a QuantileSketch per column.  summary() returns the same dict as compute_statistics.
+## As there, NaNs are left out column by column; counts holds the valid results of each column, and count the rows seen.
+class RunningStatistics(object):
+
+    def __init__(self, ncolumns, relative_accuracy = SKETCH_RELATIVE_ACCURACY):
+        self.count = 0
+        self.counts = np.zeros(ncolumns, dtype = np.int64)
+        self.mean = np.zeros(ncolumns)
+        self.m2 = np.zeros(ncolumns) # Sum of squared differences from the mean
+        self.min = np.full(ncolumns, np.inf)
+        self.max = np.full(ncolumns, -np.inf)
+        self.sketches = [QuantileSketch(relative_accuracy) for n in xrange(ncolumns)]
+
+    def _combine(self, rows, counts, mean, m2, minimum, maximum):
+        total = self.counts + counts
+        weight = counts / np.maximum(total, 1).astype(np.float64) # 0 where neither side has valid results
+        delta = mean - self.mean
+        self.mean = self.mean + delta * weight
+        self.m2 = self.m2 + m2 + delta ** 2 * self.counts * weight
+        self.count += rows
+        self.counts = total
+        self.min = np.fmin(self.min, minimum) # fmin and fmax skip NaN
+        self.max = np.fmax(self.max, maximum)
+
+    def update(self, X):
+        X = np.asarray(X, dtype = np.float64)
+        if X.ndim == 1:
+            X = X.reshape(-1, 1)
+        if len(X) == 0:
+            return
+        valid = ~np.isnan(X)
+        counts = valid.sum(axis = 0)
+        mean = np.where(valid, X, 0.0).sum(axis = 0) / np.maximum(counts, 1) # 0 for a column without valid results; it has no weight
+        m2 = np.where(valid, (X - mean) ** 2, 0.0).sum(axis = 0)
+        self._combine(len(X), counts, mean, m2, np.fmin.reduce(X, axis = 0), np.fmax.reduce(X, axis = 0))
+        for sketch, column in zip(self.sketches, X.T):
+            sketch.add(column)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        self._combine(other.count, other.counts, other.mean, other.m2, other.min, other.max)
+        for sketch, others in zip(self.sketches, other.sketches):
+            sketch.merge(others)
+
+    def summary(self, percentiles = STATISTICS_PERCENTILES):
+        valid = self.counts > 0
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            std = np.sqrt(self.m2 / self.counts)
+        return {"count": self.counts.copy(), "mean": np.where(valid, self.mean, np.nan), "std": np.where(valid, std, np.nan),
+                "min": np.where(valid, self.min, np.nan), "max": np.where(valid, self.max, np.nan), "range": np.where(valid, self.max - self.min, np.nan),
+                "percentiles": dict([(p, np.array([sketch.quantile(p / 100.0) for sketch in self.sketches])) for p in percentiles])}
+
+## Define a function to print the statistics of column n, from compute_statistics or RunningStatistics.summary
+def print_statistics(name, stats, n = 0):
+    print "Statistics for " + name + ":"
+    print "\tAverage:             " , stats["mean"][n]
+    print "\tStandard deviation:  " , stats["std"][n]
+    print "\tMinimum:             " , stats["min"][n]
+    print "\tMaximum:             " , stats["max"][n]
+    print "\tRange:               " , stats["range"][n]
+    for p in sorted(stats["percentiles"]):
+        print "\t%-21s" % ("%g percentile:" % p), stats["percentiles"][p][n]
+    print ""
+
+## Define an analyzer of trigger time tags, fed chunk by chunk, for ANALYZE_TIME_TAGS = "YES"
+## Each chunk is handled in a few vectorized passes, and only running sums are kept between chunks, so tens of millions of tags take no more memory
+## than one chunk.  The trigger period is first estimated as the median interval of the first chunk; each interval then counts as the nearest whole
+## number of periods (at least one), so that missed triggers leave a gap in the trigger numbers rather than throwing the fit off.  Tag time is fitted
+## against trigger number by least squares, from co-moments combined chunk by chunk as in RunningStatistics; times are taken relative to the estimated
+## period's grid, so that the small residuals (the jitter) do not cancel out against the large span of the times.
+class TimeTagAnalyzer(object):
+
+    def __init__(self, rate_window = TIME_TAG_RATE_WINDOW, gap_threshold = TIME_TAG_GAP_THRESHOLD, max_gaps = 1000):
+        self.rate_window = rate_window
+        self.gap_threshold = gap_threshold
+        self.max_gaps = max_gaps
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.period = None # Estimated period, from the first chunk
+        self.number = 0 # Trigger number of the last tag
+        self.intervals = RunningStatistics(1)
+        self.fit = [0, 0.0, 0.0, 0.0, 0.0, 0.0] # Count, mean trigger number, mean time, and the co-moments xx, xy, yy
+        self.missed = 0
+        self.gap_time = 0.0
+        self.gaps = [] # (index of the tag after the gap, its time, gap length, triggers missed), up to max_gaps of them
+        self.gap_count = 0
+        self.short = 0
+        self.window = None # Window number being counted, and its count so far
+        self.window_count = 0
+        self.windows = [0, np.inf, 0.0, 0] # Complete windows:  count, fewest and most tags in one, total tags
+
+    def _fit(self, x, y):
+        count, mean_x, mean_y, xx, xy, yy = self.fit
+        n = len(x)
+        chunk_x, chunk_y = x.mean(), y.mean()
+        dx, dy = x - chunk_x, y - chunk_y
+        total = count + n
+        delta_x, delta_y = chunk_x - mean_x, chunk_y - mean_y
+        weight = float(count) * n / total
+        self.fit = [total, mean_x + delta_x * n / total, mean_y + delta_y * n / total,
+                    xx + np.dot(dx, dx) + delta_x * delta_x * weight, xy + np.dot(dx, dy) + delta_x * delta_y * weight, yy + np.dot(dy, dy) + delta_y * delta_y * weight]
+
+    def _count_windows(self, TTags):
+        ids = np.floor((TTags - self.first) / (self.rate_window * self.period)).astype(np.int64)
+        counts = np.bincount(ids - ids[0])
+        if self.window is not None and ids[0] == self.window:
+            counts[0] += self.window_count
+        elif self.window is not None: # The window carried over is complete, and any between it and this chunk were empty
+            counts = np.concatenate(([self.window_count], np.zeros(max(0, ids[0] - self.window - 1), dtype = np.int64), counts))
+        complete = counts[:-1]
+        if len(complete):
+            self.windows = [self.windows[0] + len(complete), min(self.windows[1], complete.min()), max(self.windows[2], complete.max()), self.windows[3] + complete.sum()]
+        self.window, self.window_count = ids[-1], counts[-1]
+
+    def update(self, TTags):
+        TTags = np.asarray(TTags, dtype = np.float64).ravel()
+        if len(TTags) == 0:
+            return
+        if self.first is None:
+            self.first = TTags[0]
+            if len(TTags) > 1:
+                self.period = np.median(np.diff(TTags))
+            self.last = TTags[0]
+            self.count = 1
+            self._fit(np.zeros(1), np.zeros(1))
+            TTags = TTags[1:]
+            if len(TTags) == 0:
+                return
+        if self.period is None: # The first chunk held a single tag
+            self.period = TTags[0] - self.last
+        dt = np.diff(np.concatenate(([self.last], TTags)))
+        self.intervals.update(dt)
+        steps = np.maximum(1, np.rint(dt / self.period)).astype(np.int64)
+        numbers = self.number + np.cumsum(steps)
+        self._fit(numbers.astype(np.float64), (TTags - self.first) - self.period * numbers)
+
+        gaps = np.flatnonzero(dt > self.gap_threshold * self.period)
+        self.gap_count += len(gaps)
+        self.missed += int((steps[gaps] - 1).sum())
+        self.gap_time += dt[gaps].sum()
+        for i in gaps[:max(0, self.max_gaps - len(self.gaps))]:
+            self.gaps.append((self.count + i + 1, TTags[i], dt[i], steps[i] - 1)) # Index counts from 1, like the segments
+        self.short += np.count_nonzero(dt < self.period / self.gap_threshold)
+        self._count_windows(TTags)
+
+        self.count += len(TTags)
+        self.number = numbers[-1]
+        self.last = TTags[-1]
+
+    ## Returns the results as a list of (quantity, value, unit)
+    def summary(self):
+        count, mean_x, mean_y, xx, xy, yy = self.fit
+        rows = [("Time tags", self.count, ""), ("First time tag", self.first, "s"), ("Last time tag", self.last, "s")]
+        if self.count < 2:
+            return rows
+        slope = xy / xx if xx > 0 else 0.0 # Correction to the estimated period
+        fitted_period = self.period + slope
+        jitter = np.sqrt(max(0.0, yy - xy * slope) / count) # RMS of the residuals of the fit
+        intervals = self.intervals.summary()
+        windows, fewest, most, tags = self.windows
+        window_time = self.rate_window * self.period
+        rows += [("Span", self.last - self.first, "s"),
+                 ("Mean trigger rate", (self.count - 1) / (self.last - self.first), "Hz"),
+                 ("Lowest instantaneous trigger rate", 1.0 / intervals["max"][0], "Hz"),
+                 ("Highest instantaneous trigger rate", 1.0 / intervals["min"][0], "Hz"),
+                 ("Rate window", window_time, "s"),
+                 ("Complete rate windows", windows, ""),
+                 ("Lowest windowed trigger rate", fewest / window_time if windows else np.nan, "Hz"),
+                 ("Mean windowed trigger rate", tags / (windows * window_time) if windows else np.nan, "Hz"),
+                 ("Highest windowed trigger rate", most / window_time if windows else np.nan, "Hz"),
+                 ("Mean interval", intervals["mean"][0], "s"),
+                 ("Interval standard deviation", intervals["std"][0], "s")]
+        rows += [("Interval %g percentile" % p, intervals["percentiles"][p][0], "s") for p in sorted(intervals["percentiles"])]
+        rows += [("Fitted trigger period", fitted_period, "s"),
+                 ("Fitted trigger rate", 1.0 / fitted_period, "Hz"),
+                 ("RMS jitter against fitted period", jitter, "s"),
+                 ("Dead time (shortest interval)", intervals["min"][0], "s"),
+                 ("Gaps (intervals over %g periods)" % self.gap_threshold, self.gap_count, ""),
+                 ("Missed triggers (estimated)", self.missed, ""),
+                 ("Time in gaps", self.gap_time, "s"),
+                 ("Longest interval", intervals["max"][0], "s"),
+                 ("Short intervals (under 1/%g period)" % self.gap_threshold, self.short, "")]
+        return rows
+
+    ## Save the summary to base_path + "_TimeTagSummary.csv", and any gaps to base_path + "_TimeTagGaps.csv"
+    def save(self, base_path):
+        with open(base_path + "_TimeTagSummary.csv", 'w') as f:
+            f.write("Quantity,Value,Unit\n")
+            for quantity, value, unit in self.summary():
+                f.write("%s,%s,%s\n" % (quantity, repr(value) if isinstance(value, float) else value, unit))
+        if self.gaps:
+            with open(base_path + "_TimeTagGaps.csv", 'w') as f:
+                f.write("Index,Time Tag (s),Gap (s),Missed triggers\n")
+                f.writelines(["%d,%.12e,%.12e,%d\n" % gap for gap in self.gaps])
+
+## Define a function to analyze a saved _TimeTags.csv file of any size, chunk_rows lines at a time
+def analyze_time_tag_file(filename, chunk_rows = 100000):
+    analyzer = TimeTagAnalyzer()
+    with (gzip.open(filename, 'rb') if filename.endswith(".gz") else open(filename, 'rb')) as f:
+        while True:
+            lines = f.readlines(chunk_rows * 24) # Size hint, in bytes; about chunk_rows lines of time tags
+            if not lines:
+                break
+            analyzer.update(np.fromstring("".join(lines), sep = " "))
+    return analyzer
+
+## Define a function to decimate a scatter plot to the lowest and highest y of each of width columns of x, which must be in ascending order
+## Every extreme still shows, but there are at most 2 * width points to draw, however many there were.
+## NaNs (invalid results) are skipped, so a column only goes blank when none of its results are valid.
+def decimate_min_max(x, y, width = REPORT_PLOT_WIDTH):
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    if len(x) <= 2 * width:
+        return x, y
+    starts = np.unique(np.searchsorted(x, np.linspace(x[0], x[-1], width + 1)[:-1])) # First point of each column that has any
+    ends = np.append(starts[1:], len(x)) - 1
+    centers = (x[starts] + x[ends]) / 2.0
+    return np.repeat(centers, 2), np.column_stack((np.fmin.reduceat(y, starts), np.fmax.reduceat(y, starts))).ravel()
+
+## Define functions to describe the report plots, already reduced to what will be drawn, for render_report
+def scatter_plot(title, x, y, xlabel, ylabel, ylim = None):
+    x, y_drawn = decimate_min_max(x, y)
+    return {"kind": "scatter", "title": title, "x": x, "y": y_drawn, "xlabel": xlabel, "ylabel": ylabel, "ylim": ylim, "points": len(y)}
+
+def histogram_plot(title, values, xlabel, bins = REPORT_HISTOGRAM_BINS):
+    counts, edges = np.histogram(values, bins)
+    return {"kind": "histogram", "title": title, "counts": counts, "edges": edges, "xlabel": xlabel, "ylabel": "Hits", "points": len(values)}
+
+## Define a function to describe the report plots of one run:  with REPORT_MEASUREMENT_STATISTICS, each measurement against trigger time and
+## its histogram; with REPORT_THROUGHPUT_STATISTICS, the trigger times, their differences, and a histogram of the differences
+## R is None if only time tags were logged; names are the measurement names.
+def run_report_plots(R, TTags, names):
+    plots = []
+    if REPORT_MEASUREMENT_STATISTICS == "YES" and R is not None:
+        for n in xrange(R.shape[1] - 2):
+            name = names[n]
+            Ymax = np.nanmax(R[:,n+2])
+            if Ymax > 0:
+                Ymax = Ymax*1.1
+            elif Ymax < 0:
+                Ymax = Ymax*0.9
+            elif Ymax == 0:
+                Ymax = 0.1
+
+            Ymin = np.nanmin(R[:,n+2])
+            if Ymin > 0:
+                Ymin = Ymin*0.9
+            elif Ymin < 0:
+                Ymin = Ymin*1.1
+            elif Ymin == 0:
+                Ymin = -0.1
+
+            ylim = (Ymin, Ymax) if np.isfinite(Ymin) and np.isfinite(Ymax) else None # All invalid: let the plot choose
+            plots.append(scatter_plot(name + " vs. apparent trigger time", TTags, R[:,n+2], "Apparent Trigger Time (s)", name, ylim))
+            plots.append(histogram_plot("Histogram of " + name, R[np.isfinite(R[:,n+2]),n+2], name))
+    if REPORT_THROUGHPUT_STATISTICS == "YES" and len(TTags) > 1:
+        DELTA_TIMES = np.diff(TTags)
+        plots.append(scatter_plot("Apparent trigger times", np.arange(1, len(TTags) + 1), TTags, "Acquisition Number", "Apparent Trigger Time (s)"))
+        plots.append(scatter_plot("Trigger time differences", np.arange(1, len(DELTA_TIMES) + 1), DELTA_TIMES, "Acquisition Number-1", "Delta Trigger Times (s)"))
+        plots.append(histogram_plot("Histogram of trigger time differences", DELTA_TIMES, "Trigger Time Differences (s)"))
+    return plots
+
+## Define a function to draw the report plots
+## With show = True they are shown on screen one at a time; otherwise they are saved, with no display, as base_path + "_Report_<n>.png" files
+## and an HTML page, base_path + "_Report.html", showing them all.
+def render_report(plots, base_path, show = False):
+    import matplotlib
+    if not show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    html = ["<html><head><title>%s</title></head><body><h1>%s</h1>" % (os.path.basename(base_path), os.path.basename(base_path))]
+    for n, plot in enumerate(plots):
+        figure = plt.figure(figsize = (REPORT_PLOT_WIDTH / 100.0, REPORT_PLOT_WIDTH / 200.0), dpi = 100)
+        axes = figure.add_subplot(111)
+        if plot["kind"] == "scatter":
+            axes.plot(plot["x"], plot["y"], 'r+')
+            if plot["ylim"] is not None:
+                axes.set_ylim(*plot["ylim"])
+        else:
+            axes.bar(plot["edges"][:-1], plot["counts"], width = np.diff(plot["edges"]), align = 'edge')
+        axes.set_title("%s (%d segments)" % (plot["title"], plot["points"]))
+        axes.set_xlabel(plot["xlabel"])
+        axes.set_ylabel(plot["ylabel"])
+        if show:
+            plt.show()
+        else:
+            filename = base_path + "_Report_%02d.png" % (n + 1)
+            figure.savefig(filename)
+            html.append("<h2>%s</h2><img src=\"%s\">" % (plot["title"], os.path.basename(filename)))
+        plt.close(figure)
+    if not show:
+        html.append("</body></html>")
+        with open(base_path + "_Report.html", 'w') as f:
+            f.write("\n".join(html) + "\n")
+
+## Define a function to draw the report plots in a background process, so the script can finish without waiting for them
+## The plots are handed over in a file; the process is this script, started with --render-report, which stops before the main code.  The file also
+## holds the value of every constant render_report reads, as set here by --config or --set, which the process does not get.  Its error output goes
+## to base_path + "_Report.log", which is empty if the plots were drawn.
+def start_report_process(plots, base_path):
+    import subprocess
+    plots_file = base_path + "_Report.pickle"
+    settings = dict([(name, globals()[name]) for name in render_report.__code__.co_names if name.isupper() and name in globals()])
+    with open(plots_file, 'wb') as f:
+        pickle.dump((plots, base_path, settings), f, 2)
+    with open(os.devnull, 'w') as devnull:
+        with open(base_path + "_Report.log", 'w') as log:
+            return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--render-report", plots_file], stdout = devnull, stderr = log)
+
+## Define a function to draw report plots according to REPORT_PLOTS:  in a background process (FILES) or on screen (SCREEN)
+## Returns the background process, or None.
+def draw_report(plots, base_path, method = REPORT_PLOTS):
+    if plots and method == "FILES":
+        process = start_report_process(plots, base_path)
+        print "Report plots are being drawn in the background to " + base_path + "_Report.html (errors to _Report.log)\n"
+        return process
+    elif plots and method == "SCREEN":
+        render_report(plots, base_path, show = True)
+    return None
+
+## Define a function to save and summarize the runs of continuous mode, in a background thread
+## Runs arrive on run_queue as (run number, results or None, time tags, start time) until a None item; exceptions are passed back on the errors list.
+## Each run's statistics are merged into measurement_statistics (if there are measurements) and interval_statistics (trigger intervals).
+## Each run's report plots are described as in the single run report; with REPORT_PLOTS = "FILES" they are drawn by a background process to
+## BASE_FILE_NAME + "_Run<n>_Report.html", one process at a time, and otherwise the latest run's plots are kept in last_plots, as (base path, plots).
+def process_runs(run_queue, errors, measurement_statistics = None, interval_statistics = None, archive = None, last_plots = None):
+    report_process = None
+    while True:
+        item = run_queue.get()
+        if item is None:
+            return
+        run, R, TTags, started = item
+        try:
+            base_path = "%s_Run%04d" % (BASE_DIRECTORY + BASE_FILE_NAME, run)
+            writer = StreamingResultWriter(base_path, len(TTags), 0 if R is None else R.shape[1] - 2, resume = "NO")
+            if R is None:
+                writer.append_time_tags(TTags)
+            else:
+                writer.append(R)
+            writer.close()
+            if archive is not None:
+                archive.add_run(np.column_stack((np.arange(1, len(TTags) + 1), TTags)) if R is None else R,
+                                [name.strip() for name in writer.header.split(",")][:2 if R is None else R.shape[1]], started, name = "%s_Run%04d" % (BASE_FILE_NAME, run))
+            message = "Run %d saved:  %d segments" % (run, len(TTags))
+            if len(TTags) > 1:
+                intervals = RunningStatistics(1)
+                intervals.update(np.diff(TTags))
+                message += ", mean trigger interval %.6e s" % intervals.mean[0]
+                if interval_statistics is not None:
+                    interval_statistics.merge(intervals)
+            if R is not None:
+                measurements = RunningStatistics(R.shape[1] - 2)
+                measurements.update(R[:,2:])
+                message += ", measurement averages " + ", ".join(["%.6e" % m for m in measurements.mean])
+                if measurement_statistics is not None:
+                    measurement_statistics.merge(measurements)
+            sys.stdout.write(message + "\n")
+            if REPORT_PLOTS != "NO":
+                plots = run_report_plots(R, TTags, [name.strip() for name in writer.header.split(",")][2:])
+                if REPORT_PLOTS == "FILES" and plots:
+                    if report_process is not None:
+                        report_process.wait() # Keeps drawing from falling further and further behind the runs
+                    report_process = start_report_process(plots, base_path)
+                elif last_plots is not None:
+                    last_plots[:] = [(base_path, plots)]
+        except Exception as err:
+            errors.append(err)
+
+## Define continuous mode:  back to back segmented acquisitions, overlapping each run's saving with the next run's acquisition
+## Reports the statistics of all runs at the end; report plots are drawn for each run (see process_runs), or, with REPORT_PLOTS = "SCREEN",
+## shown for the last run.
+## Returns the duty cycle of each run:  the time spent acquiring divided by the time from arming the run to arming the next one.
+def run_continuous(scope, runs = CONTINUOUS_RUNS, NMeas = 0):
+
+    run_queue = Queue.Queue(PROCESSING_QUEUE_SIZE)
+    errors = []
+    measurement_statistics = RunningStatistics(NMeas) if NMeas > 0 else None
+    interval_statistics = RunningStatistics(1)
+    archive = ResultArchive() if ARCHIVE_RUNS == "YES" else None
+    last_plots = []
+    worker = threading.Thread(target = process_runs, args = (run_queue, errors, measurement_statistics, interval_statistics, archive, last_plots))
+    worker.daemon = True
+    worker.start()
+
+    summary = open(BASE_DIRECTORY + BASE_FILE_NAME + "_Runs.csv", 'w')
+    summary.write("Run,Segments,Acquisition (s),Readout (s),Cycle (s),Duty cycle\n")
+    duty_cycles = []
+
+    ## Report a run once the next one has been armed (or the last run has finished)
+    def report(run, NSegs, acquisition_time, readout_time, armed, next_armed):
+        cycle = next_armed - armed
+        duty_cycles.append(acquisition_time / cycle)
+        summary.write("%d,%d,%.6e,%.6e,%.6e,%.6f\n" % (run, NSegs, acquisition_time, readout_time, cycle, duty_cycles[-1]))
+        summary.flush()
+        sys.stdout.write("Run %d:  %d segments, acquisition %.3f s, readout %.3f s, duty cycle %.1f%%\n" % (run, NSegs, acquisition_time, readout_time, 100.0 * duty_cycles[-1]))
+
+    run = 0
+    previous = None
+    try:
+        while runs == 0 or run < runs:
+            run += 1
+            armed = timer()
+            started = time.time()
+            if previous is not None:
+                report(*(previous + (armed,)))
+                previous = None
+            trace_phase("acquisition wait")
+            acquire_waveforms(scope)
+            acquired = timer()
+            NSegs = int(scope.query(":WAVeform:SEGMented:COUNt?"))
+            if NSegs == 0:
+                print "No segments acquired in run %d." % run
+                continue
+            if NMeas > 0:
+                trace_phase("measurement readout")
+                R = capture_measurements(scope, NSegs, NMeas)
+                TTags = R[:,1]
+            else:
+                trace_phase("time tag readout")
+                R = None
+                TTags = read_time_tags(scope, NSegs)
+            read = timer()
+            run_queue.put((run, R, TTags, started)) # Waits if the background thread has fallen PROCESSING_QUEUE_SIZE runs behind
+            if errors:
+                raise errors[0]
+            previous = (run, NSegs, acquired - armed, read - acquired, armed)
+    except KeyboardInterrupt:
+        print "Continuous mode stopped by keyboard interrupt in run %d; that run is discarded." % run
+    finally:
+        if previous is not None:
+            report(*(previous + (timer(),)))
+        run_queue.put(None) # Let the background thread finish saving the queued runs
+        worker.join()
+        summary.close()
+    if errors:
+        raise errors[0]
+
+    if REPORT_MEASUREMENT_STATISTICS == "YES" and measurement_statistics is not None and measurement_statistics.count > 0:
+        print "\nMEASUREMENT STATISTICS, ALL RUNS:\n"
+        stats = measurement_statistics.summary()
+        for n, name in enumerate(MEASUREMENT_HEADER.strip('\n').split(',')[-NMeas:]):
+            print_statistics(name.strip(), stats, n)
+    if REPORT_THROUGHPUT_STATISTICS == "YES" and interval_statistics.count > 0:
+        print "\nTHROUGHPUT STATISTICS, ALL RUNS:\n"
+        print_statistics("trigger time differences within runs (s)", interval_statistics.summary())
+    if REPORT_PLOTS == "FILES" and duty_cycles:
+        print "\nReport plots of each run are drawn in the background to " + BASE_DIRECTORY + BASE_FILE_NAME + "_Run<n>_Report.html"
+    elif last_plots:
+        print "\nReport plots of the last run, run %d:" % len(duty_cycles)
+        draw_report(last_plots[0][1], last_plots[0][0])
+
+    return duty_cycles
+
+## Define a barrier for arming several scopes together (Python 2.7 has no threading.Barrier)
+## wait() returns once parties threads are waiting; abort() releases them all with an error, for when a scope fails before arming.
+class ArmingBarrier(object):
+
+    def __init__(self, parties):
+        self.parties = parties
+        self.waiting = 0
+        self.broken = False
+        self.condition = threading.Condition()
+
+    def wait(self):
+        with self.condition:
+            self.waiting += 1
+            self.condition.notify_all()
+            while self.waiting < self.parties and not self.broken:
+                self.condition.wait(1.0)
+            if self.broken:
+                raise RuntimeError("Another scope failed before arming.")
+
+    def abort(self):
+        with self.condition:
+            self.broken = True
+            self.condition.notify_all()
+
+## Define a function to run the whole sequence (connect, setup, acquire, read out, save) on one of several scopes
+## Returns the results (or None if only time tags are logged) and the time tags.
+def run_scope(rm, address, base_path, barrier = None, setup_cache_directory = SETUP_CACHE_DIRECTORY):
+    scope = None
+    try:
+        scope = rm.open_resource(address)
+        if COALESCE_COMMANDS == "YES":
+            scope = ScpiSession(scope)
+        scope.timeout = GLOBAL_TIMEOUT
+        scope.clear()
+        scope.write(":SYSTem:HEADer 0")
+        scope.write(":SYSTem:LOCK 1; GUI OFF" if LOCK_SCOPE == "YES" else ":SYSTem:LOCK 0; GUI ON")
+        if SETUP_METHOD == "SCRIPT":
+            setup_file = setup_cache_file(scope, directory = setup_cache_directory) if SETUP_CACHE == "YES" else None
+            restored = setup_file is not None and restore_setup(scope, setup_file)
+            if not restored:
+                setup_scope(scope)
+            if ErrCheck(scope):
+                raise RuntimeError("Setup has errors.")
+            if setup_file is not None and not restored:
+                save_setup(scope, setup_file)
+        else:
+            scope.write(":STOP")
+
+        if USE_AS_TRIGGER_TIME_RECORDER_ONLY == "YES":
+            NMeas = 0
+        elif MEAS_METHOD == "SCOPE":
+            NMeas = scope_measurement_results(scope)
+        else:
+            NMeas = len(MEASURE_LIST)
+
+        if barrier is not None:
+            barrier.wait()
+        try:
+            acquire_waveforms(scope)
+        except SystemExit: # acquire_waveforms exits the script if communication fails; here that would only end this thread
+            raise RuntimeError("Communication with the scope failed during the acquisition.")
+
+        NSegs = int(scope.query(":WAVeform:SEGMented:COUNt?"))
+        writer = StreamingResultWriter(base_path, NSegs, NMeas, resume = "NO")
+        if NMeas > 0:
+            R = capture_measurements(scope, NSegs, NMeas, writer = writer)
+            TTags = R[:,1]
+        else:
+            R = None
+            TTags = read_time_tags(scope, NSegs, writer = writer, xlist_directory = setup_cache_directory)
+        writer.close()
+        return R, TTags
+
+    except Exception:
+        if barrier is not None:
+            barrier.abort()
+        raise
+    finally:
+        if scope is not None:
+            try:
+                scope.clear()
+                scope.write(":SYSTem:LOCK 0; GUI ON")
+                scope.close()
+            except Exception:
+                pass
+
+## Define a function to merge the results of several scopes into one timeline, sorted by time tag
+## Columns are time tag, scope number (1 is the first address), segment index, then the measurements if every scope has the same number of them.
+def merge_timelines(outputs, filename = None, header = MEASUREMENT_HEADER):
+    parts = [(n + 1, R, TTags) for n, (R, TTags) in enumerate(outputs) if TTags is not None]
+    widths = set([0 if R is None else R.shape[1] - 2 for n, R, TTags in parts])
+    NMeas = widths.pop() if len(widths) == 1 else 0
+    T = np.empty((sum([len(TTags) for n, R, TTags in parts]), 3 + NMeas))
+    row = 0
+    for n, R, TTags in parts:
+        T[row:row + len(TTags),0] = TTags
+        T[row:row + len(TTags),1] = n
+        T[row:row + len(TTags),2] = np.arange(1, len(TTags) + 1)
+        if NMeas > 0:
+            T[row:row + len(TTags),3:] = R[:,2:]
+        row += len(TTags)
+    T = T[np.argsort(T[:,0], kind = 'mergesort')] # Each scope's time tags are already in order, so keep them stable
+    if filename is not None:
+        with open_csv(filename) as filehandle:
+            filehandle.write("Time Tag (s),Scope,Index" + ("," + header.strip('\n') if NMeas > 0 else "") + "\n")
+            fast_savetxt(filehandle, T)
+    return T
+
+## Define a function to run several scopes concurrently, one thread each
+## Returns the merged timeline (see merge_timelines); a scope that fails is reported and left out.
+def run_multiple_scopes(rm, addresses, base_path, synchronized_arming = SYNCHRONIZED_ARMING, setup_cache_directory = SETUP_CACHE_DIRECTORY):
+    from multiprocessing.pool import ThreadPool
+    barrier = ArmingBarrier(len(addresses)) if synchronized_arming == "YES" else None
+    pool = ThreadPool(len(addresses))
+    pending = [pool.apply_async(run_scope, (rm, address, "%s_Scope%d" % (base_path, n + 1), barrier, setup_cache_directory)) for n, address in enumerate(addresses)]
+    outputs = []
+    for n, result in enumerate(pending):
+        try:
+            outputs.append(result.get())
+        except Exception as err:
+            print "Scope %d (%s) failed:  %s" % (n + 1, addresses[n], err)
+            outputs.append((None, None))
+    pool.close()
+    pool.join()
+    return merge_timelines(outputs, base_path + "_Timeline.csv")
+
+##############################################################################################################################################################################
+## Simulated oscilloscope and benchmarks
+##############################################################################################################################################################################
+
+## Define a simulated oscilloscope
+## This stands in for a PyVISA resource (write, write_raw, query, read, read_raw, clear, close, timeout) and answers the commands used in this script from synthetic data:
+##     *RST, *CLS, *OPC?, *IDN?, :DIGitize, :SINGle, :STOP, :ADER?, :SYSTem:SETup(?), :ACQuire:SEGMented:*, :WAVeform:*, :MEASure:*, :MEASure:RESults?, :SYSTem:ERRor? STRing
+## Other settings under :ACQuire, :TIMebase, :CHANnel<n>, :TRIGger, :MEASure, and :SYSTem are stored and can be queried back.
+## Each VISA call waits latency seconds, plus command_time seconds per SCPI command and any command_latency for particular commands, to mimic the instrument.
+## Construction simulates a completed acquisition of NSegs segments; :SINGle or :DIGitize acquires :ACQuire:SEGMented:COUNt new segments in the background,
+## one every trigger_period seconds.  To simulate missing triggers, trigger_stall_after stops the triggers after that many segments.
+## To simulate a lost connection, fail_after makes every read after that many fail.
+## As on the scope, :DIGitize holds off replies (and wait_for_srq) until the acquisition is done, and clear() aborts it.
+## Headers must be written in the same mixed case as this script (e.g. :WAVeform:SEGMented:TTAG?) so the short form can be found.
+class SimulatedInfiniium(object):
+
+    SETTING_SUBSYSTEMS = ["ACQ", "TIM", "CHAN1", "CHAN2", "CHAN3", "CHAN4", "TRIG", "MEAS", "SYST"]
+    MEASUREMENT_LABELS = {"VPP": "V p-p", "RIS": "Rise time", "TVOL": "Time at volts"}
+
+    def __init__(self, NSegs = BENCHMARK_SEGMENTS, latency = BENCHMARK_LATENCY, command_time = 0.00001, trigger_period = BENCHMARK_TRIGGER_PERIOD, trigger_jitter = 1e-9,
+                 supports_xlist = True, points = 1000, bandwidth = 50e6, command_latency = None, trigger_stall_after = None, fail_after = None):
+        self.timeout = GLOBAL_TIMEOUT
+        self.latency = latency
+        self.command_time = command_time
+        self.command_latency = command_latency or {}
+        self.supports_xlist = supports_xlist
+        self.trigger_period = trigger_period
+        self.trigger_jitter = trigger_jitter
+        self.errors = []
+        self.responses = []
+        self.settings = {}
+        self.round_trips = 0
+        self.messages = 0
+        self.bytes_read = 0
+        self.bandwidth = bandwidth # Bytes per second for replies
+        self.segment_count = NSegs # :ACQuire:SEGMented:COUNt setting
+        self.seed = 0
+        self.trigger_stall_after = trigger_stall_after
+        self.fail_after = fail_after
+        self.acquiring = False
+        self.blocking = False # True during :DIGitize
+        self.acquisition_done = False # Acquisition done event register (:ADER?)
+
+        ## Synthetic waveforms:  one edge per segment, built from the measurement results; see _waveform
+        self.points = points
+        self.x_increment = 5e-8 / points # 5 ns/div, 10 divisions
+        self.x_origin = -2.5e-8
+        self.channel_scale = [0.2, 0.2, 0.2, 0.2]
+        self.waveform_source = 1
+        self.waveform_format = "ASC"
+        self.all_segments = False
+        self.scope_measurements = [("VPP", "CHANnel1"), ("RIS", "CHANnel1")] # Measurements "enabled on the scope" for :MEASure:RESults?
+        self._acquire(NSegs)
+
+        self.handlers = {
+            "*RST":            self._reset,
+            "*CLS":            self._clear_status,
+            "*OPC?":           lambda args: "1",
+            "*IDN?":           lambda args: "KEYSIGHT TECHNOLOGIES,MSOS804A,SIMULATED,%s" % ("06.00.00628" if self.supports_xlist else "05.70.00504"),
+            "*ESE":            lambda args: None,
+            "*SRE":            lambda args: None,
+            "*ESR?":           lambda args: "0" if self.acquiring else "1",
+            "DIG":             self._digitize,
+            "SING":            self._single,
+            "STOP":            self._stop,
+            "ADER?":           self._ader_query,
+            "SYST:ERR?":       self._error_query,
+            "SYST:SET?":       self._setup_query,
+            "SYST:SET":        self._restore_setup,
+            "ACQ:SEGM:COUN":   self._set_segment_count,
+            "ACQ:SEGM:COUN?":  lambda args: "%d" % self.segment_count,
+            "ACQ:SEGM:IND":    self._set_index,
+            "ACQ:SEGM:IND?":   lambda args: "%d" % self.segment_index,
+            "WAV:SEGM:COUN?":  lambda args: "%d" % (self._acquired_so_far() if self.acquiring else self.NSegs),
+            "WAV:SEGM:TTAG?":  lambda args: "%+.12E" % self.time_tags[self.segment_index - 1],
+            "WAV:SEGM:XLIS?":  self._xlist_query,
+            "MEAS:VPP?":       lambda args: self._measure("VPP", args),
+            "MEAS:RIS?":       lambda args: self._measure("RIS", args),
+            "MEAS:TVOL?":      lambda args: self._measure("TVOL", args),
+            "MEAS:RES?":       self._results_query,
+            "WAV:SOUR":        self._set_source,
+            "WAV:FORM":        self._set_format,
+            "WAV:BYT":         lambda args: None, # Always LSBFirst
+            "WAV:STR":         lambda args: None, # Always a definite length block
+            "WAV:SEGM:ALL":    self._set_all_segments,
+            "WAV:PRE?":        self._preamble_query,
+            "WAV:DATA?":       self._data_query,
+            }
+
+    ## Generate the synthetic data of a segmented acquisition
+    def _acquire(self, NSegs):
+        rng = np.random.RandomState(self.seed)
+        self.seed += 1
+        self.NSegs = NSegs
+        self.segment_index = 1
+
+        ## Time tags: a steady trigger with a little Gaussian jitter, referenced to the first segment
+        self.time_tags = np.arange(NSegs) * self.trigger_period + rng.normal(0, self.trigger_jitter, NSegs)
+        self.time_tags[0] = 0.0
+
+        ## Per-segment measurement results for channels 1-4
+        self.amplitude = 0.8 + rng.normal(0, 0.01, (4, NSegs))
+        self.rise_time = 5e-10 + rng.normal(0, 1e-11, (4, NSegs))
+        self.edge_time = rng.normal(0, 2e-11, (4, NSegs))
+        self.waveforms = {}
+        self.encoded = {}
+
+    def _reset(self, args):
+        self.settings.clear()
+        self.segment_count = 2
+        self.all_segments = False
+        self.waveform_format = "ASC"
+
+    def _single(self, args):
+        self.acquiring = True
+        self.acquisition_done = False
+        self.acquisition_start = time.time()
+
+    def _digitize(self, args):
+        self._single(args)
+        self.blocking = True
+
+    def _acquired_so_far(self):
+        acquired = min(self.segment_count, int((time.time() - self.acquisition_start) / self.trigger_period))
+        if self.trigger_stall_after is not None:
+            acquired = min(acquired, self.trigger_stall_after)
+        return acquired
+
+    ## Stop acquiring and keep the segments acquired so far
+    def _finish(self, NSegs):
+        self.acquiring = False
+        self.blocking = False
+        self._acquire(NSegs)
+
+    ## Finish the acquisition once every segment is in
+    def _update(self):
+        if self.acquiring and self._acquired_so_far() >= self.segment_count:
+            self._finish(self.segment_count)
+            self.acquisition_done = True
+
+    def _stop(self, args):
+        if self.acquiring:
+            self._finish(self._acquired_so_far())
+
+    def _ader_query(self, args):
+        done = self.acquisition_done
+        self.acquisition_done = False
+        return "1" if done else "0"
+
+    ## Wait up to timeout milliseconds for the acquisition to finish
+    def _wait_for_acquisition(self, timeout):
+        deadline = time.time() + timeout / 1000.0
+        self._update()
+        while self.acquiring:
+            if time.time() >= deadline:
+                return False
+            time.sleep(max(0.0005, min(0.01, deadline - time.time())))
+            self._update()
+        return True
+
+    def _set_segment_count(self, args):
+        self.segment_count = int(float(args))
+
+    ## The setup is an opaque binary block; this one is a pickle, which is full of ; and newline bytes
+    def _setup_query(self, args):
+        setup = pickle.dumps((self.settings, self.segment_count), 2)
+        return "#8%08d%s" % (len(setup), setup)
+
+    def _restore_setup(self, args):
+        ndigits = int(args[1])
+        self.settings, self.segment_count = pickle.loads(args[2 + ndigits:2 + ndigits + int(args[2:2 + ndigits])])
+
+    def _clear_status(self, args):
+        del self.errors[:]
+
+    def _error_query(self, args):
+        if self.errors:
+            return self.errors.pop(0)
+        return '0,"No error"'
+
+    def _set_index(self, args):
+        index = int(float(args))
+        if 1 <= index <= self.NSegs:
+            self.segment_index = index
+        else:
+            self.errors.append('-222,"Data out of range"')
+
+    def _xlist_query(self, args):
+        if not self.supports_xlist:
+            raise KeyError
+        return ",".join(["%+.12E" % t for t in self.time_tags])
+
+    ## Return the current segment's result of a measurement on the channel named in args (e.g. "CHANnel1" or "0,+1,CHANnel3")
+    def _measure(self, name, args):
+        channel = int(args.split(",")[-1].strip()[-1]) - 1
+        n = self.segment_index - 1
+        if name == "VPP":
+            return "%+.6E" % self.amplitude[channel, n]
+        if name == "RIS":
+            return "%+.6E" % self.rise_time[channel, n]
+        return "%+.6E" % self.edge_time[channel, n]
+
+    ## :MEASure:RESults? reports, per enabled measurement, a label and six values (current, minimum, maximum, mean, standard deviation, count) with
+    ## statistics on, as after *RST, or only the current value with :MEASure:STATistics CURRent; the statistics themselves are not simulated
+    def _results_query(self, args):
+        results = []
+        for name, source in self.scope_measurements:
+            current = self._measure(name, source)
+            if self.settings.get("MEAS:STAT", "ON").upper().startswith("CURR"):
+                results.append(current)
+            else:
+                label = "%s(%s)" % (self.MEASUREMENT_LABELS[name], source[-1])
+                results.extend([label, current, current, current, current, "+0.0E+00", "1"])
+        return ",".join(results)
+
+    def _set_source(self, args):
+        self.waveform_source = int(args[-1])
+
+    def _set_format(self, args):
+        self.waveform_format = args.upper()[:3] # ASC, BYT, or WOR
+
+    def _set_all_segments(self, args):
+        self.all_segments = args.upper() in ("1", "ON")
+
+    ## Y increment is the full scale range (8 divisions) divided by the number of codes
+    def _y_increment(self):
+        codes = 256.0 if self.waveform_format == "BYT" else 65536.0
+        return 8 * self.channel_scale[self.waveform_source - 1] / codes
+
+    def _preamble_query(self, args):
+        format_code = {"ASC": 0, "BYT": 1, "WOR": 2}[self.waveform_format]
+        return "%d,0,%d,1,%+.6E,%+.6E,0,%+.6E,%+.6E,0" % (format_code, self.points, self.x_increment, self.x_origin, self._y_increment(), 0.0)
+
+    ## Synthetic waveform for one channel (segments x points, volts):  a tanh edge with each segment's amplitude, 10-90% rise time, and edge time, plus noise
+    ## The 10-90% rise time of 0.5 * (1 + tanh(t / tau)) is 2 * atanh(0.8) * tau
+    def _waveform(self, channel):
+        if channel not in self.waveforms:
+            rng = np.random.RandomState(channel)
+            t = np.arange(self.points) * self.x_increment + self.x_origin
+            tau = self.rise_time[channel - 1][:,np.newaxis] / (2 * np.arctanh(0.8))
+            edge = np.tanh((t[np.newaxis,:] - self.edge_time[channel - 1][:,np.newaxis]) / tau)
+            self.waveforms[channel] = 0.5 * self.amplitude[channel - 1][:,np.newaxis] * edge + rng.normal(0, 0.002, (self.NSegs, self.points))
+        return self.waveforms[channel]
+
+    ## The encoded reply is cached so that benchmarks time the transfer and parsing, not the simulator
+    def _data_query(self, args):
+        key = (self.waveform_source, self.waveform_format, self.all_segments, self.segment_index)
+        if key not in self.encoded:
+            volts = self._waveform(self.waveform_source)
+            volts = volts if self.all_segments else volts[self.segment_index - 1:self.segment_index]
+            if self.waveform_format == "ASC":
+                self.encoded[key] = ",".join(["%+.6E" % v for v in volts.ravel()])
+            else:
+                dtype = "i1" if self.waveform_format == "BYT" else "<i2"
+                limit = 127 if self.waveform_format == "BYT" else 32767
+                payload = np.clip(np.round(volts / self._y_increment()), -limit, limit).astype(dtype).tostring()
+                self.encoded[key] = "#%d%d" % (len(str(len(payload))), len(payload)) + payload
+        return self.encoded[key]
+
+    ## Store or recall a setting that has no handler of its own
+    def _setting(self, key, args):
+        if key.endswith("?") and key[:-1] in self.settings:
+            return self.settings[key[:-1]]
+        if key.endswith("?") or key.split(":")[0] not in self.SETTING_SUBSYSTEMS:
+            raise KeyError(key)
+        self.settings[key] = args
+
+    ## Execute each ; separated command in a program message
+    ## Returns the simulated processing time of the message
+    def _execute(self, message):
+        self._update()
+        delay = 0.0
+        for key, header, args in parse_scpi_message(message):
+            delay += self.command_time + self.command_latency.get(key, 0.0)
+            try:
+                if key in self.handlers:
+                    response = self.handlers[key](args)
+                else:
+                    response = self._setting(key, args)
+            except KeyError:
+                self.errors.append('-113,"Undefined header"')
+                continue
+            if response is not None:
+                self.responses.append(response)
+        return delay
+
+    def write(self, message):
+        self.messages += 1
+        time.sleep(self.latency / 2.0 + self._execute(message))
+
+    def read(self):
+        self.round_trips += 1
+        if self.fail_after is not None and self.round_trips > self.fail_after:
+            raise IOError("VI_ERROR_CONN_LOST (-1073807194): The connection for the given session has been lost.")
+        if not self.responses or (self.blocking and not self._wait_for_acquisition(self.timeout)):
+            time.sleep(self.latency / 2.0)
+            raise IOError("VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.")
+        reply = ";".join(self.responses) + "\n"
+        del self.responses[:]
+        self.bytes_read += len(reply)
+        time.sleep(self.latency / 2.0 + len(reply) / self.bandwidth)
+        return reply
+
+    read_raw = read
+    write_raw = write
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def wait_for_srq(self, timeout = 25000):
+        if not self._wait_for_acquisition(timeout):
+            raise IOError("VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.")
+
+    def clear(self):
+        if self.blocking: # Device clear aborts :DIGitize
+            self._stop(None)
+        del self.responses[:]
+
+    def close(self):
+        pass
+
+## Define a simulated VISA resource manager, so that SCOPE_VISA_ADDRESS = "SIMULATED" runs the whole script without a scope
+class SimulatedResourceManager(object):
+
+    def __init__(self, latency = BENCHMARK_LATENCY):
+        self.latency = latency
+
+    def open_resource(self, address):
+        return SimulatedInfiniium(NUMBER_SEGMENTS, self.latency, command_latency = BENCHMARK_COMMAND_LATENCY)
+
+    def close(self):
+        pass
+
+## Define a TCP server that makes a simulated oscilloscope available as a raw SCPI socket, like port 5025 of a real Infiniium
+## (e.g. open "TCPIP0::localhost::5025::SOCKET" with read_termination = "\n").  Use port 0 to pick any free port; the port in use is in .port
+## Program messages are newline terminated (block data may hold newlines); the replies to each message are sent back as one newline terminated reply.
+## As on the scope, replies not yet read when a connection closes are dropped.
+class SimulatedInfiniiumServer(threading.Thread):
+
+    def __init__(self, scope, host = "127.0.0.1", port = 5025):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scope = scope
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except socket.error: # The listener was closed
+                return
+            self._serve(connection)
+
+    def _serve(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        del self.scope.responses[:]
+        received = ""
+        while True:
+            try:
+                data = connection.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            received += data
+            end = scpi_message_end(received)
+            while end >= 0:
+                message, received = received[:end], received[end + 1:]
+                self.scope.write(message)
+                end = scpi_message_end(received)
+                if self.scope.responses:
+                    connection.sendall(self.scope.read())
+        connection.close()
+
+    def close(self):
+        self.listener.close()
+
+## Define a benchmark for time tag readout
+def benchmark_time_tag_readout(NSegs = BENCHMARK_SEGMENTS, latency = BENCHMARK_LATENCY):
+    print "Time tag readout, %d segments, %.2f ms simulated round trip:" % (NSegs, latency * 1000.0)
+    cases = [("Per-segment loop (original)", "BATCH", 1, True, False),
+             ("BATCH, 50 segments/message",  "BATCH", 50, True, False),
+             ("BATCH, %d segments/message" % TTAG_BATCH_SIZE, "BATCH", TTAG_BATCH_SIZE, True, False),
+             ("XLIST",                       "XLIST", TTAG_BATCH_SIZE, True, False),
+             ("AUTO, no XLIST support",      "AUTO",  TTAG_BATCH_SIZE, False, False),
+             ("AUTO, no XLIST, later launch", "AUTO",  TTAG_BATCH_SIZE, False, True)]
+    directory = tempfile.mkdtemp() # For the list of scopes without XLIST support
+    try:
+        for label, method, batch_size, supports_xlist, later_launch in cases:
+            scope = SimulatedInfiniium(NSegs, latency, supports_xlist = supports_xlist)
+            if later_launch:
+                read_time_tags(scope, NSegs, method, batch_size, xlist_directory = directory)
+                Xlist_Support.clear() # A later launch only has the list on disk
+                scope.round_trips = 0
+            start = timer()
+            TTags = read_time_tags(scope, NSegs, method, batch_size, xlist_directory = directory)
+            elapsed = timer() - start
+            if not np.allclose(TTags, scope.time_tags, rtol = 1e-11, atol = 0):
+                print "\tWARNING:  %s returned incorrect time tags." % label
+            print "\t%-32s %12.0f segments/s  %8.3f s  %6d round trips" % (label, NSegs / elapsed, elapsed, scope.round_trips)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+    print ""
+
+## Define a benchmark for per-segment measurement readout
+def benchmark_measurement_readout(NSegs = BENCHMARK_SEGMENTS / 4, latency = BENCHMARK_LATENCY):
+    print "Measurement readout, %d segments x %d measurements, %.2f ms simulated round trip:" % (NSegs, len(MEASURE_LIST), latency * 1000.0)
+
+    ## Original approach:  one round trip per segment for the time tag and one per measurement
+    scope = SimulatedInfiniium(NSegs, latency)
+    start = timer()
+    for n in xrange(NSegs):
+        scope.query(":ACQuire:SEGMented:INDex %d;:WAVeform:SEGMented:TTAG?" % (n + 1))
+        for m in MEASURE_LIST:
+            scope.query(measurement_query(m))
+    elapsed = timer() - start
+    print "\t%-32s %12.0f segments/s  %8.3f s  %6d round trips" % ("One query per measurement", NSegs / elapsed, elapsed, scope.round_trips)
+
+    for label, method, batch_size in [("SCRIPT, 1 segment/message", "SCRIPT", 1),
+                                      ("SCRIPT, %d segments/message" % MEAS_BATCH_SIZE, "SCRIPT", MEAS_BATCH_SIZE),
+                                      ("SCOPE, %d segments/message" % MEAS_BATCH_SIZE, "SCOPE", MEAS_BATCH_SIZE)]:
+        scope = SimulatedInfiniium(NSegs, latency)
+        NMeas = len(MEASURE_LIST) if method == "SCRIPT" else len(scope.scope_measurements)
+        start = timer()
+        R = capture_measurements(scope, NSegs, NMeas, method, MEASURE_LIST, batch_size)
+        elapsed = timer() - start
+        if not np.allclose(R[:,1], scope.time_tags, rtol = 1e-11, atol = 0):
+            print "\tWARNING:  %s returned incorrect time tags." % label
+        if method == "SCOPE" and not np.allclose(R[:,2:], np.transpose([scope.amplitude[0], scope.rise_time[0]]), rtol = 1e-6, atol = 0):
+            print "\tWARNING:  %s returned incorrect measurement results." % label
+        print "\t%-32s %12.0f segments/s  %8.3f s  %6d round trips" % (label, NSegs / elapsed, elapsed, scope.round_trips)
+    print ""
+
+## Define a benchmark for downloading all segments of one channel in each waveform format
+def benchmark_waveform_download(NSegs = BENCHMARK_SEGMENTS / 4, latency = BENCHMARK_LATENCY):
+    print "Waveform download, 1 channel, %d segments x 1000 points, %.2f ms simulated round trip, 50 MB/s link:" % (NSegs, latency * 1000.0)
+    for waveform_format in ["BYTE", "WORD", "ASCII"]:
+        scope = SimulatedInfiniium(NSegs, latency)
+        download_waveforms(scope, NSegs, [1], waveform_format) # Warm up the simulator's reply cache
+        scope.bytes_read = 0
+        start = timer()
+        W, scaling = download_waveforms(scope, NSegs, [1], waveform_format)
+        elapsed = timer() - start
+        volts = W[0] * scaling[0,1] + scaling[0,2]
+        if np.max(np.abs(volts - scope._waveform(1))) > scaling[0,1] or (waveform_format == "ASCII" and np.max(np.abs(volts - scope._waveform(1))) > 1e-6):
+            print "\tWARNING:  %s returned incorrect waveforms." % waveform_format
+        print "\t%-6s %10.1f MB/s transferred  %10.1f Msamples/s  %8.3f s  %8.1f MB" % (waveform_format, scope.bytes_read / elapsed / 1e6, W.size / elapsed / 1e6, elapsed, scope.bytes_read / 1e6)
+    print ""
+
+## Define a benchmark and accuracy check for the host-side measurements, against the known synthetic edges of the simulated scope
+## The accuracy check fails if the mean error of a measurement is over its tolerance (volts or seconds):  for VPP, a few WORD codes; for the
+## rise time, 1% of the simulated 500 ps; for the threshold crossing, 1% of that rise time
+def benchmark_host_measurements(segment_counts = [1000, 10000, 100000], points = 200, accuracy_points = 1000, tolerances = {"VPP": 1e-4, "RIS": 5e-12, "TVOL": 5e-12}):
+
+    ## WORD codes of the simulated waveforms of every channel used in MEASURE_LIST
+    def synthetic_waveforms(scope):
+        channels = sorted(set([int(m.split(",")[-1].strip()[-1]) for m in MEASURE_LIST]))
+        W = np.empty((len(channels), scope.NSegs, scope.points), dtype = np.int16)
+        scaling = np.empty((len(channels), 5))
+        scope.waveform_format = "WOR"
+        for row, channel in enumerate(channels):
+            scope.waveform_source = channel
+            W[row] = np.round(scope._waveform(channel) / scope._y_increment())
+            scaling[row] = [channel, scope._y_increment(), 0.0, scope.x_increment, scope.x_origin]
+            del scope.waveforms[channel]
+        return W, scaling
+
+    print "Host-side measurements of MEASURE_LIST, %d points per segment:" % points
+    for NSegs in segment_counts:
+        W, scaling = synthetic_waveforms(SimulatedInfiniium(NSegs, 0, points = points))
+        start = timer()
+        compute_host_measurements(W, scaling, MEASURE_LIST, HOST_CHUNK_SEGMENTS)
+        elapsed = timer() - start
+        print "\t%7d segments  %10.0f segments/s  %8.3f s" % (NSegs, NSegs / elapsed, elapsed)
+        del W
+
+    ## Accuracy against the synthetic edges.  Peak-peak voltage is the maximum minus the minimum, noise included, as on the scope, so it is
+    ## compared with the peak-peak voltage of the simulated samples before quantization, not with the edge amplitude.
+    print "Accuracy, %d segments, %d points per segment:" % (segment_counts[0], accuracy_points)
+    scope = SimulatedInfiniium(segment_counts[0], 0, points = accuracy_points)
+    channels = sorted(set([int(m.split(",")[-1].strip()[-1]) for m in MEASURE_LIST]))
+    peak_peak = dict((channel, np.ptp(scope._waveform(channel), axis = 1)) for channel in channels)
+    W, scaling = synthetic_waveforms(scope)
+    M = compute_host_measurements(W, scaling, MEASURE_LIST, HOST_CHUNK_SEGMENTS)
+    failed = []
+    for n, command in enumerate(MEASURE_LIST):
+        name = scpi_short_form(command.split(" ")[0].split(":")[-1])
+        channel = int(command.split(",")[-1].strip()[-1])
+        expected = {"VPP": peak_peak[channel], "RIS": scope.rise_time[channel - 1], "TVOL": scope.edge_time[channel - 1]}[name]
+        error = M[:,n] - expected
+        print "\t%-32s mean error %+.3E  rms error %.3E  invalid %d  (tolerance %.1E)" % (command, np.nanmean(error), np.sqrt(np.nanmean(error**2)), np.sum(np.isnan(error)), tolerances[name])
+        if not abs(np.nanmean(error)) <= tolerances[name] or np.isnan(error).any():
+            failed.append(command)
+    print ""
+    if failed:
+        raise AssertionError("Host-side measurements out of tolerance:  %s" % ", ".join(failed))
+
+## Define a benchmark of CSV export:  np.savetxt against fast_savetxt, with and without compression
+def benchmark_csv_export(rows = 1000000):
+    print "CSV export, %d rows x %d columns:" % (rows, 2 + len(MEASURE_LIST))
+    R = np.random.RandomState(0).normal(0, 1, (rows, 2 + len(MEASURE_LIST)))
+    directory = tempfile.mkdtemp()
+    try:
+        for label, precision, compression in [("np.savetxt", None, "NO"),
+                                              ("fast_savetxt", CSV_PRECISION, "NO"),
+                                              ("fast_savetxt, 9 digits", 9, "NO"),
+                                              ("fast_savetxt, gzip", CSV_PRECISION, "YES")]:
+            filename = os.path.join(directory, "benchmark.csv")
+            start = timer()
+            with open_csv(filename, compression) as filehandle:
+                if precision is None:
+                    np.savetxt(filehandle, R, delimiter = ',')
+                else:
+                    fast_savetxt(filehandle, R, precision)
+            elapsed = timer() - start
+            if compression == "YES":
+                filename += ".gz"
+            size = os.path.getsize(filename)
+            if precision is not None and precision >= 16 and not np.array_equal(np.loadtxt(filename, delimiter = ',')[:1000], R[:1000]):
+                print "\tWARNING:  %s did not read back exactly." % label
+            os.remove(filename)
+            print "\t%-24s %12.0f rows/s  %8.3f s  %8.1f MB" % (label, rows / elapsed, elapsed, size / 1e6)
+        print ""
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define a benchmark of running several simulated scopes concurrently
+def benchmark_multiple_scopes(scope_counts = [1, 2, 4], latency = BENCHMARK_LATENCY):
+    directory = tempfile.mkdtemp()
+    try:
+        rows = []
+        for count in scope_counts:
+            setup_cache_directory = tempfile.mkdtemp(dir = directory) # Every count starts without a saved setup, as the first count did
+            start = timer()
+            T = run_multiple_scopes(SimulatedResourceManager(latency), ["SIMULATED"] * count, os.path.join(directory, BASE_FILE_NAME), setup_cache_directory = setup_cache_directory)
+            rows.append((count, timer() - start, len(T)))
+        print "Several scopes, %d segments each, %.2f ms simulated round trip:" % (NUMBER_SEGMENTS, latency * 1000.0)
+        for count, elapsed, segments in rows:
+            print "\t%d scope(s)  %8.3f s wall clock  %8d segments in the merged timeline" % (count, elapsed, segments)
+        print ""
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define a benchmark of the statistics:  one pass per column per statistic with a Python loop for the trigger intervals (what the report used to do),
+## against compute_statistics, and against RunningStatistics fed in batches.  The streamed percentiles must be within the sketch accuracy of the nearest
+## rank; compute_statistics interpolates between ranks, which, where the data is sparse, can be further away than that.
+def benchmark_statistics(rows = 1000000, columns = 4, batch_rows = 10000):
+    rng = np.random.RandomState(0)
+    R = np.column_stack((np.arange(1, rows + 1), np.cumsum(rng.exponential(1e-5, rows)), rng.normal(0.5, 0.01, (rows, columns))))
+    print "Statistics of %d segments, %d measurements:" % (rows, columns)
+
+    start = timer()
+    DELTA_TIMES = np.zeros(rows - 1)
+    for n in xrange(rows - 1):
+        DELTA_TIMES[n] = R[n + 1,1] - R[n,1]
+    for n in xrange(columns):
+        np.mean(R[:,n + 2]), np.std(R[:,n + 2]), np.max(R[:,n + 2]), np.min(R[:,n + 2])
+    np.mean(DELTA_TIMES), np.std(DELTA_TIMES), np.max(DELTA_TIMES), np.min(DELTA_TIMES)
+    elapsed_loop = timer() - start
+
+    start = timer()
+    exact = compute_statistics(np.column_stack((R[1:,2:], np.diff(R[:,1])))) # Percentiles included
+    elapsed_vectorized = timer() - start
+
+    start = timer()
+    running = RunningStatistics(columns + 1)
+    for first in xrange(1, rows, batch_rows): # Intervals of each batch include the one from the end of the batch before
+        batch = R[first - 1:first + batch_rows]
+        running.update(np.column_stack((batch[1:,2:], np.diff(batch[:,1]))))
+    streamed = running.summary()
+    elapsed_streaming = timer() - start
+
+    print "\t%-40s %8.3f s" % ("Per-column passes, Python interval loop", elapsed_loop)
+    print "\t%-40s %8.3f s  (with percentiles)" % ("compute_statistics", elapsed_vectorized)
+    print "\t%-40s %8.3f s  (with percentiles)" % ("RunningStatistics, %d row batches" % batch_rows, elapsed_streaming)
+    X = np.column_stack((R[1:,2:], np.diff(R[:,1])))
+    ranked = dict([(p, np.percentile(X, p, axis = 0, interpolation = "lower")) for p in STATISTICS_PERCENTILES])
+    print "\tLargest relative difference, streaming vs. exact:  mean %.1e, std %.1e, percentiles %.1e (sketch accuracy %.0e)\n" % (
+        np.max(np.abs(streamed["mean"] / exact["mean"] - 1)), np.max(np.abs(streamed["std"] / exact["std"] - 1)),
+        max([np.max(np.abs(streamed["percentiles"][p] / ranked[p] - 1)) for p in STATISTICS_PERCENTILES]), SKETCH_RELATIVE_ACCURACY)
+
+## Define a benchmark of the time tag analysis on tags tens of millions long, generated chunk by chunk:  a trigger period slightly off nominal, random
+## jitter, and randomly missed triggers, which the analysis must find
+def benchmark_time_tag_analysis(tags = 20000000, chunk_rows = 100000, period = 1e-5 * (1 + 3e-6), jitter = 1e-9, missed_fraction = 1e-4):
+    rng = np.random.RandomState(0)
+    analyzer = TimeTagAnalyzer()
+    missed = 0
+    number = 0
+    elapsed = 0.0
+    for first in xrange(0, tags, chunk_rows):
+        steps = 1 + rng.binomial(1, missed_fraction, min(chunk_rows, tags - first)) # A step of two periods is a missed trigger
+        if first == 0:
+            steps[0] = 0
+        missed += int((steps - 1).clip(0).sum())
+        numbers = number + np.cumsum(steps)
+        number = numbers[-1]
+        TTags = numbers * period + rng.normal(0, jitter, len(numbers))
+        start = timer()
+        analyzer.update(TTags)
+        elapsed += timer() - start
+    results = dict([(quantity, value) for quantity, value, unit in analyzer.summary()])
+    print "Time tag analysis of %d tags in %d tag chunks:  %.3f s, %.1f million tags/s" % (tags, chunk_rows, elapsed, tags / elapsed / 1e6)
+    print "\t%-24s %16s %16s" % ("", "True", "Found")
+    print "\t%-24s %16.9e %16.9e" % ("Period (s)", period, results["Fitted trigger period"])
+    print "\t%-24s %16.3e %16.3e" % ("RMS jitter (s)", jitter, results["RMS jitter against fitted period"])
+    print "\t%-24s %16d %16d\n" % ("Missed triggers", missed, results["Missed triggers (estimated)"])
+
+## Define a benchmark of the report plots of one measurement and the trigger time differences:  every point drawn, as before, vs. decimated plots and
+## NumPy histograms, saved to PNG files
+def benchmark_report(sizes = [10000, 100000, 1000000]):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    directory = tempfile.mkdtemp() # Save the plots into a scratch directory
+    try:
+        print "Report plots, %d pixels wide:" % REPORT_PLOT_WIDTH
+        for NSegs in sizes:
+            rng = np.random.RandomState(0)
+            TIMES = np.cumsum(rng.exponential(1e-5, NSegs))
+            DELTA_TIMES = np.diff(TIMES)
+            Y = rng.normal(0.5, 0.01, NSegs)
+
+            start = timer()
+            for n, (x, y) in enumerate([(TIMES, Y), (np.arange(1, len(DELTA_TIMES) + 1), DELTA_TIMES)]):
+                figure = plt.figure(figsize = (REPORT_PLOT_WIDTH / 100.0, REPORT_PLOT_WIDTH / 200.0), dpi = 100)
+                plt.plot(x, y, 'r+')
+                figure.savefig(os.path.join(directory, "full_%d.png" % n))
+                plt.close(figure)
+                figure = plt.figure(figsize = (REPORT_PLOT_WIDTH / 100.0, REPORT_PLOT_WIDTH / 200.0), dpi = 100)
+                plt.hist(y)
+                figure.savefig(os.path.join(directory, "full_hist_%d.png" % n))
+                plt.close(figure)
+            elapsed_full = timer() - start
+
+            start = timer()
+            plots = [scatter_plot("Measurement", TIMES, Y, "Apparent Trigger Time (s)", "Measurement"), histogram_plot("Measurement", Y, "Measurement"),
+                     scatter_plot("Differences", np.arange(1, len(DELTA_TIMES) + 1), DELTA_TIMES, "Acquisition Number-1", "Delta Trigger Times (s)"),
+                     histogram_plot("Differences", DELTA_TIMES, "Trigger Time Differences (s)")]
+            render_report(plots, os.path.join(directory, "decimated"))
+            elapsed_decimated = timer() - start
+            print "\t%8d segments:  every point %8.3f s, decimated %8.3f s" % (NSegs, elapsed_full, elapsed_decimated)
+        print ""
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define a benchmark of the transports against a simulated scope served on a local raw SCPI socket (SimulatedInfiniiumServer):  the round trip time of
+## a query (*OPC?) alone and right after a command, and the transfer rate of a large binary block (every segment of one channel, :WAVeform:DATA? in
+## WORD format)
+## HiSLIP cannot be measured this way, as the stand-in only speaks raw SCPI; VISA is measured if PyVISA finds a VISA library (VISA_LIBRARY).
+def benchmark_transport(queries = 1000, exchanges = 50, NSegs = 2000, points = 2000):
+    server = SimulatedInfiniiumServer(SimulatedInfiniium(NSegs, 0.0, command_time = 0.0, points = points, bandwidth = 1e12), port = 0)
+    download_waveforms(server.scope, NSegs, [1], "WORD") # Encode the waveforms once, so that only the transfer is timed
+    server.start()
+    print "Transports, local socket stand-in, %d queries and %d segments of %d points (%.1f MB):" % (queries, NSegs, points, NSegs * points * 2 / 1e6)
+    for label, open_scope in [("SOCKET", lambda: SocketInstrument("127.0.0.1", server.port)),
+                              ("SOCKET, Nagle and default buffers", lambda: SocketInstrument("127.0.0.1", server.port, buffer_size = 0, no_delay = False)),
+                              ("VISA, TCPIP::SOCKET resource", lambda: ScopeResourceManager()._visa_resource("TCPIP0::127.0.0.1::%d::SOCKET" % server.port))]:
+        try:
+            scope = open_scope()
+            scope.timeout = GLOBAL_TIMEOUT
+            if hasattr(scope, "read_termination"): # PyVISA socket resources need to be told where replies end
+                scope.read_termination = "\n"
+            start = timer()
+            for n in xrange(queries):
+                scope.query("*OPC?")
+            elapsed_query = (timer() - start) / queries
+            start = timer()
+            for n in xrange(exchanges): # With Nagle's algorithm, the query waits for the command to be acknowledged
+                scope.write(":WAVeform:SEGMented:ALL OFF")
+                scope.query("*OPC?")
+            elapsed_exchange = (timer() - start) / exchanges
+            start = timer()
+            W, scaling = download_waveforms(scope, NSegs, [1], "WORD")
+            elapsed_block = timer() - start
+            scope.close()
+        except Exception as err:
+            print "\t%-34s not available:  %s" % (label, str(err).split("\n")[0])
+            continue
+        print "\t%-34s %8.1f us per query  %8.1f us per command and query  %8.1f MB/s" % (label, elapsed_query * 1e6, elapsed_exchange * 1e6,
+                                                                                          W.nbytes / elapsed_block / 1e6)
+    print "\t%-34s not measured; needs a HiSLIP server\n" % "HISLIP"
+    server.close()
+
+## Define a benchmark of the startup time of the logger, launched as it is in a test sequence:  a new Python process each time, connecting to the
+## simulated scope and exiting (--connect-only), compared with the Python interpreter alone and with loading every module the script used to import
+def benchmark_startup(launches = 5):
+    import subprocess
+    script = os.path.abspath(__file__)
+    print "Startup, best of %d launches (start of process to exit):" % launches
+    for label, command in [("Python interpreter alone", [sys.executable, "-c", "pass"]),
+                           ("Modules imported before", [sys.executable, "-c", "import visa, numpy, scipy, matplotlib.pyplot"]),
+                           ("--connect-only, SIMULATED", [sys.executable, script, "--address", "SIMULATED", "--connect-only", "--set", "RUN_BENCHMARKS=NO"])]:
+        elapsed = []
+        for n in range(launches):
+            start = timer()
+            with open(os.devnull, 'w') as devnull:
+                returncode = subprocess.call(command, stdout = devnull, stderr = devnull)
+            elapsed.append(timer() - start)
+        print "\t%-28s %8.3f s%s" % (label, min(elapsed), "" if returncode == 0 else "  (failed)")
+    print ""
+
+## Define the scripted setup the script started with, as the baseline for benchmark_setup:  a query for each *OPC? wait, and the channel scale and
+## offset set a second time.  *OPC? goes in a message of its own, which waits the same, so that a coalescing ScpiSession sees the repeated settings.
+def original_setup_scope(scope, NSegs):
+    scope.query("*RST;*OPC?")
+    scope.write(":STOP")
+    scope.write(":ACQuire:MODE SEGMented")
+    scope.write(":TIMebase:VIEW MAIN")
+    scope.write(":TIMebase:REFerence CENTer")
+    scope.write(":TIMebase:SCALe 5e-9")
+    scope.write(":TIMebase:POSition 0")
+    scope.query("*OPC?")
+    scope.write(":CHANnel1:DISPlay 1; SCALe %f; OFFSet %f" % (CHANNEL_1_SCALE, CHANNEL_1_OFFSET))
+    scope.write(":CHANnel2:DISPlay 0")
+    scope.write(":CHANnel3:DISPlay 1")
+    scope.write(":CHANnel4:DISPlay 0")
+    for n in range(1, 5):
+        scope.write(":CHANnel%d:SCALe 0.2; OFFSet 0" % n)
+        scope.query("*OPC?")
+    scope.write(":TRIGger:MODE EDGE")
+    scope.write(":TRIGger:EDGE:SOURce CHANnel1")
+    scope.write(":TRIGger:EDGE:COUPling DC")
+    scope.write(":TRIGger:EDGE:SLOPe POSitive")
+    scope.write(":TRIGger:LEVel CHANnel1,0")
+    scope.query("*OPC?")
+    scope.write(":ACQuire:SEGMented:COUNt %d" % NSegs)
+
+## Define a benchmark of the scripted setup:  the original setup sent as it comes and through a coalescing ScpiSession, then the current setup_scope
+## through the session, and restoring the setup it saved.  The original and current setups differ (e.g. channels 2-4), so settings are compared in pairs.
+def benchmark_setup(latency = BENCHMARK_LATENCY):
+    directory = tempfile.mkdtemp() # Save the setup into a scratch directory
+    try:
+        print "Scripted setup, %.2f ms simulated round trip, %.1f s for *RST:" % (latency * 1000.0, BENCHMARK_COMMAND_LATENCY.get("*RST", 0.0))
+        settings = []
+        for label, setup, coalesce, cached in [("Original, message per command", original_setup_scope, False, False),
+                                               ("Original, coalesced session", original_setup_scope, True, False),
+                                               ("Coalesced session", setup_scope, True, False),
+                                               ("Restored from the setup cache", setup_scope, True, True)]:
+            resource = SimulatedInfiniium(2, latency, command_latency = BENCHMARK_COMMAND_LATENCY)
+            scope = ScpiSession(resource) if coalesce else resource
+            start = timer()
+            if cached:
+                restore_setup(scope, setup_cache_file(scope, directory = directory))
+            else:
+                setup(scope, 2)
+            ErrCheck(scope)
+            elapsed = timer() - start
+            settings.append(dict([(key, ScpiSession._value(value)) for key, value in resource.settings.items()] + [("ACQ:SEGM:COUN", resource.segment_count)]))
+            print "\t%-32s %8.3f s  %4d messages  %4d round trips  %4d settings skipped" % (label, elapsed, resource.messages, resource.round_trips, scope.skipped if coalesce else 0)
+            if setup is setup_scope and not cached:
+                save_setup(scope, setup_cache_file(scope, directory = directory))
+        print "\tSame settings: %s (original), %s (current)\n" % (settings[0] == settings[1], settings[2] == settings[3])
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define a benchmark of acquisition completion:  how soon a finished acquisition is noticed, and how much is kept when triggers go missing
+def benchmark_acquisition_wait(NSegs = 10000, stall_after = 6000, timeout = 500):
+    print "Acquisition wait, %d segments at %.0f us between triggers (%.3f s):" % (NSegs, BENCHMARK_TRIGGER_PERIOD * 1e6, NSegs * BENCHMARK_TRIGGER_PERIOD)
+    rows = []
+    for label, wait_method, timeout_behavior, stall in [("POLL", "POLL", "SAVE_AND_ABORT", None),
+                                                        ("SRQ", "SRQ", "SAVE_AND_ABORT", None),
+                                                        ("POLL, missing triggers, SAVE_AND_ABORT", "POLL", "SAVE_AND_ABORT", stall_after),
+                                                        ("POLL, missing triggers, TRY_AGAIN", "POLL", "TRY_AGAIN", stall_after),
+                                                        ("SRQ, missing triggers, SAVE_AND_ABORT", "SRQ", "SAVE_AND_ABORT", stall_after)]:
+        scope = SimulatedInfiniium(2, BENCHMARK_LATENCY, trigger_stall_after = stall)
+        scope.segment_count = NSegs
+        start = timer()
+        acquire_waveforms(scope, NSegs, wait_method, timeout_behavior, timeout)
+        elapsed = timer() - start
+        rows.append((label, elapsed, int(scope.query(":WAVeform:SEGMented:COUNt?"))))
+    for label, elapsed, kept in rows:
+        print "\t%-40s %8.3f s  %6d segments kept" % (label, elapsed, kept)
+    print ""
+
+## Define a benchmark of the I/O tracer:  its cost per command (on a simulated scope with no latency, so that nothing hides it), and a sample trace
+def benchmark_command_trace(NSegs = BENCHMARK_SEGMENTS, latency = BENCHMARK_LATENCY):
+    global COMMAND_TRACER
+    elapsed = []
+    for traced in [False, True]:
+        scope = SimulatedInfiniium(NSegs, 0.0, command_time = 0.0)
+        if traced:
+            scope = CommandTracer(scope)
+        start = timer()
+        for n in xrange(NSegs):
+            scope.query(":ACQuire:SEGMented:INDex %d;:WAVeform:SEGMented:TTAG?" % (n + 1))
+        elapsed.append(timer() - start)
+    print "I/O tracer overhead:  %.1f us per command (%.1f us untraced, %.1f us traced)\n" % (1e6 * (elapsed[1] - elapsed[0]) / NSegs, 1e6 * elapsed[0] / NSegs, 1e6 * elapsed[1] / NSegs)
+
+    directory = tempfile.mkdtemp()
+    try:
+        COMMAND_TRACER = CommandTracer(SimulatedInfiniium(2, latency, command_latency = BENCHMARK_COMMAND_LATENCY))
+        scope = ScpiSession(COMMAND_TRACER)
+        trace_phase("setup")
+        setup_scope(scope, NSegs)
+        ErrCheck(scope)
+        trace_phase("acquisition wait")
+        acquire_waveforms(scope, NSegs)
+        trace_phase("measurement readout")
+        writer = StreamingResultWriter(os.path.join(directory, BASE_FILE_NAME), NSegs, len(MEASURE_LIST), save_format = "CSV")
+        capture_measurements(scope, NSegs, len(MEASURE_LIST), writer = writer)
+        trace_phase("save")
+        writer.close()
+        print "Sample trace, %d segments, %.2f ms simulated round trip:" % (NSegs, latency * 1000.0)
+        COMMAND_TRACER.report(top = 5)
+        COMMAND_TRACER = None
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define a benchmark of a measurement readout that fails late (the connection is lost after fail_fraction of the segments), then runs again:  reading
+## from the first segment again, as before, vs. resuming from the readout journal; and what keeping the journal costs a readout that does not fail
+def benchmark_resume(NSegs = 20000, fail_fraction = 0.9, latency = BENCHMARK_LATENCY):
+    directory = tempfile.mkdtemp() # Save into a scratch directory
+    try:
+        base_path = os.path.join(directory, BASE_FILE_NAME)
+        NMeas = len(MEASURE_LIST)
+        fail_after = int(NSegs * fail_fraction) // MEAS_BATCH_SIZE + 1 # Batches, and the *IDN? query
+        print "Readout of %d segments, lost connection after segment %d, %.2f ms simulated round trip:" % (NSegs, (fail_after - 1) * MEAS_BATCH_SIZE, latency * 1000.0)
+
+        ## Read out until the connection is lost, and leave the files as the script would on exit
+        def failed_readout(resume):
+            scope = SimulatedInfiniium(NSegs, latency, fail_after = fail_after)
+            writer = StreamingResultWriter(base_path, NSegs, NMeas, resume = resume, scope_id = scope.query("*IDN?").strip())
+            try:
+                capture_measurements(scope, NSegs, NMeas, writer = writer)
+            except IOError:
+                for filehandle in [writer.csv_file, writer.time_tag_file, writer.journal_file]:
+                    if filehandle is not None:
+                        filehandle.close()
+            scope.fail_after = None
+            scope.clear() # As when the script starts
+            return scope
+
+        for label, resume in [("Read again from segment 1", "NO"), ("Resumed from the journal", "YES")]:
+            scope = failed_readout(resume)
+            round_trips = scope.round_trips
+            start = timer()
+            journal = find_resumable_readout(scope, base_path, NMeas) if resume == "YES" else None
+            writer = StreamingResultWriter(base_path, NSegs, NMeas, resume = resume, scope_id = scope.query("*IDN?").strip(), journal = journal)
+            R = capture_measurements(scope, NSegs, NMeas, writer = writer)
+            writer.close()
+            elapsed = timer() - start
+            saved = np.loadtxt(base_path + "_Measurements.csv", delimiter = ',', skiprows = 1)
+            complete = np.array_equal(saved, R) and np.array_equal(saved[:,0], np.arange(1, NSegs + 1)) and np.array_equal(np.loadtxt(base_path + "_TimeTags.csv"), R[:,1])
+            print "\t%-28s %8.3f s  %6d round trips  saved rows complete and in order: %s" % (label, elapsed, scope.round_trips - round_trips, complete)
+        scope = failed_readout("YES")
+        print "\t%-28s %s" % ("Rerun with 1 measurement", "journal refused, set up and armed again" if find_resumable_readout(scope, base_path, 1) is None else "WARNING:  journal accepted")
+        for label, resume in [("No journal", "NO"), ("Journal after every batch", "YES")]:
+            scope = SimulatedInfiniium(NSegs, latency)
+            start = timer()
+            writer = StreamingResultWriter(base_path, NSegs, NMeas, resume = resume)
+            capture_measurements(scope, NSegs, NMeas, writer = writer)
+            writer.close()
+            print "\t%-28s %8.3f s  full readout without failure" % (label, timer() - start)
+        print ""
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define a benchmark of queries across runs:  a 10 ms time tag window, and a measurement over a threshold that only a few outliers reach, answered by
+## reading every run's CSV file back with np.loadtxt vs. from the run archive, uncompressed and compressed
+def benchmark_archive(runs = 10, NSegs = 100000, columns = 4, outliers = 5, chunk_rows = 8192):
+    directory = tempfile.mkdtemp() # Save into a scratch directory
+    try:
+        rng = np.random.RandomState(0)
+        names = ["Index", "Time Tag (s)"] + ["Measurement %d" % (n + 1) for n in range(columns)]
+        archives = [("Archive", ResultArchive(os.path.join(directory, "Archive"), chunk_rows, compression = "NO")),
+                    ("Archive, compressed", ResultArchive(os.path.join(directory, "Compressed"), chunk_rows, compression = "YES"))]
+        elapsed_add = dict([(label, 0.0) for label, archive in archives])
+        for run in range(runs):
+            R = np.column_stack((np.arange(1, NSegs + 1), np.cumsum(rng.exponential(1e-5, NSegs)), rng.normal(0.5, 0.01, (NSegs, columns))))
+            R[rng.randint(0, NSegs, outliers),2] = 0.9
+            with open(os.path.join(directory, "Run%d_Measurements.csv" % run), 'wb') as filehandle:
+                filehandle.write(",".join(names) + "\n")
+                fast_savetxt(filehandle, R)
+            for label, archive in archives:
+                start = timer()
+                archive.add_run(R, names)
+                elapsed_add[label] += timer() - start
+        print "Queries over %d runs of %d segments, %d measurements, %d segments per chunk:" % (runs, NSegs, columns, chunk_rows)
+        for column, low, high in [("Time Tag (s)", 0.5, 0.51), ("Measurement 1", 0.8, np.inf)]:
+            start = timer()
+            expected = []
+            for run in range(runs):
+                R = np.loadtxt(os.path.join(directory, "Run%d_Measurements.csv" % run), delimiter = ',', skiprows = 1)
+                expected.append(R[(R[:,names.index(column)] >= low) & (R[:,names.index(column)] <= high)])
+            elapsed = timer() - start
+            print "\t%s from %g to %g, %d rows:" % (column, low, high, sum([len(rows) for rows in expected]))
+            print "\t\t%-22s %8.3f s" % ("np.loadtxt every run", elapsed)
+            for label, archive in archives:
+                start = timer()
+                matches = archive.query(column, low, high)
+                elapsed = timer() - start
+                same = len(matches) == len([rows for rows in expected if len(rows)]) and all([np.array_equal(rows, expected[run["run"] - 1]) for run, rows in matches])
+                print "\t\t%-22s %8.3f s  %4d of %d chunks read  same rows: %s" % (label, elapsed, archive.chunks_read, sum([len(run["chunks"]) for run in archive.runs]), same)
+        for label, archive in archives:
+            size = sum([os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(archive.directory) for name in files])
+            print "\t%-22s %8.3f s to add the runs, %6.1f MB" % (label, elapsed_add[label], size / 1e6)
+        print "\t%-22s %17s %6.1f MB\n" % ("CSV files", "", sum([os.path.getsize(os.path.join(directory, "Run%d_Measurements.csv" % run)) for run in range(runs)]) / 1e6)
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Define an end-to-end benchmark of the script's phases (setup, acquisition wait, readout, save) at different segment counts
+def benchmark_end_to_end(segment_counts = [100, 1000, 10000], latency = BENCHMARK_LATENCY):
+    directory = tempfile.mkdtemp() # Save into a scratch directory
+    try:
+        rows = []
+        for NSegs in segment_counts:
+            scope = SimulatedInfiniium(2, latency, command_latency = BENCHMARK_COMMAND_LATENCY)
+            if COALESCE_COMMANDS == "YES":
+                scope = ScpiSession(scope)
+            times = [timer()]
+            setup_scope(scope, NSegs)
+            ErrCheck(scope)
+            times.append(timer())
+            acquire_waveforms(scope, NSegs)
+            times.append(timer())
+            NSegs_Acquired = int(scope.query(":WAVeform:SEGMented:COUNt?"))
+            R = capture_measurements(scope, NSegs_Acquired, len(MEASURE_LIST))
+            times.append(timer())
+            writer = StreamingResultWriter(os.path.join(directory, BASE_FILE_NAME), NSegs_Acquired, len(MEASURE_LIST))
+            writer.append(R)
+            writer.close()
+            times.append(timer())
+            rows.append([NSegs] + list(np.diff(times)) + [times[-1] - times[0], scope.round_trips])
+        print "End-to-end run, %d measurements, %.2f ms simulated round trip, %.0f us between triggers:" % (len(MEASURE_LIST), latency * 1000.0, BENCHMARK_TRIGGER_PERIOD * 1e6)
+        print "\t%8s %10s %10s %10s %10s %10s %8s" % ("Segments", "Setup", "Acquire", "Readout", "Save", "Total (s)", "Trips")
+        for row in rows:
+            print "\t%8d %10.3f %10.3f %10.3f %10.3f %10.3f %8d" % tuple(row)
+        print ""
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+## Draw the report plots instead of running the logger, when started by start_report_process
+if Command_Line is not None and Command_Line.render_report is not None:
+    with open(Command_Line.render_report, 'rb') as filehandle:
+        Report_Plots, Report_Base_Path, Report_Settings = pickle.load(filehandle)
+    globals().update(Report_Settings)
+    render_report(Report_Plots, Report_Base_Path)
+    os.remove(Command_Line.render_report)
+    sys.exit()
+
+## Query the run archive instead of running the logger, if requested
+if Command_Line is not None and Command_Line.query is not None:
+    Archive = ResultArchive()
+    start = timer()
+    Matches = Archive.query(*Command_Line.query)
+    print "%d of %d archived runs have %s from %g to %g; %d of %d chunks read in %.3f s." % (len(Matches), len(Archive.runs), Command_Line.query[0],
+        Command_Line.query[1], Command_Line.query[2], Archive.chunks_read, sum([len(run["chunks"]) for run in Archive.runs]), timer() - start)
+    for run, rows in Matches:
+        filename = BASE_DIRECTORY + BASE_FILE_NAME + "_Query_Run%06d.csv" % run["run"]
+        with open_csv(filename) as filehandle:
+            filehandle.write(",".join(run["columns"]) + "\n")
+            fast_savetxt(filehandle, rows)
+        print "\tRun %d (%s, started %s):  %d rows, saved to %s" % (run["run"], run.get("name", ""), time.ctime(run["started"]), len(rows), filename)
+    sys.exit()
+
+## Run the benchmarks instead of the logger, if requested
+if RUN_BENCHMARKS == "YES":
+    benchmark_time_tag_readout()
+    benchmark_measurement_readout()
+    benchmark_waveform_download()
+    benchmark_host_measurements()
+    benchmark_csv_export()
+    benchmark_resume()
+    benchmark_archive()
+    benchmark_statistics()
+    benchmark_time_tag_analysis()
+    benchmark_report()
+    benchmark_setup()
+    benchmark_acquisition_wait()
+    benchmark_command_trace()
+    benchmark_transport()
+    benchmark_end_to_end()
+    benchmark_multiple_scopes()
+    benchmark_startup()
+    print "Benchmarks done."
+    sys.exit()
 
 ##############################################################################################################################################################################
 ## Main code
@@ -231,9 +3287,20 @@ sys.stdout.write("Script is running.  This may take a while...\n")
 ## Connect and initialize scope
 ##############################################################################################################################################################################
 
-## Define VISA Resource Manager & install directory
-## This directory will need to be changed if VISA was installed somewhere else.
-rm = visa.ResourceManager('C:\\Windows\\System32\\visa32.dll') # this uses pyvisa
+## Define the Resource Manager
+## The VISA library is set by VISA_LIBRARY, if VISA is needed at all.
+if SCOPE_VISA_ADDRESS == "SIMULATED" or (isinstance(SCOPE_VISA_ADDRESS, list) and set(SCOPE_VISA_ADDRESS) == set(["SIMULATED"])):
+    rm = SimulatedResourceManager() # No scope needed; see RUN_BENCHMARKS
+else:
+    rm = ScopeResourceManager() # VISA, HiSLIP, or socket; see SCOPE_TRANSPORT
+
+## Several scopes:  run the whole sequence on all of them concurrently, then finish
+if isinstance(SCOPE_VISA_ADDRESS, list):
+    Timeline = run_multiple_scopes(rm, SCOPE_VISA_ADDRESS, BASE_DIRECTORY + BASE_FILE_NAME)
+    rm.close()
+    print "\nMerged %d segments from %d scopes into one timeline." % (len(Timeline), len(SCOPE_VISA_ADDRESS))
+    print "Done."
+    sys.exit()
 
 ## Open Connection
 ## Define & open the scope by the VISA address or alias; # this uses PyVisa
@@ -242,6 +3309,11 @@ try:
 except Exception:
     print "Unable to connect to oscilloscope at " + str(SCOPE_VISA_ADDRESS) + ". Aborting script.\n"
     sys.exit()
+if TRACE_COMMANDS == "YES":
+    KsInfiniium = COMMAND_TRACER = CommandTracer(KsInfiniium)
+    atexit.register(COMMAND_TRACER.finish, BASE_DIRECTORY + BASE_FILE_NAME, TRACE_FORMAT) # Also when the script exits early
+if COALESCE_COMMANDS == "YES":
+    KsInfiniium = ScpiSession(KsInfiniium)
 
 ## Set Global Timeout
 ## This will be the default timeout value, but local timeouts may be used as needed (e.g. arming, triggering, finishing the acquisition)
@@ -252,15 +3324,21 @@ KsInfiniium.clear()
 
 KsInfiniium.write(":SYSTem:HEADer 0") # Turns headers off in response to queries.  While these headers can be useful for debug and other scenarios, they require more parsing.  
 
+Scope_ID = KsInfiniium.query("*IDN?").strip()
+print "Connected to " + Scope_ID + " %.3f s after start." % (time.time() - SCRIPT_START)
+if Command_Line is not None and Command_Line.connect_only:
+    KsInfiniium.close()
+    rm.close()
+    sys.exit()
+
 ## Data should already be acquired and scope should be STOPPED
 
 ##############################################################################################################################################################################
 ## Main Code
 
-TTags = [] # Create empty list
-
 ##############################################################################################################################################################################
 ## Scope setup
+trace_phase("setup")
 
 if LOCK_SCOPE == "YES":
     KsInfiniium.write(":SYSTem:LOCK 1; GUI OFF")
@@ -269,75 +3347,73 @@ elif LOCK_SCOPE == "NO":
 else:
     InfiniiumSafeExitCustomMessage("LOCK_SCOPE not defined properly.  Properly closing scope and exiting script.")
 
-if SETUP_METHOD == "MANUAL":
-    KsInfiniium.write(":STOP")
+## Resume a readout that did not finish, if the scope still holds its acquisition; setting up or arming the scope would lose it
+## Find number of enabled measurements
+if MEAS_METHOD == "SCRIPT" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
+    NUMBER_MEASUREMENTS = len(MEASURE_LIST)
+elif MEAS_METHOD == "SCOPE" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
+    NUMBER_MEASUREMENTS = scope_measurement_results(KsInfiniium)
+else:
+    NUMBER_MEASUREMENTS = 0
 
-elif SETUP_METHOD == "SCRIPT":
+## Look for an unfinished readout, with these settings, of the acquisition still on the scope
+Journal = find_resumable_readout(KsInfiniium, BASE_DIRECTORY + BASE_FILE_NAME, NUMBER_MEASUREMENTS) if RESUME_READOUT == "YES" and CONTINUOUS_RUNS == 1 else None
 
-    ## Start with a default setup
-    KsInfiniium.query("*RST;*OPC?") # Reset scope
-    KsInfiniium.write(":STOP") # Stop scope before making changes
+if Journal is not None:
+    print "Found an unfinished readout of this acquisition; the scope is not set up or armed again."
 
-    ## Set acquisition type        
-    KsInfiniium.write(":ACQuire:MODE SEGMented")
-    
-    ## Setup timebase - Set them in this order
-    KsInfiniium.write(":TIMebase:VIEW MAIN")
-    KsInfiniium.write(":TIMebase:REFerence CENTer")
-    KsInfiniium.write(":TIMebase:SCALe 5e-9") # Set horizontal scale (seconds/division)
-    KsInfiniium.write(":TIMebase:POSition 0")
-    KsInfiniium.query("*OPC?")
-
-    ## Turn channels on/off
-    if(CHANNEL_1_SCALE != 0):
-        KsInfiniium.write(":CHANnel1:DISPlay 1; SCALe %f; OFFSet %f" % CHANNEL_1_SCALE % CHANNEL_1_OFFSET) # Turn on channel 1
-    KsInfiniium.write(":CHANnel2:DISPlay 0")
-    KsInfiniium.write(":CHANnel3:DISPlay 1")
-    KsInfiniium.write(":CHANnel4:DISPlay 0")
-    
-    ## Set up channel scaling and offset
-    KsInfiniium.query(":CHANnel1:SCALe 0.2; OFFSet 0;*OPC?") # Set the vertical scale (volts/division) and offset for each channel
-    KsInfiniium.query(":CHANnel2:SCALe 0.2; OFFSet 0;*OPC?")
-    KsInfiniium.query(":CHANnel3:SCALe 0.2; OFFSet 0;*OPC?")
-    KsInfiniium.query(":CHANnel4:SCALe 0.2; OFFSet 0;*OPC?")
+elif SETUP_METHOD == "MANUAL":
+    KsInfiniium.write(":STOP")
 
-    ## Set up trigger
-    ## Trigger sweep is always TRIGgered (not AUTO) in Segmented memory mode
-    KsInfiniium.write(":TRIGger:MODE EDGE")
-    KsInfiniium.write(":TRIGger:EDGE:SOURce CHANnel1") # Set source for edge trigger    
-    KsInfiniium.write(":TRIGger:EDGE:COUPling DC")
-    KsInfiniium.write(":TRIGger:EDGE:SLOPe POSitive")
-    KsInfiniium.write(":TRIGger:LEVel CHANnel1,0") # Set level last
-    KsInfiniium.query("*OPC?")
+elif SETUP_METHOD == "SCRIPT":
 
-    ## Set up segmented acquisiton
-    KsInfiniium.write(":ACQuire:SEGMented:COUNt %d" % NUMBER_SEGMENTS)
+    ## Restore the saved setup if there is one for this scope and these settings, else set up command by command
+    Setup_File = setup_cache_file(KsInfiniium) if SETUP_CACHE == "YES" else None
+    Setup_Restored = Setup_File is not None and restore_setup(KsInfiniium, Setup_File)
+    if Setup_Restored:
+        print "Setup restored from " + Setup_File
+    else:
+        setup_scope(KsInfiniium)
 
     ## Do error check
     Setup_Err = ErrCheck()
     if len(Setup_Err) == 0:
         print "Setup completed without error."
+        if Setup_File is not None and not Setup_Restored:
+            save_setup(KsInfiniium, Setup_File)
         del Setup_Err
     else:
         InfiniiumSafeExitCustomMessage("Setup has errors.  Properly closing scope and exiting script.")
 else: 
     InfiniiumSafeExitCustomMessage("SETUP_METHOD not defined properly.  Properly closing scope and exiting script.")
 
-## Acquire waveforms
-acquire_waveforms()
-
-## Find number of enabled measurements and pre-allocate Results array
-if MEAS_METHOD == "SCRIPT" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
-    NUMBER_MEASUREMENTS = len(MEASURE_LIST)
-elif MEAS_METHOD == "SCOPE" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
-    NUMBER_MEASUREMENTS = len(KsInfiniium.query(":MEASure:RESults?").split(','))/7
-else:
-    NUMBER_MEASUREMENTS = 0
+## Count the measurements enabled on the scope again after a setup, which may have changed them, and pre-allocate Results array
+if Journal is None and MEAS_METHOD == "SCOPE" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
+    NUMBER_MEASUREMENTS = scope_measurement_results(KsInfiniium)
 if NUMBER_MEASUREMENTS == 0 and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
     InfiniiumSafeExitCustomMessage("No measurements defined or enabled.  Properly closing scope and exiting script.")
 else:
     Results = []
 
+## Continuous mode:  acquire, read out, and save CONTINUOUS_RUNS runs back to back, then finish
+if CONTINUOUS_RUNS != 1:
+    Duty_Cycles = run_continuous(KsInfiniium, CONTINUOUS_RUNS, NUMBER_MEASUREMENTS)
+    if Duty_Cycles:
+        print "\nAverage duty cycle over %d runs:  %.1f%%" % (len(Duty_Cycles), 100.0 * np.mean(Duty_Cycles))
+    print "\nDone with oscilloscope operations.\n"
+    KsInfiniium.clear()
+    KsInfiniium.write(":SYSTem:LOCK 0; GUI ON")
+    KsInfiniium.close()
+    rm.close()
+    print "Done."
+    sys.exit()
+
+## Acquire waveforms
+trace_phase("acquisition wait")
+Run_Started = time.time()
+if Journal is None:
+    acquire_waveforms()
+
 #KsInfiniium.write(':ACQuire:SEGMented:PRATe 0')
 #KsInfiniium.write(':ACQuire:SEGMented:PLAY ON')
 #KsInfiniium.write(':ANALyze:AEDGes 1')
@@ -354,19 +3430,39 @@ if NSegs_Acquired == 0:
     KsInfiniium.close()
     rm.close()
     sys.exit()
-sgm_index = 0
-while sgm_index <= NSegs_Acquired: # Loop through segments, grab time tags
-    sgm_index +=1
-    TTag = float(KsInfiniium.query(":ACQuire:SEGMented:INDex " + str(sgm_index) + ";:WAVeform:SEGMented:TTAG?"))
-        ## Note this is really two lines, but faster to concatenate them together as above:
-            ## KsInfiniium.write(":ACQuire:SEGMented:INDex " + str(sgm_index)) # Set segment
-            ## TTag = float(KsInfiniium.query(":WAVeform:SEGMented:TTAG?")) # Get Time Tag
-    TTags.append(TTag) # Append current result to list
+
+## Open the output files; results are saved batch by batch as they are read
+writer = StreamingResultWriter(BASE_DIRECTORY + BASE_FILE_NAME, NSegs_Acquired, NUMBER_MEASUREMENTS, scope_id = Scope_ID, journal = Journal)
+
+## Grab the time tags (and measurement results) of all segments
+if USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO" and HOST_MEASUREMENTS == "YES" and DOWNLOAD_WAVEFORMS == "YES":
+    trace_phase("time tag readout")
+    TTags = read_time_tags(KsInfiniium, NSegs_Acquired) # Measurements are computed from the waveforms after the download below, and saved then
+elif USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
+    trace_phase("measurement readout")
+    Results = capture_measurements(KsInfiniium, NSegs_Acquired, NUMBER_MEASUREMENTS, writer = writer) # Columns are index, time tag, then one column per measurement
+    TTags = Results[:,1]
+else:
+    trace_phase("time tag readout")
+    TTags = read_time_tags(KsInfiniium, NSegs_Acquired, writer = writer)
+    ## Note these replace a loop of one query per segment:
+        ## KsInfiniium.query(":ACQuire:SEGMented:INDex " + str(sgm_index) + ";:WAVeform:SEGMented:TTAG?")
+    ## which costs a full VISA round trip per segment
+
+## Download the waveforms of all segments, if requested
+if DOWNLOAD_WAVEFORMS == "YES":
+    trace_phase("waveform download")
+    Waveforms, Waveform_Scaling = download_waveforms(KsInfiniium, NSegs_Acquired)
+    if USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO" and HOST_MEASUREMENTS == "YES":
+        trace_phase("host measurements")
+        Results = np.column_stack((np.arange(1, NSegs_Acquired + 1), TTags, compute_host_measurements(Waveforms, Waveform_Scaling)))
+        writer.append(Results)
 
 ##############################################################################################################################################################################
 ## Properly disconnect from scope
 ##############################################################################################################################################################################
 
+trace_phase("disconnect")
 print "\nDone with oscilloscope operations.\n"
 KsInfiniium.clear() # Clear scope's remote interface
 KsInfiniium.write(":SYSTem:LOCK 0; GUI ON")
@@ -374,93 +3470,54 @@ KsInfiniium.close() # Close interface to scope
 rm.close()
         
 #####
-## Save data
-xxx = Save_Data(Results, MEASUREMENT_HEADER)
-Results = np.asarray(xxx[0])
-MEASUREMENT_HEADER = xxx[1]
-del xxx
-
-## Export time tags to CSV
-TTags = np.asarray(TTags)
-filename = BASE_DIRECTORY + BASE_FILE_NAME + "_TimeTags.csv"
-with open(filename, 'wb') as filehandle:
-    np.savetxt(filehandle, TTags, delimiter=',', newline= '\n', comments='')
+## Finish saving data; results and time tags were saved as they were read
+trace_phase("save")
+writer.close()
+MEASUREMENT_HEADER = writer.header
+
+## Add the run to the archive, where it is kept alongside earlier runs
+if ARCHIVE_RUNS == "YES":
+    Archive_Run = ResultArchive().add_run(Results if NUMBER_MEASUREMENTS > 0 else np.column_stack((np.arange(1, len(TTags) + 1), TTags)),
+                                          [name.strip() for name in MEASUREMENT_HEADER.split(",")][:2 + NUMBER_MEASUREMENTS], Run_Started, name = BASE_FILE_NAME, scope = Scope_ID)
+    print "Run %d added to the archive in %s." % (Archive_Run, ARCHIVE_DIRECTORY)
+
+## Save waveforms as raw codes, with the scaling needed to convert them to volts and seconds
+if DOWNLOAD_WAVEFORMS == "YES":
+    with open(BASE_DIRECTORY + BASE_FILE_NAME + "_Waveforms.npy", 'wb') as filehandle:
+        np.save(filehandle, Waveforms)
+    with open(BASE_DIRECTORY + BASE_FILE_NAME + "_WaveformScaling.csv", 'w') as filehandle:
+        filehandle.write("Channel,Y increment (V),Y origin (V),X increment (s),X origin (s)\n")
+        np.savetxt(filehandle, Waveform_Scaling, delimiter=',')
+    del filehandle
 
 ##############################################################################################################################################################################
 ## Report statistics
 ##############################################################################################################################################################################
 
+trace_phase("report")
 try:
     
     if (REPORT_MEASUREMENT_STATISTICS == "YES" or REPORT_THROUGHPUT_STATISTICS == "YES"):
-        DELTA_TIMES = np.zeros()
-        if USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
-            TIMES = Results[:,1]
-            for n in range (0,0,1):
-                DELTA_TIMES[n] = Results[n+1,1] - Results[n,1]
-        elif USE_AS_TRIGGER_TIME_RECORDER_ONLY == "YES":
-            TIMES = Results
-            for n in range (0,0,1):
-                DELTA_TIMES[n] = Results[n+1] - Results[n]
-        del n
+        TIMES = TTags
+        DELTA_TIMES = np.diff(TIMES)
+        MEASUREMENT_NAMES = [name.strip() for name in MEASUREMENT_HEADER.strip('\n').split(',')[2:]]
     
     if REPORT_MEASUREMENT_STATISTICS == "YES" and USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO":
         print "MEASUREMENT STATISTICS:\n"
+        Measurement_Statistics = compute_statistics(Results[:,2:]) # Every statistic of every measurement in one pass
         for n in range (0,NUMBER_MEASUREMENTS,1):
-            m_avg     = np.mean(Results[:,n+2])
-            m_std_dev = np.std(Results[:,n+2])
-            m_max     = np.max(Results[:,n+2])
-            m_min     = np.min(Results[:,n+2])
-            m_range    = m_max - m_min        
-            
-            print "Measurement statistics for " + str(list(MEASUREMENT_HEADER.strip('\n').split(','))[n+2]) + ":"
-            print "\tAverage:             " , m_avg
-            print "\tStandard deviation:  " , m_std_dev
-            print "\tMinimum:             " , m_min
-            print "\tMaximum:             " , m_max
-            print "\tRange:               " , m_range , "\n"
-            
-            Ymax = m_max
-            if Ymax > 0:
-                Ymax = Ymax*1.1
-            elif Ymax < 0:
-                Ymax = Ymax*0.9
-            elif Ymax == 0:
-                Ymax = 0.1
-    
-            Ymin = m_min
-            if Ymin > 0:
-                Ymin = Ymin*0.9
-            elif Ymin < 0:
-                Ymin = Ymin*1.1
-            elif Ymin == 0:
-                Ymin = -0.1
-    
-            print str(list(MEASUREMENT_HEADER.strip('\n').split(','))[n+2]) + ") vs. apparent trigger time (s):"
-            print "\tNOTE:  Time tags are referenced to computer clock, not scope clock.  Refer to Python documentation for time.clock() details.\n"
-            plt.plot(TIMES,Results[:,n+2],'r+')
-            plt.ylim(Ymin,Ymax)
-            plt.xlabel("Apparent Trigger Time (s)")
-            plt.ylabel(str(list(MEASUREMENT_HEADER.strip('\n').split(','))[n+2]))
-            plt.show()
-
-            print "\n"
-            print "Historgam of " +  str(list(MEASUREMENT_HEADER.strip('\n').split(','))[n+2]) + ":"
-            plt.hist(Results[:,n+2])
-            plt.xlabel( str(list(MEASUREMENT_HEADER.split(','))[n+2]))
-            plt.ylabel("Hits")
-            plt.show()
-            print "\n"
+            print_statistics(MEASUREMENT_NAMES[n], Measurement_Statistics, n)
         
-        del n, m_avg, m_std_dev, m_min, m_max, m_range, Ymin, Ymax
+        del n
     
-    if REPORT_THROUGHPUT_STATISTICS == "YES":
-                
-        THROUGHPUT_avg     = np.mean(DELTA_TIMES)
-        THROUGHPUT_std_dev = np.std(DELTA_TIMES)
-        THROUGHPUT_max     = np.max(DELTA_TIMES)
-        THROUGHPUT_min     = np.min(DELTA_TIMES)
-        THROUGHPUTrange    = THROUGHPUT_max - THROUGHPUT_min
+    if REPORT_THROUGHPUT_STATISTICS == "YES" and len(DELTA_TIMES) == 0:
+        print "THROUGHPUT STATISTICS:\n"
+        print "\tOnly one segment was acquired; there are no trigger time differences.\n"
+    elif REPORT_THROUGHPUT_STATISTICS == "YES":
+        
+        Interval_Statistics = compute_statistics(DELTA_TIMES)
+        THROUGHPUT_avg     = Interval_Statistics["mean"][0]
+        THROUGHPUT_std_dev = Interval_Statistics["std"][0]
         
         print "THROUGHPUT STATISTICS:\n"
         print "\tNOTE:  Time tags are based off of computer clock, not scope clock.  Refer to Python documentation for time.clock() details.\n"
@@ -468,37 +3525,29 @@ try:
         print "\tAverage time between triggers"
         print "\t   was no more than: " , THROUGHPUT_avg , "seconds (" +     str('%5.2f' % (1.0/THROUGHPUT_avg)) + " Hz)."
         print "\tStandard deviation:  " , THROUGHPUT_std_dev , "seconds (" + str('%5.2f' % ((THROUGHPUT_std_dev/THROUGHPUT_avg)*float(10**3))) + " parts per thousand)."
-        print "\tMinimum:             " , THROUGHPUT_min
-        print "\tMaximum:             " , THROUGHPUT_max
-        print "\tRange:               " , THROUGHPUTrange , "\n"
+        print "\tMinimum:             " , Interval_Statistics["min"][0]
+        print "\tMaximum:             " , Interval_Statistics["max"][0]
+        print "\tRange:               " , Interval_Statistics["range"][0]
+        for p in sorted(Interval_Statistics["percentiles"]):
+            print "\t%-21s" % ("%g percentile:" % p), Interval_Statistics["percentiles"][p][0]
+        print ""
+        if writer.analyzer is not None:
+            print "Time tag analysis (saved to " + BASE_FILE_NAME + "_TimeTagSummary.csv):"
+            for quantity, value, unit in writer.analyzer.summary()[3:]:
+                print "\t%-40s" % (quantity + ":"), value, unit
+            print ""
         
-        indices = np.linspace(1,1,1,dtype=int)
-        plt.plot(indices,TIMES,'r+')
-        plt.xlim(-1,2)
-        plt.xlabel("Acquisition Number")
-        plt.ylabel("Apparent Trigger Time (s)")
-        plt.show()
-        
-        print "\n"
-        indices = np.linspace(1,0,0,dtype=int)
-        plt.plot(indices,DELTA_TIMES,'r+')
-        plt.xlabel("Acquisition Number-1")
-        plt.ylabel("Delta Trigger Times (s)")
-        plt.show()
-    
-        print "\n"
-        plt.hist(DELTA_TIMES)
-        plt.xlabel("Trigger Time Differences (s)")
-        plt.ylabel("Hits")
-        plt.show()
-        
-        del THROUGHPUT_avg, THROUGHPUT_std_dev, THROUGHPUT_max, THROUGHPUT_min, THROUGHPUTrange, indices
+        del THROUGHPUT_avg, THROUGHPUT_std_dev, p
         
 except Exception as err:
     print 'Exception: ' + str(err.message) + "\n"
     print 'Exception occured in Statistcs and Throuput reproting section.\n'
     sys.exit("Exiting script.")
 
+if REPORT_PLOTS != "NO":
+    draw_report(run_report_plots(Results if USE_AS_TRIGGER_TIME_RECORDER_ONLY == "NO" else None, TTags,
+                                 [name.strip() for name in MEASUREMENT_HEADER.strip('\n').split(',')[2:]]), BASE_DIRECTORY + BASE_FILE_NAME)
+
 ##############################################################################################################################################################################
 ## Done
 ##############################################################################################################################################################################